@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark vhost-gen loading, rendering and startup with synthetic workloads.
+
+Runs fully offline against the repository's own conf.yml, nginx.yml and
+apache24.yml. Results are written as JSON, and a previous result file can be
+passed to flag regressions.
+
+Usage: bench.py [-o <file>] [-c <file>] [-t <percent>] [-s <sizes>] [-r <runs>]
+
+  -o <file>     Write results to <file> (default: bench-results.json)
+  -c <file>     Compare against an earlier result file and exit 1 when a
+                benchmark got slower than the threshold
+  -t <percent>  Regression threshold in percent (default: 10)
+  -s <sizes>    Comma separated vhost counts to render (default: 1,100,10000,100000)
+  -r <runs>     Runs per benchmark, the median counts (default: 5)
+"""
+
+from __future__ import print_function
+
+import getopt
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, "vhost-gen.py")
+
+SERVERS = {
+    "nginx": (os.path.join(HERE, "conf.yml"), os.path.join(HERE, "nginx.yml")),
+    "apache24": (
+        os.path.join(HERE, "..", "..", "apache", "vhost-gen", "conf.yml"),
+        os.path.join(HERE, "..", "..", "apache", "vhost-gen", "apache24.yml"),
+    ),
+}
+MODES = ("plain", "ssl", "both", "redir", "let")
+SIZES = (1, 100, 10000, 100000)
+
+# Number of entries in the alias/deny lists of the large config
+LARGE_LISTS = 1000
+# Vhosts rendered per run with the large config
+LARGE_VHOSTS = 100
+
+
+############################################################
+# Helper
+############################################################
+
+
+def load_vhost_gen():
+    """Import vhost-gen.py as a module."""
+    spec = importlib.util.spec_from_file_location("vhost_gen", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(func, runs, items=1):
+    """Run func() runs times and summarize the wall clock time of each run."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    median = times[len(times) // 2]
+    return {
+        "runs": runs,
+        "items": items,
+        "min": times[0],
+        "median": median,
+        "max": times[-1],
+        "per_item_us": median / items * 1e6,
+    }
+
+
+def write_large_config(vg, src, path):
+    """Write a copy of src with LARGE_LISTS aliases and denies to path."""
+    _, config, _ = vg.load_yaml(src)
+    config = vg.merge_yaml(vg.DEFAULT_CONFIG, config)
+    config["vhost"]["alias"] = [
+        {
+            "alias": "/alias-%d/" % i,
+            "path": "/data/alias/%d" % i,
+            "xdomain_request": {"enable": i % 2 == 0, "origin": "example.org"},
+        }
+        for i in range(LARGE_LISTS)
+    ]
+    config["vhost"]["deny"] = [
+        {"alias": "/deny-%d/" % i} for i in range(LARGE_LISTS)
+    ]
+    # JSON is valid YAML
+    with open(path, "w") as stream:
+        json.dump(config, stream)
+
+
+############################################################
+# Benchmarks
+############################################################
+
+
+def bench_render(vg, config, template, mode, count):
+    """Build the context and render count vhosts like a batch run does."""
+    fragments = vg.FragmentCache(config, template)
+    for i in range(count):
+        name = "site%d.example.org" % i
+        ctx = vg.VhostContext(config, name, "/data/wwwroot/" + name, None,
+                              mode, "/", False)
+        vg.get_vhost(ctx, template, fragments)
+
+
+def bench_startup(args, env, runs):
+    """Time a complete interpreter start running vhost-gen with args."""
+    def run():
+        subprocess.check_call([sys.executable, SCRIPT] + args,
+                              stdout=subprocess.DEVNULL, env=env)
+    return measure(run, runs)
+
+
+def run_benchmarks(vg, workdir, sizes, runs):
+    """Run all benchmarks and return {name: result}."""
+    results = dict()
+    cache_dir = os.path.join(workdir, "cache")
+
+    for server, (config_path, template_path) in SERVERS.items():
+        tpl_dir = os.path.join(workdir, server)
+        os.makedirs(tpl_dir)
+        shutil.copy(template_path, os.path.join(tpl_dir, vg.TEMPLATES[server]))
+        large_path = os.path.join(workdir, server + "-large.yml")
+        write_large_config(vg, config_path, large_path)
+
+        for label, path in (("", config_path), ("large/", large_path)):
+            results[server + "/load_config/" + label + "cold"] = measure(
+                lambda: vg.load_config(path), runs)
+            vg.load_config(path, cache_dir)
+            results[server + "/load_config/" + label + "cached"] = measure(
+                lambda: vg.load_config(path, cache_dir), runs)
+
+        results[server + "/load_template/cold"] = measure(
+            lambda: vg.load_template(tpl_dir, None, server), runs)
+        vg.load_template(tpl_dir, None, server, cache_dir)
+        results[server + "/load_template/cached"] = measure(
+            lambda: vg.load_template(tpl_dir, None, server, cache_dir), runs)
+
+        _, config, _ = vg.load_config(config_path)
+        _, large, _ = vg.load_config(large_path)
+        _, template, _ = vg.load_template(tpl_dir, None, server)
+
+        for mode in MODES:
+            for size in sizes:
+                name = "%s/get_vhost/%s/%d" % (server, mode, size)
+                results[name] = measure(
+                    lambda: bench_render(vg, config, template, mode, size),
+                    runs, size)
+            name = "%s/get_vhost/%s/large/%d" % (server, mode, LARGE_VHOSTS)
+            results[name] = measure(
+                lambda: bench_render(vg, large, template, mode, LARGE_VHOSTS),
+                runs, LARGE_VHOSTS)
+
+    # Cold interpreter startup, with a warm on-disk config/template cache
+    env = dict(os.environ, VHOST_GEN_CACHE_DIR=cache_dir)
+    config_path = SERVERS["nginx"][0]
+    render = ["-c", config_path, "-t", os.path.join(workdir, "nginx"),
+              "-p", "/data/wwwroot/foo", "-n", "foo"]
+    results["startup/version"] = bench_startup(["--version"], env, runs)
+    results["startup/render"] = bench_startup(render, env, runs)
+    results["startup/render/no-cache"] = bench_startup(render + ["--no-cache"],
+                                                       env, runs)
+    return results
+
+
+############################################################
+# Compare
+############################################################
+
+
+def compare(old, new, threshold):
+    """Print the median change of every benchmark and return the regressions."""
+    regressions = []
+    print("%-45s %12s %12s %9s" % ("benchmark", "before [s]", "after [s]",
+                                   "change"))
+    for name in sorted(new):
+        if name not in old:
+            continue
+        before = old[name]["median"]
+        after = new[name]["median"]
+        change = (after - before) / before * 100 if before else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("%-45s %12.6f %12.6f %+8.1f%%%s" % (name, before, after,
+                                                  change, flag))
+    return regressions
+
+
+############################################################
+# Main
+############################################################
+
+
+def print_results(results):
+    """Print a summary table."""
+    print("%-45s %12s %12s %12s" % ("benchmark", "median [s]", "min [s]",
+                                    "per item [us]"))
+    for name in sorted(results):
+        res = results[name]
+        print("%-45s %12.6f %12.6f %12.2f" % (name, res["median"], res["min"],
+                                              res["per_item_us"]))
+
+
+def main(argv):
+    """Main entrypoint."""
+    try:
+        opts, _ = getopt.getopt(argv, "ho:c:t:s:r:")
+    except getopt.GetoptError as err:
+        print(err, file=sys.stderr)
+        return 2
+
+    output = "bench-results.json"
+    previous = None
+    threshold = 10.0
+    sizes = SIZES
+    runs = 5
+    for opt, arg in opts:
+        if opt == "-h":
+            print(__doc__.strip())
+            return 0
+        if opt == "-o":
+            output = arg
+        elif opt == "-c":
+            previous = arg
+        elif opt == "-t":
+            threshold = float(arg)
+        elif opt == "-s":
+            sizes = tuple(int(size) for size in arg.split(","))
+        elif opt == "-r":
+            runs = int(arg)
+
+    vg = load_vhost_gen()
+    workdir = tempfile.mkdtemp(prefix="vhost-gen-bench-")
+    try:
+        results = run_benchmarks(vg, workdir, sizes, runs)
+    finally:
+        shutil.rmtree(workdir)
+
+    print_results(results)
+    with open(output, "w") as stream:
+        json.dump(
+            {
+                "meta": {
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "yaml_loader": vg.yaml_loader().__name__,
+                },
+                "results": results,
+            },
+            stream,
+            indent=2,
+            sort_keys=True,
+        )
+    print("results written to", output)
+
+    if previous is not None:
+        with open(previous) as stream:
+            old = json.load(stream)["results"]
+        print()
+        regressions = compare(old, results, threshold)
+        if regressions:
+            print("%d benchmark(s) regressed by more than %.1f%%"
+                  % (len(regressions), threshold))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
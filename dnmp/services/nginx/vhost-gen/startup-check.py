@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Check the startup cost of vhost-gen against its import time budget.
+
+Every scenario runs vhost-gen.py with 'python3 -X importtime' and sums the
+cumulative import time of all top-level modules which a bare interpreter
+does not import anyway. The best of several runs is compared with the
+budget of the scenario, and modules a scenario must never import (e.g. yaml
+for --help) are reported as failures.
+
+Usage: startup-check.py [<path to vhost-gen.py>]
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Number of runs per scenario, the fastest one counts
+RUNS = 5
+
+
+def get_scenarios(config, tpl_dir):
+    """Get (name, argv, budget in microseconds, forbidden modules)."""
+    render = ["-c", config, "-t", tpl_dir, "-p", "/data/wwwroot/foo", "-n", "foo"]
+    return [
+        ("--version", ["--version"], 1000, ("yaml", "re", "getopt")),
+        ("--help", ["--help"], 1000, ("yaml", "re", "getopt")),
+        ("invalid arguments", ["-p", "/x", "-n", "in valid"], 20000, ("yaml",)),
+        ("render (cached)", render, 30000, ("yaml",)),
+    ]
+
+
+def import_times(argv, env):
+    """Run python3 -X importtime and return {top-level module: cumulative us}."""
+    proc = subprocess.Popen(
+        [sys.executable, "-X", "importtime"] + argv,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        env=env,
+    )
+    _, stderr = proc.communicate()
+
+    times = dict()
+    for line in stderr.decode("utf-8", "replace").splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        # Nested imports are indented below their parent
+        if name.startswith("  ") or not cumulative.strip().isdigit():
+            continue
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main(argv):
+    """Main entrypoint."""
+    script = argv[0] if argv else os.path.join(HERE, "vhost-gen.py")
+    config = os.path.join(HERE, "conf.yml")
+
+    cache_dir = tempfile.mkdtemp(prefix="vhost-gen-startup-")
+    env = dict(os.environ, VHOST_GEN_CACHE_DIR=cache_dir)
+    try:
+        baseline = set(import_times(["-c", "pass"], env))
+
+        # Warm up the config/template cache for the cached render scenario
+        subprocess.call(
+            [sys.executable, script, "-c", config, "-t", HERE, "-p", "/x", "-n", "x"],
+            stdout=subprocess.DEVNULL, env=env,
+        )
+
+        failed = False
+        print("%-20s %10s %10s  %s" % ("scenario", "us", "budget", "status"))
+        for name, args, budget, forbidden in get_scenarios(config, HERE):
+            best = None
+            imported = set()
+            for _ in range(RUNS):
+                times = import_times([script] + args, env)
+                imported |= set(times)
+                total = sum(t for mod, t in times.items() if mod not in baseline)
+                best = total if best is None else min(best, total)
+
+            errors = []
+            if best > budget:
+                errors.append("over budget")
+            for mod in forbidden:
+                if mod in imported - baseline:
+                    errors.append("imports " + mod)
+            failed = failed or bool(errors)
+            print("%-20s %10d %10d  %s" % (name, best, budget,
+                                          ", ".join(errors) or "ok"))
+    finally:
+        shutil.rmtree(cache_dir)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
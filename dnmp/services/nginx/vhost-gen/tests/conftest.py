@@ -0,0 +1,68 @@
+"""
+Fixtures for the vhost-gen tests: vhost-gen.py loaded as a module and
+a config saving to a temporary conf_dir.
+"""
+
+import copy
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+TOOL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APACHE_TOOL_DIR = os.path.join(TOOL_DIR, "..", "..", "apache", "vhost-gen")
+
+
+def import_vhost_gen():
+    """Import vhost-gen.py, registered as vhost_gen (so frozen configs pickle)."""
+    spec = importlib.util.spec_from_file_location(
+        "vhost_gen", os.path.join(TOOL_DIR, "vhost-gen.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["vhost_gen"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def vhost_gen():
+    return import_vhost_gen()
+
+
+@pytest.fixture
+def make_vg(vhost_gen, tmp_path):
+    """Get a factory loading a VhostGen object for a server (and its template)."""
+    loaded = []
+
+    def make(server="nginx", tpl_dir=TOOL_DIR, **vhost):
+        config = copy.deepcopy(vhost_gen.DEFAULT_CONFIG)
+        config["server"] = server
+        config["conf_dir"] = str(tmp_path / "conf")
+        config["vhost"]["log"]["dir"] = {"create": True, "path": str(tmp_path / "log")}
+        config["vhost"].update(vhost)
+        os.makedirs(config["conf_dir"], exist_ok=True)
+        # json is valid yaml
+        path = tmp_path / "conf.yml"
+        path.write_text(json.dumps(config))
+        vg = vhost_gen.load(str(path), tpl_dir, cache_dir=None)
+        loaded.append(vg)
+        return vg
+
+    yield make
+    for vg in loaded:
+        vg.inventory.close()
+
+
+@pytest.fixture
+def vg(make_vg):
+    return make_vg()
+
+
+@pytest.fixture
+def conf_files(vg):
+    """Get a function listing the vhost files of conf_dir."""
+    def files():
+        return sorted(name for name in os.listdir(vg.config["conf_dir"])
+                      if not name.startswith("."))
+    return files
@@ -0,0 +1,107 @@
+"""Bundles: rewriting one section keeps the others."""
+
+import os
+
+import pytest
+
+
+SPECS = [{"name": "v%d.com" % (i), "docroot": "/data/v%d" % (i)} for i in range(6)]
+
+
+def bundled(vhost_gen, conf_dir):
+    """Get the sections of every bundle in conf_dir by file name."""
+    return dict((name, vhost_gen.read_bundle(os.path.join(conf_dir, name))[1])
+                for name in sorted(os.listdir(conf_dir))
+                if vhost_gen.is_bundle_path(name))
+
+
+def test_is_bundle_path(vhost_gen):
+    assert vhost_gen.is_bundle_path("/etc/nginx/conf.d/vhost-gen.bundle-0.conf")
+    assert vhost_gen.is_bundle_path("vhost-gen.bundle-12.conf.disabled")
+    assert vhost_gen.is_bundle_path("vhost-gen.mass.conf")
+    assert not vhost_gen.is_bundle_path("vhost-gen.bundle-1.com.conf")
+    assert not vhost_gen.is_bundle_path("my-vhost-gen.bundle-1.conf")
+    assert not vhost_gen.is_bundle_path("vhost-gen.massive.conf")
+
+
+def test_bundle_rewrites(vhost_gen, vg, conf_files):
+    for spec in SPECS:
+        status, path = vg.save(spec, bundle=2)
+        assert status == vhost_gen.STATUS_CREATED
+        assert path == vhost_gen.get_bundle_path(vg.config, spec["name"], 2)
+    bundles = bundled(vhost_gen, vg.config["conf_dir"])
+    assert len(bundles) == 2
+    assert conf_files() == sorted(bundles)
+    assert sorted(name for sections in bundles.values() for name in sections) \
+        == [spec["name"] for spec in SPECS]
+
+    assert vg.save(SPECS[0], bundle=2)[0] == vhost_gen.STATUS_UNCHANGED
+    status, path = vg.save(dict(SPECS[0], docroot="/data/new"), bundle=2)
+    assert status == vhost_gen.STATUS_UPDATED
+    after = bundled(vhost_gen, vg.config["conf_dir"])
+    assert "/data/new" in after[os.path.basename(path)]["v0.com"]
+    for name, sections in bundles.items():
+        for vhost in sections:
+            if vhost != "v0.com":
+                assert after[name][vhost] == sections[vhost]
+
+    # Disabling moves the section to the .disabled bundle and back
+    assert vg.inventory.set_enabled("v1.com", False) == \
+        (True, vhost_gen.STATUS_DISABLED, "")
+    path = vg.inventory.entry("v1.com")[1]["path"]
+    assert "v1.com" not in vhost_gen.read_bundle(path)[1]
+    disabled = vhost_gen.read_bundle(path + vhost_gen.DISABLED_SUFFIX)[1]
+    assert disabled == {"v1.com": after[os.path.basename(path)]["v1.com"]}
+    assert vg.inventory.set_enabled("v1.com", True)[1] == vhost_gen.STATUS_ENABLED
+    assert bundled(vhost_gen, vg.config["conf_dir"]) == after
+
+    # Removing the last vhost of a bundle removes the bundle
+    for spec in SPECS:
+        assert vg.inventory.remove(spec["name"]) == (True, vhost_gen.STATUS_REMOVED, "")
+        for name in after:
+            after[name].pop(spec["name"], None)
+        assert bundled(vhost_gen, vg.config["conf_dir"]) == \
+            dict((name, sections) for name, sections in after.items() if sections)
+    assert conf_files() == []
+    assert vg.inventory.entries() == (True, [], "")
+
+
+@pytest.mark.parametrize("name", ["vhost-gen.bundle-1", "vhost-gen.mass"])
+def test_reserved_names(vhost_gen, vg, name):
+    with pytest.raises(vhost_gen.ArgumentError):
+        vg.render({"name": name, "docroot": "/data/a"})
+
+
+@pytest.mark.parametrize("content", [
+    # A section without its end marker
+    "# vhost-gen begin a.com\nserver {}\n",
+    "# vhost-gen begin a.com\nserver {}\n# vhost-gen begin b.com\n"
+    "server {}\n# vhost-gen end b.com\n",
+    # Content outside of the sections
+    "server {}\n# vhost-gen begin a.com\nserver {}\n# vhost-gen end a.com\n",
+    "# vhost-gen begin a.com\nserver {}\n# vhost-gen end a.com\nserver {}\n",
+])
+def test_malformed_bundles_are_not_rewritten(vhost_gen, vg, content):
+    path = vhost_gen.get_bundle_path(vg.config, "c.com", 1)
+    with open(path, "w") as fp:
+        fp.write(content)
+    assert vhost_gen.read_bundle(path)[0] is False
+    with pytest.raises(vhost_gen.SaveError, match="Malformed bundle"):
+        vg.save({"name": "c.com", "docroot": "/data/c"}, bundle=1)
+    with open(path) as fp:
+        assert fp.read() == content
+
+
+def test_malformed_mass_file_is_not_rewritten(vhost_gen, vg):
+    mass = vhost_gen.get_mass_path(vg.config)
+    vg.save({"name": "a.com", "docroot": "/data/a"}, mass=True)
+    with open(mass) as fp:
+        content = fp.read()
+    # A section after the content following the sections
+    content += "# vhost-gen begin b.com\n    b.com \"/data/b/\";\n# vhost-gen end b.com\n"
+    with open(mass, "w") as fp:
+        fp.write(content)
+    with pytest.raises(vhost_gen.SaveError, match="Malformed bundle"):
+        vg.save({"name": "c.com", "docroot": "/data/c"}, mass=True)
+    with open(mass) as fp:
+        assert fp.read() == content
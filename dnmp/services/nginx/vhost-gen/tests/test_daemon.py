@@ -0,0 +1,86 @@
+"""The daemon saves vhosts like the command line and the library do."""
+
+import json
+import socket
+import threading
+
+import pytest
+
+from conftest import TOOL_DIR
+
+
+@pytest.fixture
+def make_daemon(vhost_gen, vg, tmp_path):
+    daemons = []
+
+    def make(*argv):
+        args = vhost_gen.parse_args(["-c", str(tmp_path / "conf.yml"), "-t", TOOL_DIR,
+                                     "--no-cache", "--serve", str(tmp_path / "sock")]
+                                    + list(argv))
+        daemon = vhost_gen.VhostDaemon(args)
+        daemons.append(daemon)
+        return daemon
+
+    yield make
+    for daemon in daemons:
+        if daemon.inventory is not None:
+            daemon.inventory.close()
+
+
+def save(daemon, **vhost):
+    return daemon.handle({"op": "save", "vhost": vhost})
+
+
+def test_daemon_save(vhost_gen, vg, make_daemon, conf_files):
+    daemon = make_daemon()
+    response = save(daemon, name="a.com", docroot="/data/a")
+    assert response["ok"], response
+    assert (response["status"], response["path"]) == \
+        (vhost_gen.STATUS_CREATED, vg.path("a.com"))
+    assert save(daemon, name="a.com", docroot="/data/a")["status"] == \
+        vhost_gen.STATUS_UNCHANGED
+    with open(vg.path("a.com")) as fp:
+        assert fp.read() == vg.render({"name": "a.com", "docroot": "/data/a"})
+    assert vg.inventory.entry("a.com")[1]["spec"]["docroot"] == "/data/a"
+
+    response = daemon.handle({"op": "render", "vhost": {"name": "b.com",
+                                                         "docroot": "/data/b"}})
+    assert response["vhost"] == vg.render({"name": "b.com", "docroot": "/data/b"})
+    assert conf_files() == ["a.com.conf"]
+
+    response = save(daemon, name="c.com", docroot="/data/c", default="no")
+    assert not response["ok"]
+    assert conf_files() == ["a.com.conf"]
+
+
+def test_daemon_bundle_and_mass(vhost_gen, vg, make_daemon, conf_files):
+    daemon = make_daemon("--bundle", "2")
+    response = save(daemon, name="a.com", docroot="/data/a")
+    assert response["path"] == vhost_gen.get_bundle_path(vg.config, "a.com", 2)
+    assert "a.com" in vhost_gen.read_bundle(response["path"])[1]
+
+    daemon = make_daemon("--mass")
+    mass = vhost_gen.get_mass_path(vg.config)
+    response = save(daemon, name="b.com", docroot="/data/b")
+    assert (response["status"], response["path"]) == (vhost_gen.STATUS_CREATED, mass)
+    # Saving without --mass moves it to its own file again
+    response = save(make_daemon(), name="b.com", docroot="/data/b")
+    assert response["path"] == vg.path("b.com")
+    assert vhost_gen.read_bundle(mass)[1] == {}
+
+
+def test_daemon_connection(vhost_gen, vg, make_daemon):
+    daemon = make_daemon()
+    server, client = socket.socketpair()
+    thread = threading.Thread(target=daemon.handle_connection, args=(server,))
+    thread.start()
+    stream = client.makefile("rwb")
+    for request in ({"op": "ping"},
+                    {"op": "save", "vhost": {"name": "a.com", "docroot": "/data/a"}}):
+        stream.write(json.dumps(request).encode("utf-8") + b"\n")
+        stream.flush()
+        assert json.loads(stream.readline().decode("utf-8"))["ok"]
+    stream.close()
+    client.close()
+    thread.join(5)
+    assert vg.inventory.entry("a.com")[0]
@@ -0,0 +1,99 @@
+"""Inventory garbage collection: only vhosts whose docroot is gone are orphans."""
+
+import os
+import socket
+
+import pytest
+
+
+@pytest.fixture
+def sites(vhost_gen, vg, tmp_path):
+    """Save a vhost with an existing docroot (kept) and one without (gone)."""
+    docroot = tmp_path / "www" / "kept"
+    docroot.mkdir(parents=True)
+    vg.save({"name": "kept.com", "docroot": str(docroot)}, bundle=1)
+    vg.save({"name": "gone.com", "docroot": str(tmp_path / "www" / "gone")},
+            bundle=1)
+    vg.save({"name": "single.com", "docroot": str(tmp_path / "www" / "single")})
+    return vhost_gen.get_bundle_path(vg.config, "kept.com", 1)
+
+
+def test_gc_reports_orphans(vhost_gen, vg, sites, conf_files):
+    files = conf_files()
+    response = vhost_gen.gc_request(vg.inventory)
+    assert response["ok"]
+    assert response["checked"] == 3
+    assert [(orphan["name"], orphan["status"]) for orphan in response["orphans"]] \
+        == [("gone.com", None), ("single.com", None)]
+    assert conf_files() == files
+
+
+def test_gc_remove(vhost_gen, vg, sites, conf_files):
+    response = vhost_gen.gc_request(vg.inventory, "remove")
+    assert [(orphan["name"], orphan["status"], orphan["error"])
+            for orphan in response["orphans"]] == \
+        [("gone.com", vhost_gen.STATUS_REMOVED, None),
+         ("single.com", vhost_gen.STATUS_REMOVED, None)]
+    assert conf_files() == [os.path.basename(sites)]
+    assert sorted(vhost_gen.read_bundle(sites)[1]) == ["kept.com"]
+    assert [entry["name"] for entry in vg.inventory.entries()[1]] == ["kept.com"]
+    assert vhost_gen.gc_request(vg.inventory, "remove")["orphans"] == []
+
+
+def test_gc_disable(vhost_gen, vg, sites, conf_files):
+    response = vhost_gen.gc_request(vg.inventory, "disable")
+    assert [orphan["status"] for orphan in response["orphans"]] == \
+        [vhost_gen.STATUS_DISABLED, vhost_gen.STATUS_DISABLED]
+    assert sorted(vhost_gen.read_bundle(sites)[1]) == ["kept.com"]
+    assert sorted(vhost_gen.read_bundle(sites + vhost_gen.DISABLED_SUFFIX)[1]) \
+        == ["gone.com"]
+    assert os.path.exists(vg.path("single.com") + vhost_gen.DISABLED_SUFFIX)
+    # Disabled vhosts are not checked again, but stay in the inventory
+    assert vhost_gen.gc_request(vg.inventory)["checked"] == 1
+    assert len(vg.inventory.entries()[1]) == 3
+
+
+def test_gc_backends(vhost_gen):
+    listening = socket.socket()
+    listening.bind(("127.0.0.1", 0))
+    listening.listen(1)
+    closed = socket.socket()
+    closed.bind(("127.0.0.1", 0))
+    try:
+        entries = [{"name": name, "spec": {"docroot": None,
+                                           "proxy": "http://127.0.0.1:%d" % (port)}}
+                   for name, port in (("up.com", listening.getsockname()[1]),
+                                      ("down.com", closed.getsockname()[1]))]
+        orphans = vhost_gen.find_orphans(entries, timeout=1.0)
+    finally:
+        listening.close()
+        closed.close()
+    assert [entry["name"] for entry, _ in orphans] == ["down.com"]
+    assert orphans[0][1].startswith("backend unreachable")
+
+
+@pytest.mark.parametrize("action", ["remove", "disable"])
+def test_gc_rewrites_each_bundle_once(vhost_gen, vg, tmp_path, monkeypatch, action):
+    for i in range(5):
+        vg.save({"name": "v%d.com" % (i), "docroot": str(tmp_path / "gone")},
+                bundle=1)
+    path = vhost_gen.get_bundle_path(vg.config, "v0.com", 1)
+    write_bundle = vhost_gen.write_bundle
+    writes = []
+
+    def counting_write_bundle(path, *args):
+        writes.append(os.path.basename(path))
+        return write_bundle(path, *args)
+
+    monkeypatch.setattr(vhost_gen, "write_bundle", counting_write_bundle)
+    response = vhost_gen.gc_request(vg.inventory, action)
+    assert [orphan["error"] for orphan in response["orphans"]] == [None] * 5
+    if action == "remove":
+        assert writes == [os.path.basename(path)]
+        assert not os.path.exists(path)
+        assert vg.inventory.entries()[1] == []
+    else:
+        assert sorted(writes) == sorted([os.path.basename(path),
+                                         os.path.basename(path)
+                                         + vhost_gen.DISABLED_SUFFIX])
+        assert len(vhost_gen.read_bundle(path + vhost_gen.DISABLED_SUFFIX)[1]) == 5
@@ -0,0 +1,23 @@
+"""The inventory: entries follow their vhosts, failed updates lose no files."""
+
+import os
+
+
+def test_move_into_bundle(vhost_gen, vg, conf_files):
+    vg.save({"name": "a.com", "docroot": "/data/a"})
+    status, path = vg.save({"name": "a.com", "docroot": "/data/a"}, bundle=1)
+    assert status == vhost_gen.STATUS_CREATED
+    assert conf_files() == [os.path.basename(path)]
+    assert vg.inventory.entry("a.com")[1]["path"] == path
+
+
+def test_failed_record_keeps_previous_file(vhost_gen, vg, conf_files):
+    vg.save({"name": "a.com", "docroot": "/data/a"})
+    vg.inventory.run(lambda db: db.execute(
+        "CREATE TRIGGER fail BEFORE INSERT ON vhosts"
+        " BEGIN SELECT RAISE(ABORT, 'disk full'); END"))
+
+    status, path = vg.save({"name": "a.com", "docroot": "/data/a"}, bundle=1)
+    # The entry still points at the old file, which must still be there
+    assert vg.inventory.entry("a.com")[1]["path"] == vg.path("a.com")
+    assert conf_files() == ["a.com.conf", os.path.basename(path)]
@@ -0,0 +1,45 @@
+"""The library API: load() errors and the immutable loaded config."""
+
+import os
+import pickle
+
+import pytest
+
+
+def test_config_is_frozen(vhost_gen, vg):
+    with pytest.raises(TypeError):
+        vg.config["conf_dir"] = "/tmp"
+    with pytest.raises(TypeError):
+        vg.config["vhost"]["log"].update(dir={})
+    with pytest.raises(AttributeError):
+        vg.config["vhost"]["index"].append("index.cgi")
+    with pytest.raises(AttributeError):
+        vg.inventory = None
+    assert pickle.loads(pickle.dumps(vg.config)) == vg.config
+
+
+def test_missing_config_is_an_error(vhost_gen, tmp_path):
+    with pytest.raises(vhost_gen.ConfigError):
+        vhost_gen.load(str(tmp_path / "missing.yml"), str(tmp_path), cache_dir=None)
+
+
+def test_cache_key(vhost_gen, tmp_path, monkeypatch):
+    script = tmp_path / "vhost-gen.py"
+    script.write_text("# vhost-gen\n")
+    source = tmp_path / "conf.yml"
+    source.write_text("server: nginx\n")
+    monkeypatch.setattr(vhost_gen, "__file__", str(script))
+    key = vhost_gen.cache_key([str(source)])
+    assert key == vhost_gen.cache_key([str(source)])
+
+    # The program is keyed by its stat only, the sources by their content too
+    os.utime(str(script), ns=(0, 0))
+    assert vhost_gen.cache_key([str(source)]) != key
+    os.utime(str(source), ns=(0, 0))
+    key = vhost_gen.cache_key([str(source)])
+    assert len(key[1]) == 3
+    # Same mtime and size
+    source.write_text("server: httpd\n")
+    os.utime(str(source), ns=(0, 0))
+    assert vhost_gen.cache_key([str(source)]) != key
+    assert vhost_gen.cache_key([str(tmp_path / "missing.yml")]) is None
@@ -0,0 +1,11 @@
+"""Validating vhost specs (manifest entries)."""
+
+import pytest
+
+
+def test_save_rejects_invalid_specs(vhost_gen, vg, conf_files):
+    with pytest.raises(vhost_gen.ArgumentError):
+        vg.save({"name": "a.com", "docroot": "/data/a", "default": "false"})
+    with pytest.raises(vhost_gen.ArgumentError):
+        vg.save({"name": "a.com"})
+    assert conf_files() == []
@@ -0,0 +1,65 @@
+"""The mass hosting file: map entries are added and removed, the server block stays."""
+
+
+SPECS = [{"name": "v%d.com" % (i), "docroot": "/data/v%d" % (i)} for i in range(2)]
+
+
+def test_mass_rewrites(vhost_gen, vg, conf_files):
+    mass = vhost_gen.get_mass_path(vg.config)
+    assert vg.save(SPECS[0], mass=True) == (vhost_gen.STATUS_CREATED, mass)
+    assert vg.save(SPECS[1], mass=True) == (vhost_gen.STATUS_CREATED, mass)
+    # Proxies are not mass hosted
+    proxy = {"name": "p.com", "proxy": "http://backend:8080",
+             "location": "/"}
+    assert vg.save(proxy, mass=True) == (vhost_gen.STATUS_CREATED, vg.path("p.com"))
+    assert conf_files() == ["p.com.conf", "vhost-gen.mass.conf"]
+
+    head, sections, tail = vhost_gen.read_bundle_parts(mass)[1]
+    assert sorted(sections) == ["v0.com", "v1.com"]
+    assert "/data/v0" in sections["v0.com"]
+    assert "map " in head
+    assert "server_name" in tail
+
+    assert vg.save(SPECS[0], mass=True) == (vhost_gen.STATUS_UNCHANGED, mass)
+    assert vhost_gen.read_bundle_parts(mass)[1] == (head, sections, tail)
+
+    # Saving without mass moves the vhost out of the map again
+    assert vg.save(SPECS[0]) == (vhost_gen.STATUS_CREATED, vg.path("v0.com"))
+    assert vhost_gen.read_bundle_parts(mass)[1] == \
+        (head, {"v1.com": sections["v1.com"]}, tail)
+    assert vg.inventory.entry("v0.com")[1]["path"] == vg.path("v0.com")
+
+    assert vg.inventory.remove("v1.com")[0]
+    # The server block stays, without map entries
+    assert vhost_gen.read_bundle_parts(mass)[1] == (head, {}, tail)
+    assert conf_files() == ["p.com.conf", "v0.com.conf", "vhost-gen.mass.conf"]
+
+
+
+def test_apache_mass_vhosts(vhost_gen, make_vg, conf_files):
+    from conftest import APACHE_TOOL_DIR
+
+    vg = make_vg("apache24", APACHE_TOOL_DIR, mass={"docroot": "/data/wwwroot"})
+    mass = vhost_gen.get_mass_path(vg.config)
+    # Apache finds the document root by the host name
+    spec = {"name": "site.com", "docroot": "/data/wwwroot/site.com"}
+    assert vg.save(spec, mass=True) == (vhost_gen.STATUS_CREATED, mass)
+    other = {"name": "other.com", "docroot": "/data/other"}
+    assert vg.save(other, mass=True) == \
+        (vhost_gen.STATUS_CREATED, vg.path("other.com"))
+    assert sorted(vhost_gen.read_bundle(mass)[1]) == ["site.com"]
+
+
+def test_mass_map_keywords(vhost_gen, vg):
+    mass = vhost_gen.get_mass_path(vg.config)
+    for name in ("default", "include", "hostnames", "volatile", "site.com"):
+        vg.save({"name": name, "docroot": "/data/" + name}, mass=True)
+    head, sections, tail = vhost_gen.read_bundle_parts(mass)[1]
+    assert sections["default"] == '    \\default "/data/default/";\n'
+    assert sections["include"] == '    \\include "/data/include/";\n'
+    assert sections["site.com"] == '    site.com "/data/site.com/";\n'
+    # The only default of the map is the empty document root
+    assert head.count("default") == 1
+    # Hosts missing from the map are not proxied anywhere
+    assert "return 444;" in tail
+    assert "proxy_pass" not in tail
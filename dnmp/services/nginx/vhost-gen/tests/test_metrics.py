@@ -0,0 +1,36 @@
+"""Metrics: every write adds the increments once, the profiler is drained."""
+
+
+def test_metrics_increments(vhost_gen, vg, tmp_path):
+    path = str(tmp_path / "vhost-gen.prom")
+    profiler = vhost_gen.PhaseProfiler(True)
+    for _ in range(3):
+        profiler.add("render", 0.001, 0.001)
+        profiler.count_save(vhost_gen.STATUS_CREATED, "server {}\n")
+        vhost_gen.write_metrics(path, profiler, vg.config)
+        # Written samples are not kept (nor written again)
+        assert profiler.samples == {}
+        assert profiler.observations == {}
+    vhost_gen.write_metrics(path, profiler, vg.config)
+
+    metrics = vhost_gen.read_metrics(path)
+    assert metrics["vhost_gen_vhosts_rendered_total"] == 3
+    assert metrics['vhost_gen_vhosts_saved_total{status="created"}'] == 3
+    assert metrics['vhost_gen_render_seconds_bucket{le="0.001"}'] == 3
+    assert metrics["vhost_gen_render_seconds_count"] == 3
+    assert metrics["vhost_gen_output_bytes_count"] == 3
+
+
+def test_metrics_count_inventory_vhosts(vhost_gen, vg, tmp_path):
+    path = str(tmp_path / "vhost-gen.prom")
+    vhost_gen.write_metrics(path, vhost_gen.PhaseProfiler(True), vg.config)
+    assert vhost_gen.read_metrics(path)["vhost_gen_conf_dir_vhosts"] == 0
+
+    for i in range(4):
+        vg.save({"name": "v%d.com" % (i), "docroot": "/data/v%d" % (i)}, bundle=1)
+    vg.save({"name": "m.com", "docroot": "/data/m"}, mass=True)
+    vg.save({"name": "p.com", "docroot": "/data/p"})
+    vg.inventory.set_enabled("p.com", False)
+    vhost_gen.write_metrics(path, vhost_gen.PhaseProfiler(True), vg.config)
+    # Two files hold five enabled vhosts
+    assert vhost_gen.read_metrics(path)["vhost_gen_conf_dir_vhosts"] == 5
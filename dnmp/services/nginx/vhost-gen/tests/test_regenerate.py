@@ -0,0 +1,80 @@
+"""Regeneration: changed dependencies re-render, moves leave no stale copies."""
+
+import os
+
+
+SPECS = [{"name": "v%d.com" % (i), "docroot": "/data/v%d" % (i)} for i in range(3)]
+
+
+def statuses(vhost_gen, results):
+    return dict((result["name"], result["status"]) for result in results
+                if result["name"] != vhost_gen.MASS_NAME)
+
+
+def test_regenerate_changed_config(vhost_gen, vg, make_vg):
+    for spec in SPECS:
+        vg.save(spec)
+    assert set(statuses(vhost_gen, vg.regenerate()).values()) == \
+        {vhost_gen.STATUS_SKIPPED}
+
+    # The mass hosting settings are part of the config digest
+    changed = make_vg(mass={"docroot": "/srv"})
+    assert set(statuses(vhost_gen, changed.regenerate()).values()) == \
+        {vhost_gen.STATUS_UNCHANGED}
+    assert set(statuses(vhost_gen, changed.regenerate()).values()) == \
+        {vhost_gen.STATUS_SKIPPED}
+
+
+def test_dependencies(vhost_gen, vg, monkeypatch):
+    spec = vg.context(SPECS[0]).spec()
+    digests = vg.fragments.dependencies(spec)
+    # A staged config renders for the live conf_dir
+    staged = vhost_gen.FragmentCache(
+        dict(vg.config, conf_dir="/tmp/stage", live_conf_dir=vg.config["conf_dir"]),
+        vg.template)
+    assert staged.dependencies(spec) == digests
+    moved = vhost_gen.FragmentCache(dict(vg.config, conf_dir="/tmp/other"),
+                                    vg.template)
+    assert moved.dependencies(spec)[0] != digests[0]
+    # So does a new version of the renderer
+    monkeypatch.setattr(vhost_gen, "RENDER_VERSION", vhost_gen.RENDER_VERSION + 1)
+    assert vhost_gen.FragmentCache(vg.config, vg.template).dependencies(spec)[0] \
+        != digests[0]
+
+
+def test_regenerate_moves(vhost_gen, vg, conf_files):
+    for spec in SPECS:
+        vg.save(spec)
+    proxy = {"name": "p.com", "proxy": "http://backend:8080", "location": "/"}
+    vg.save(proxy)
+    assert vg.inventory.set_enabled("v2.com", False)[0]
+
+    def paths():
+        return dict((entry["name"], vg.inventory.local_path(entry["path"]))
+                    for entry in vg.inventory.entries()[1])
+
+    # Into bundles: every file is replaced by its section
+    vg.regenerate(bundle=1)
+    bundle = vhost_gen.get_bundle_path(vg.config, "v0.com", 1)
+    disabled = bundle + vhost_gen.DISABLED_SUFFIX
+    assert conf_files() == sorted([os.path.basename(bundle),
+                                   os.path.basename(disabled)])
+    assert sorted(vhost_gen.read_bundle(bundle)[1]) == ["p.com", "v0.com", "v1.com"]
+    assert sorted(vhost_gen.read_bundle(disabled)[1]) == ["v2.com"]
+    assert set(paths().values()) == {bundle}
+
+    # Into the mass hosting file: only the proxy stays in the bundle
+    vg.regenerate(mass=True)
+    mass = vhost_gen.get_mass_path(vg.config)
+    assert sorted(vhost_gen.read_bundle(mass)[1]) == ["v0.com", "v1.com"]
+    assert sorted(vhost_gen.read_bundle(mass + vhost_gen.DISABLED_SUFFIX)[1]) \
+        == ["v2.com"]
+    assert sorted(vhost_gen.read_bundle(bundle)[1]) == ["p.com"]
+    assert not os.path.exists(disabled)
+    assert paths() == {"p.com": bundle, "v0.com": mass, "v1.com": mass,
+                       "v2.com": mass}
+
+    # Nothing moves without bundle or mass
+    assert set(statuses(vhost_gen, vg.regenerate()).values()) == \
+        {vhost_gen.STATUS_SKIPPED}
+    assert paths()["p.com"] == bundle
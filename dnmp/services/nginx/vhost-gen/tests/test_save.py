@@ -0,0 +1,41 @@
+"""Saving single vhosts: a vhost is only rewritten when its content changed."""
+
+import os
+
+
+def test_save_statuses(vhost_gen, vg):
+    spec = {"name": "a.com", "docroot": "/data/a"}
+    status, path = vg.save(spec)
+    assert status == vhost_gen.STATUS_CREATED
+    assert path == os.path.join(vg.config["conf_dir"], "a.com.conf")
+    mtime = os.stat(path).st_mtime_ns
+
+    assert vg.save(spec) == (vhost_gen.STATUS_UNCHANGED, path)
+    assert os.stat(path).st_mtime_ns == mtime
+
+    status, _ = vg.save(dict(spec, docroot="/data/b"))
+    assert status == vhost_gen.STATUS_UPDATED
+    with open(path) as fp:
+        assert "/data/b" in fp.read()
+
+    succ, entry, _ = vg.inventory.entry("a.com")
+    assert succ
+    assert entry["path"] == path
+    assert entry["spec"]["docroot"] == "/data/b"
+
+
+def test_symlink_replace_error(vhost_gen, tmp_path, monkeypatch):
+    dst = str(tmp_path / "link")
+    assert vhost_gen.symlink("/dev/stdout", dst, force=True) == (True, None)
+
+    def replace(src, dst):
+        # The temporary link vanished before the rename failed
+        os.remove(src)
+        raise OSError(16, "Device or resource busy")
+
+    monkeypatch.setattr(vhost_gen.os, "replace", replace)
+    succ, err = vhost_gen.symlink("/dev/stderr", dst, force=True)
+    assert not succ
+    assert err.startswith("[ERR] Cannot replace: " + dst)
+    assert os.readlink(dst) == "/dev/stdout"
+    assert os.listdir(str(tmp_path)) == ["link"]
@@ -0,0 +1,71 @@
+"""Paired saves (--stack): either both vhosts are written or neither is."""
+
+import os
+
+
+def pair(tmp_path):
+    saves = []
+    for side in ("backend", "front"):
+        conf_dir = tmp_path / side
+        conf_dir.mkdir()
+        saves.append(({"conf_dir": str(conf_dir)}, "a.com", side + " a.com\n"))
+    return saves
+
+
+def listdir(vhost_gen, tmp_path):
+    """Get the files of both conf_dirs, temporary files included."""
+    return sorted(os.path.relpath(os.path.join(root, name), str(tmp_path))
+                  for side in ("backend", "front")
+                  for root, _, names in os.walk(str(tmp_path / side))
+                  for name in names if name != vhost_gen.LOCK_FILE)
+
+
+def test_pair_statuses(vhost_gen, tmp_path):
+    saves = pair(tmp_path)
+    assert vhost_gen.save_vhost_pair(saves) == \
+        (True, [vhost_gen.STATUS_CREATED] * 2, "")
+    assert vhost_gen.save_vhost_pair(saves) == \
+        (True, [vhost_gen.STATUS_UNCHANGED] * 2, "")
+    saves[1] = (saves[1][0], "a.com", "front a.com, updated\n")
+    assert vhost_gen.save_vhost_pair(saves) == \
+        (True, [vhost_gen.STATUS_UNCHANGED, vhost_gen.STATUS_UPDATED], "")
+
+
+def test_pair_rollback(vhost_gen, tmp_path):
+    saves = pair(tmp_path)
+    vhost_gen.save_vhost_pair(saves)
+    saves = [(config, name, vhost + "# new\n") for config, name, vhost in saves]
+    saves.append(({"conf_dir": saves[0][0]["conf_dir"]}, "b.com", "backend b.com\n"))
+    # The front vhost cannot be replaced
+    os.remove(str(tmp_path / "front" / "a.com.conf"))
+    os.mkdir(str(tmp_path / "front" / "a.com.conf"))
+
+    succ, statuses, err = vhost_gen.save_vhost_pair(saves)
+    assert not succ
+    assert err.startswith("[ERR] Cannot write vhost:")
+    assert "rollback failed" not in err
+    # The backend vhost renamed before is restored, b.com removed again
+    assert listdir(vhost_gen, tmp_path) == ["backend/a.com.conf"]
+    with open(str(tmp_path / "backend" / "a.com.conf")) as fp:
+        assert fp.read() == "backend a.com\n"
+
+
+def test_pair_rollback_of_missing_file(vhost_gen, tmp_path, monkeypatch):
+    saves = pair(tmp_path)
+    replace = os.replace
+    replaced = []
+
+    def failing_replace(src, dst):
+        if replaced:
+            # The first vhost is gone before the rollback gets to it
+            os.remove(replaced[0])
+            raise OSError(28, "No space left on device")
+        replace(src, dst)
+        replaced.append(dst)
+
+    monkeypatch.setattr(vhost_gen.os, "replace", failing_replace)
+    succ, _, err = vhost_gen.save_vhost_pair(saves)
+    monkeypatch.undo()
+    assert not succ
+    assert err == "[ERR] Cannot write vhost: [Errno 28] No space left on device"
+    assert listdir(vhost_gen, tmp_path) == []
@@ -0,0 +1,84 @@
+"""Staged batches: commit and abort must not lose vhosts saved meanwhile."""
+
+import os
+
+
+def inventory_names(vg):
+    succ, entries, err = vg.inventory.entries()
+    assert succ, err
+    return [entry["name"] for entry in entries]
+
+
+def test_commit(vhost_gen, vg, conf_files):
+    vg.save({"name": "a.com", "docroot": "/data/a"})
+    vg.save({"name": "b.com", "docroot": "/data/b"})
+    stage = vhost_gen.StagedConfDir(vg.config)
+    assert stage.open()[0]
+    staged = vhost_gen.VhostGen(stage.config, vg.template)
+
+    staged.save({"name": "a.com", "docroot": "/data/a2"}, log_settings=False)
+    staged.save({"name": "c.com", "docroot": "/data/c"}, log_settings=False)
+    assert staged.inventory.remove("b.com")[0]
+    # Nothing is live before the commit
+    assert conf_files() == ["a.com.conf", "b.com.conf"]
+    # A single save does not wait for the staged batch
+    vg.save({"name": "race.com", "docroot": "/data/race"}, log_settings=False)
+
+    succ, changed, err = stage.commit()
+    assert succ, err
+    assert changed == 3
+    assert conf_files() == ["a.com.conf", "c.com.conf", "race.com.conf"]
+    with open(vg.path("a.com")) as fp:
+        assert "/data/a2" in fp.read()
+    assert inventory_names(vg) == ["a.com", "c.com", "race.com"]
+    assert [name for name in os.listdir(vg.config["conf_dir"])
+            if name.startswith(vhost_gen.STAGE_PREFIX)] == []
+
+
+def test_abort(vhost_gen, vg, conf_files):
+    vg.save({"name": "a.com", "docroot": "/data/a"})
+    vg.save({"name": "b.com", "docroot": "/data/b"})
+    with open(vg.path("a.com")) as fp:
+        live = fp.read()
+    stage = vhost_gen.StagedConfDir(vg.config)
+    assert stage.open()[0]
+    staged = vhost_gen.VhostGen(stage.config, vg.template)
+
+    staged.save({"name": "a.com", "docroot": "/data/a2"}, log_settings=False)
+    staged.save({"name": "c.com", "docroot": "/data/c"}, log_settings=False)
+    assert staged.inventory.remove("b.com")[0]
+    vg.save({"name": "race.com", "docroot": "/data/race"}, log_settings=False)
+
+    stage.abort()
+    assert conf_files() == ["a.com.conf", "b.com.conf", "race.com.conf"]
+    with open(vg.path("a.com")) as fp:
+        assert fp.read() == live
+    # Only the entries the batch changed are restored
+    assert inventory_names(vg) == ["a.com", "b.com", "race.com"]
+    succ, entry, _ = vg.inventory.entry("a.com")
+    assert entry["spec"]["docroot"] == "/data/a"
+    assert [name for name in os.listdir(vg.config["conf_dir"])
+            if name.startswith(vhost_gen.STAGE_PREFIX)] == []
+
+
+
+def test_commit_keeps_files_updated_meanwhile(vhost_gen, vg, conf_files):
+    vg.save({"name": "a.com", "docroot": "/data/a"})
+    vg.save({"name": "b.com", "docroot": "/data/b"})
+    stage = vhost_gen.StagedConfDir(vg.config)
+    assert stage.open()[0]
+    staged = vhost_gen.VhostGen(stage.config, vg.template)
+
+    staged.save({"name": "a.com", "docroot": "/data/a2"}, log_settings=False)
+    # The batch never touches b.com, a single save updates it
+    assert vg.save({"name": "b.com", "docroot": "/data/b2"},
+                   log_settings=False)[0] == vhost_gen.STATUS_UPDATED
+
+    succ, changed, err = stage.commit()
+    assert succ, err
+    assert changed == 1
+    with open(vg.path("b.com")) as fp:
+        assert "/data/b2" in fp.read()
+    with open(vg.path("a.com")) as fp:
+        assert "/data/a2" in fp.read()
+    assert vg.inventory.entry("b.com")[1]["spec"]["docroot"] == "/data/b2"
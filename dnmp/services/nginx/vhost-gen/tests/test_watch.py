@@ -0,0 +1,67 @@
+"""Watch mode: site directories are added and removed, stored specs are kept."""
+
+import os
+
+import pytest
+
+from conftest import TOOL_DIR
+
+
+@pytest.fixture
+def www(tmp_path):
+    path = tmp_path / "www"
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def daemon(vhost_gen, vg, www, tmp_path):
+    args = vhost_gen.parse_args(["-c", str(tmp_path / "conf.yml"), "-t", TOOL_DIR,
+                                 "--no-cache", "--watch", str(www)])
+    daemon = vhost_gen.VhostDaemon(args)
+    assert daemon.load()[0]
+    yield daemon
+    daemon.inventory.close()
+
+
+def test_watch_create_and_remove(vhost_gen, vg, daemon, www, conf_files):
+    (www / "a.com").mkdir()
+    (www / "b.com").mkdir()
+    (www / ".hidden").mkdir()
+    vhost_gen.watch_sync_all(daemon, daemon.args)
+    assert conf_files() == ["a.com.conf", "b.com.conf"]
+    assert vg.inventory.entry("a.com")[1]["spec"]["docroot"] == str(www / "a.com")
+
+    # Removed while not watching
+    (www / "a.com").rmdir()
+    vhost_gen.watch_sync_all(daemon, daemon.args)
+    assert conf_files() == ["b.com.conf"]
+    assert [entry["name"] for entry in vg.inventory.entries()[1]] == ["b.com"]
+
+
+def test_watch_keeps_stored_spec(vhost_gen, vg, daemon, www, conf_files):
+    (www / "a.com").mkdir()
+    status, path = vg.save({"name": "a.com", "docroot": str(www / "a.com"),
+                            "mode": "ssl"})
+    with open(path) as fp:
+        content = fp.read()
+    vhost_gen.watch_sync_all(daemon, daemon.args)
+    with open(path) as fp:
+        assert fp.read() == content
+    assert vg.inventory.entry("a.com")[1]["spec"]["mode"] == "ssl"
+
+
+def test_watch_leaves_other_vhosts_alone(vhost_gen, vg, daemon, www, conf_files):
+    (www / "a.com").mkdir()
+    (www / "b.com").mkdir()
+    vg.save({"name": "a.com", "docroot": "/data/elsewhere"})
+    vg.save({"name": "b.com", "docroot": str(www / "b.com")})
+    assert vg.inventory.set_enabled("b.com", False)[0]
+    vhost_gen.watch_sync_all(daemon, daemon.args)
+    assert vg.inventory.entry("a.com")[1]["spec"]["docroot"] == "/data/elsewhere"
+    assert conf_files() == ["a.com.conf", "b.com.conf.disabled"]
+
+    # The vhost of a deleted directory is removed, even when disabled
+    (www / "b.com").rmdir()
+    vhost_gen.watch_sync_all(daemon, daemon.args)
+    assert conf_files() == ["a.com.conf"]
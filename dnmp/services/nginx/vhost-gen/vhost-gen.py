@@ -7,6 +7,17 @@
 
 """
 vHost creator for Apache 2.2, Apache 2.4 and Nginx.
+
+Besides the command line tool, this file can be imported as a module
+(the Docker images install it as vhost_gen) to render vhosts in-process:
+
+    import vhost_gen
+
+    vg = vhost_gen.load("/etc/vhost-gen/conf.yml", "/etc/vhost-gen/templates")
+    vg.render({"name": "a.com", "docroot": "/data/wwwroot/a.com"})
+    vg.save({"name": "b.com", "proxy": "http://apache:80", "location": "/"})
+
+Errors are raised as VhostGenError subclasses.
 """
 
 ############################################################
@@ -15,14 +26,13 @@ vHost creator for Apache 2.2, Apache 2.4 and Nginx.
 
 from __future__ import print_function
 
-import getopt
-import itertools
+# Only cheap builtin modules are imported here. Everything else is imported
+# by the functions needing it, so that --help, --version, argument validation
+# and --connect start as fast as possible (see startup-check.py).
+import errno
+import marshal
 import os
-import re
 import sys
-import time
-
-import yaml
 
 ############################################################
 # Globals
@@ -32,6 +42,98 @@ import yaml
 CONFIG_PATH = "/etc/vhost-gen/conf.yml"
 TEMPLATE_DIR = "/etc/vhost-gen/templates"
 
+# Stack mode (--stack): config and template of the backend (Apache) vhosts,
+# rendered together with the front (Nginx) reverse proxy vhosts
+STACK_CONFIG_PATH = "/etc/vhost-gen/stack/conf.yml"
+STACK_TEMPLATE_DIR = "/etc/vhost-gen/stack/templates"
+
+# Cache of parsed and compiled config/templates, can be overwritten with
+# --cache-dir or the VHOST_GEN_CACHE_DIR environment variable
+CACHE_DIR = os.environ.get("VHOST_GEN_CACHE_DIR", "/var/cache/vhost-gen")
+CACHE_VERSION = 1
+
+# Version of the rendered output, part of the inventory digests (see
+# vhost_dependencies()): bump it whenever vhost-gen renders the same config
+# and templates differently, so --regenerate renders every vhost again
+RENDER_VERSION = 1
+
+# Seconds a daemon client connection may stay idle
+DAEMON_TIMEOUT = 30
+
+# Watch mode: seconds to wait for more events before rendering a batch
+# of changes, and the directory scan interval without inotify
+WATCH_DEBOUNCE = 0.5
+WATCH_POLL_INTERVAL = 2.0
+
+# Advisory lock file inside conf_dir
+LOCK_FILE = ".vhost-gen.lock"
+
+# Inventory of all saved vhosts inside conf_dir, and the suffix disabled
+# vhosts are renamed to (so the server does not include them any more)
+INVENTORY_FILE = ".vhost-gen.sqlite"
+DISABLED_SUFFIX = ".disabled"
+
+# Bundle mode (--bundle): vhosts are saved as marked sections of a few
+# conf_dir/vhost-gen.bundle-<shard>.conf files instead of one file each
+BUNDLE_PREFIX = "vhost-gen.bundle-"
+BUNDLE_BEGIN = "# vhost-gen begin "
+BUNDLE_END = "# vhost-gen end "
+# A file with this line has its sections after it, with fixed content before
+# it and after the sections (e.g. the mass hosting file)
+BUNDLE_SECTIONS = "# vhost-gen sections\n"
+
+# Mass hosting (--mass): plain vhosts are saved as sections of the map from
+# host names to document roots in conf_dir/vhost-gen.mass.conf, which also
+# has the single server block serving all of them (per server type: the map
+# around the sections, an entry of it, the server name and document root of
+# the server block and its directive answering hosts not in the map)
+MASS_NAME = "vhost-gen.mass"
+# Nginx looks the document root of a host up in a map in front of the
+# server block, apache serves <vhost.mass.docroot>/<host> (mod_vhost_alias)
+# for the ServerAlias entries inside the VirtualHost. Map keys which are
+# map parameters are escaped with a backslash. The nginx server block
+# matches every host name, but closes the connection (444) for hosts
+# missing from the map; apache answers them with the default server.
+MASS = {
+    "nginx": {
+        "map": ('map $host $vhost_docroot {\n    default "";\n', "}\n"),
+        "entry": '    %(name)s "%(docroot)s";\n',
+        "keywords": ("default", "hostnames", "include", "volatile"),
+        "server_name": "~^.+$",
+        "docroot": "$vhost_docroot",
+        "directives": (
+            'if ($vhost_docroot = "") {\n'
+            '    return 444;\n'
+            '}\n'
+        ),
+    },
+    "apache24": {
+        "map": None,
+        "entry": "    ServerAlias %(name)s\n",
+        "keywords": (),
+        "server_name": MASS_NAME,
+        "docroot": None,
+        "directives": 'VirtualDocumentRoot "%(docroot)s"\n',
+    },
+}
+
+# Shared snippets (vhost.snippets) are written to this directory inside
+# conf_dir and included with the directive of the server type
+SNIPPET_DIR = "vhost-gen.snippets"
+SNIPPET_INCLUDE = {"apache22": 'Include "%s"', "apache24": 'Include "%s"',
+                   "nginx": "include %s;"}
+
+# Staging directories (--stage) are created inside conf_dir with this prefix,
+# the web server only includes conf_dir/*.conf so it never reads them
+STAGE_PREFIX = ".stage."
+
+# Garbage collection (--gc): number of concurrent document root and backend
+# checks, seconds a backend may take to accept a connection and what can be
+# done with orphaned vhosts
+GC_WORKERS = 32
+GC_TIMEOUT = 3.0
+GC_ACTIONS = ("disable", "remove")
+
 # stdout/stderr log paths
 STDOUT_ACCESS = "/tmp/www-access.log"
 STDERR_ERROR = "/tmp/www-error.log"
@@ -65,13 +167,81 @@ DEFAULT_CONFIG = {
         "alias": [],
         "deny": [],
         "server_status": {"enable": False, "alias": "/server-status"},
+        "snippets": {"enable": False},
+        "mass": {"docroot": "/data/wwwroot"},
     },
 }
 
+# Save status of a vhost (-s), a reload is needed unless all are unchanged
+STATUS_CREATED = "created"
+STATUS_UPDATED = "updated"
+STATUS_UNCHANGED = "unchanged"
+STATUS_REMOVED = "removed"
+STATUS_DISABLED = "disabled"
+STATUS_ENABLED = "enabled"
+STATUS_SKIPPED = "skipped"
+
+# Inventory operations (command line options and daemon ops)
+INVENTORY_OPS = ("list", "show", "remove", "disable", "enable")
+
+# Allowed keys of a single vhost entry in a manifest (-b)
+MANIFEST_KEYS = ("name", "docroot", "proxy", "location", "mode", "default")
+
+# How check_args_req() refers to the vhost arguments in its messages: by
+# their command line options, or by their keys in a vhost spec (manifest
+# entries and the library API)
+ARG_NAMES = {"name": "-n", "docroot": "-p", "proxy": "-r", "location": "-l",
+             "mode": "-m mode string"}
+SPEC_NAMES = {"name": "name", "docroot": "docroot", "proxy": "proxy",
+              "location": "location", "mode": "mode"}
+
 # Available templates
 TEMPLATES = {"apache22": "apache22.yml", "apache24": "apache24.yml",
              "nginx": "nginx.yml"}
 
+# Template sections and the placeholders each of them may contain
+TEMPLATE_PLACEHOLDERS = {
+    ("vhost",): (
+        "__PORT__", "__HTTP_PROTO__", "__DEFAULT_VHOST__", "__DOCUMENT_ROOT__",
+        "__VHOST_NAME__", "__VHOST_DOCROOT__", "__VHOST_RPROXY__",
+        "__REDIRECT__", "__SSL__", "__INDEX__", "__ACCESS_LOG__",
+        "__ERROR_LOG__", "__PHP_FPM__", "__ALIASES__", "__DENIES__",
+        "__SERVER_STATUS__", "__CUSTOM__",
+    ),
+    ("vhost_type", "docroot"): ("__DOCUMENT_ROOT__", "__INDEX__"),
+    ("vhost_type", "rproxy"): (
+        "__LOCATION__", "__PROXY_PROTO__", "__PROXY_ADDR__", "__PROXY_PORT__",
+    ),
+    ("features", "ssl"): (
+        "__SSL_PATH_CRT__", "__SSL_PATH_KEY__", "__SSL_PROTOCOLS__",
+        "__SSL_HONOR_CIPHER_ORDER__", "__SSL_CIPHERS__",
+    ),
+    ("features", "redirect"): ("__VHOST_NAME__", "__SSL_PORT__"),
+    ("features", "php_fpm"): (
+        "__PHP_ADDR__", "__PHP_PORT__", "__PHP_TIMEOUT__", "__DOCUMENT_ROOT__",
+    ),
+    ("features", "alias"): ("__ALIAS__", "__PATH__", "__XDOMAIN_REQ__"),
+    ("features", "deny"): ("__REGEX__",),
+    ("features", "server_status"): ("__REGEX__",),
+    ("features", "xdomain_request"): ("__REGEX__",),
+}
+
+# Regex: __PLACEHOLDER__
+PLACEHOLDER_REGEX = "__[A-Z0-9]+(?:_[A-Z0-9]+)*__"
+
+# Regex: HOSTNAME/IP:PORT
+PROXY_REGEX = "(?i)(^http(s)?://[-_.a-zA-Z0-9]+:[0-9]+$)"
+
+# Regex: vhost name
+NAME_REGEX = "(?i)(^[-_.a-zA-Z0-9]+$)"
+
+# Regex: file name of a bundle or the mass hosting file (or a disabled one),
+# no vhost may be named like them
+BUNDLE_REGEX = "^vhost-gen\\.(bundle-[0-9]+|mass)\\.conf(\\.disabled)?$"
+
+# Compiled regexes by pattern, see get_regex()
+REGEX_CACHE = dict()
+
 
 ############################################################
 # System Functions
@@ -83,6 +253,23 @@ def print_help():
     print(
         """
     Usage: vhost-gen -p|r <str> -n <str> [-l <str> -c <str> -t <str> -o <str> -d -s -v]
+       vhost-gen -b <str> [-c <str> -t <str> -o <str> -s -v --jobs <int>]
+       vhost-gen --ndjson [-b <str> -c <str> -t <str> -o <str> -s -v]
+       vhost-gen --list|--show <str>|--remove <str>|--disable <str>|--enable <str>
+                 [-c <str>]
+       vhost-gen --regenerate [-c <str> -t <str> -o <str>]
+       vhost-gen -b <str> -s|--regenerate --stage [--check-cmd <str> --reload-cmd <str>]
+       vhost-gen -n <str> -s|-b <str> -s|--regenerate --bundle <int> ...
+       vhost-gen -n <str> -s|-b <str> -s|--regenerate --mass ...
+       vhost-gen --gc [--gc-action <str> --reload-cmd <str> -c <str>]
+       vhost-gen --stack <str> -p <str> -n <str> [-m <str> -c <str> -t <str> -d -s]
+                 [--stack-config <str> --stack-tpl <str>]
+       vhost-gen --serve <str> [-c <str> -t <str> -o <str> -v]
+       vhost-gen --connect <str> -p|r <str> -n <str> [-l <str> -m <str> -d -s]
+       vhost-gen --watch <str> [-m <str> -c <str> -t <str> -o <str> -v]
+                 [--reload-cmd <str> --poll]
+       vhost-gen ... --profile [--profile-out <str>]
+       vhost-gen ... --metrics <str>
        vhost-gen --help
        vhost-gen --version
 
@@ -128,12 +315,189 @@ def print_help():
               Apache does not have any specialities, the first vhost takes precedence.
     -s          If specified, the generated vhost will be saved in the location found in
               conf.yml. If not specified, vhost will be printed to stdout.
+              The file is only written if its content changed and the save status
+              is printed as '<created|updated|unchanged> <path>'. In batch mode a
+              final 'reload: <yes|no>' line tells if the server needs a reload.
     -v          Be verbose.
 
+    Cache arguments:
+    --cache-dir <str>
+                Directory to cache the parsed and compiled config and templates in.
+              The cache is only invalidated when one of the source files changes.
+              If not set, the default location is /var/cache/vhost-gen
+    --no-cache  Always parse config and templates from their YAML files.
+
+    Batch arguments:
+    -b <str>    Path to a manifest file (YAML or JSON) holding a list of vhosts to
+              generate in one run. Use '-' to read the manifest from stdin.
+              Each entry is a mapping with the keys: name, docroot or proxy,
+              location, mode and default (same meaning as -n, -p, -r, -l, -m, -d).
+              The list can also be nested under a top-level 'vhosts' key.
+              Config and template are loaded once, every entry is validated up
+              front and a per-entry summary is printed at the end.
+    --ndjson    Stream the manifest instead of loading it: read one vhost entry
+              (a JSON object with the keys above) per line from stdin (or from
+              the -b file), render it and save it (-s) or write it to stdout
+              immediately, and print one JSON result line per entry:
+                {"line": 1, "name": ..., "ok": true, "status": ..., "path": ...}
+                {"line": 2, "name": ..., "ok": true, "vhost": ...}
+                {"line": 3, "name": ..., "ok": false, "error": ...}
+              Memory stays flat however many entries are streamed, so names are
+              not checked for duplicates. The summary goes to stderr.
+    --jobs <int>
+                Render (and save) the vhosts of a manifest (-b, --serve and --watch
+              batches) with <int> worker processes, 0 uses one per CPU.
+              Every worker receives the loaded config and template once and
+              renders contiguous shards of the list. The summary keeps the
+              manifest order. Defaults to 1 (no worker processes).
+
+    Daemon arguments:
+    --serve <str>
+                Run as a daemon listening on the given unix socket path.
+              Config and templates are kept loaded (and reloaded when one of
+              their files changes) and render/save requests are accepted as
+              newline delimited JSON:
+                {"op": "render"|"save", "vhost": {"name": ..., "docroot": ...}}
+                {"op": "batch", "manifest": <path>, "save": true|false}
+                {"op": "ping"}
+    --connect <str>
+                Send the vhost given by -n, -p, -r, -l, -m, -d and -s (or the manifest
+              given by -b) to the daemon listening on the given unix socket path
+              instead of generating it in this process. -c, -t and -o are ignored,
+              the daemon uses its own.
+
+    Watch arguments:
+    --watch <str>
+                Watch a document root parent directory (e.g.: /data/wwwroot) and
+              keep one vhost per site directory in it: <dir>/<name> is saved
+              as <name> with document root <dir>/<name> (and mode -m, vhosts
+              already in the inventory keep their mode). Vhosts are added as
+              directories appear and removed as they disappear, also while not
+              watching. Bursts of changes are rendered as one batch.
+              Existing vhosts not pointing to <dir>/<name> are never touched.
+    --reload-cmd <str>
+                Command to reload the web server once after each batch of changes,
+              e.g.: 'nginx -s reload' or 'httpd -k graceful'.
+    --poll      Scan the directory every %d seconds instead of using inotify.
+
+    Inventory arguments:
+                Every saved vhost is recorded in conf_dir/.vhost-gen.sqlite with its
+              arguments, path, content digest, the digests of config and template
+              and the time it was saved. These options use it instead of
+              scanning conf_dir:
+    --list      List all vhosts: name, enabled/disabled, mode, document root or
+              reverse proxy and the time it was saved.
+    --show <str>
+                Show the inventory entry of a vhost as JSON.
+    --remove <str>
+                Remove a vhost (its file and its inventory entry).
+    --disable <str>
+                Disable a vhost by renaming its file to <name>.conf.disabled.
+    --enable <str>
+                Enable a disabled vhost again. Saving a vhost enables it as well.
+    --regenerate
+                Render every vhost of the inventory again from its stored arguments
+              after conf.yml or a template changed. Each vhost is skipped unless
+              a config or template section it is rendered from (e.g. vhost.ssl
+              only for ssl vhosts) changed, and only rewritten if its content
+              changed. Prints the rendered vhosts, a summary and 'reload: <yes|no>'.
+    --gc        Find orphaned vhosts: enabled vhosts whose document root does not
+              exist any more, or whose reverse proxy backend does not resolve or
+              does not accept connections within %.0f seconds. Up to %d document
+              roots and backends are checked concurrently, each distinct one once.
+    --gc-action <str>
+                Like --gc and also 'disable' or 'remove' every orphaned vhost, then
+              run --reload-cmd once if any was. Prints 'reload: <yes|no>'.
+
+    Bundle arguments:
+    --bundle <int>
+                Save vhosts (-s, -b with -s, and every save of --serve and --watch)
+              as sections of <int> bundle files conf_dir/vhost-gen.bundle-<shard>.conf
+              instead of one file each. The shard of a vhost only depends on its
+              name, its section is marked by '# vhost-gen begin <name>' and
+              '# vhost-gen end <name>' lines and saving a vhost only rewrites its
+              own bundle. With --regenerate, every vhost of the inventory is
+              moved into its bundle. Use the same <int> every time, a vhost saved
+              with another one moves to its new bundle. Disabled vhosts go to
+              <bundle>.disabled.
+
+    Mass hosting arguments (nginx, apache24):
+    --mass      Save plain vhosts with a document root (-p, -m plain, no -d) only
+              as an entry of the map from host names to document roots in
+              conf_dir/vhost-gen.mass.conf, which also has the single server
+              block serving every host of the map (with the shared log files
+              of vhost-gen.mass). Adding a vhost only adds its map entry. The
+              server block matches every host name on port 80, only exact server
+              names of other vhosts win, and closes the connection (444) of hosts
+              not in the map. All other vhosts (reverse proxies, ssl, the default
+              vhost) still get their own server blocks. With --regenerate, every plain vhost of the
+              inventory is moved into the map. A vhost saved without --mass
+              moves back to its own file. Also applies to every save of --serve
+              and --watch.
+              Apache has a ServerAlias per host in the single VirtualHost
+              instead, which serves <vhost.mass.docroot>/<host> with
+              mod_vhost_alias. Only vhosts whose document root is exactly that
+              directory are moved into it, unknown hosts get the default vhost.
+
+    Stage arguments:
+    --stage     Save a batch (-b with -s, or --regenerate) into a staging directory
+              inside conf_dir first, holding hard links of all existing vhosts,
+              and only move the vhosts which changed into conf_dir once the
+              whole batch has been rendered (and checked). If it fails, conf_dir
+              and the inventory are left unchanged.
+    --check-cmd <str>
+                Like --stage and validate the staging directory with a command
+              before it goes live, {} is replaced by the staging directory, e.g.:
+              'sh -c "sed s#/etc/nginx/conf.d/#{}/# /etc/nginx/nginx.conf > {}/.n.conf
+              && nginx -t -c {}/.n.conf"' (or 'true' to skip the check).
+    --reload-cmd <str>
+                With -b and --regenerate: run this command (e.g.: 'nginx -s reload'
+              or 'httpd -k graceful') once if any vhost was created or updated.
+
+    Stack arguments:
+    --stack <str>
+                Render a backend vhost (e.g. Apache) serving the document root -p and
+              the front vhost (e.g. Nginx, configured by -c and -t) reverse proxying
+              to it on the given backend host (e.g. apache) in one run, from the
+              same -n, -m and -d. The proxy uses https and the backend ssl_port
+              for modes with an https vhost, else http and the backend port.
+              With -s both vhosts are saved as a pair: if either one cannot be
+              written, neither is changed.
+    --stack-config <str>
+                Path to the backend configuration file.
+              If not set, the default location is %s
+    --stack-tpl <str>
+                Path to the backend vhost template directory.
+              If not set, the default location is %s
+
+    Profile arguments:
+    --profile   Print the wall and CPU time spent in each phase (startup, parse_args,
+              load_config, load_template, render, write, apply_log_settings, ...)
+              to stderr when done. Batch, daemon and watch runs show the
+              percentiles of each phase over all vhosts rendered; daemons print
+              them when stopped (with --metrics, over the vhosts rendered since
+              the metrics file was last written).
+    --profile-out <str>
+                Like --profile and also dump cProfile statistics of the whole run
+              into the given file (readable with pstats or snakeviz).
+
+    Metrics arguments:
+    --metrics <str>
+                Atomically write Prometheus metrics (for the node-exporter textfile
+              collector) to the given file after the run, or after every request
+              or batch of a daemon. Counters and histograms are continued from
+              the existing file (locking its directory, so parallel runs add
+              up): vhosts rendered and saved by status, errors by
+              kind, render and config/template load time and the size of every
+              vhost written. Gauges hold the number of enabled vhosts in the
+              inventory and the size of the vhost files in conf_dir.
+
     Misc arguments:
     --help      Show this help.
     --version   Show version.
     """
+        % (WATCH_POLL_INTERVAL, GC_TIMEOUT, GC_WORKERS, STACK_CONFIG_PATH,
+           STACK_TEMPLATE_DIR)
     )
 
 
@@ -150,14 +514,33 @@ def print_version():
 ############################################################
 
 
-def str_replace(string, replacer):
-    """Generic string replace."""
+def get_regex(pattern):
+    """Compile a regex on first use and only once."""
+    if pattern not in REGEX_CACHE:
+        import re
+
+        REGEX_CACHE[pattern] = re.compile(pattern)
+    return REGEX_CACHE[pattern]
+
+
+def log_time():
+    """Get the current time for log messages."""
+    import time
 
-    # Replace all 'keys' with 'values'
-    for key, val in replacer.items():
-        string = string.replace(key, val)
+    return time.strftime("%Y-%m-%d %H:%M:%S")
 
-    return string
+
+def str_render(compiled, replacer):
+    """
+    Render a compiled template section in a single pass.
+
+    Even indices of the compiled tuple are literal text, odd indices are
+    placeholders which are looked up in replacer.
+    """
+    parts = list(compiled)
+    for i in range(1, len(parts), 2):
+        parts[i] = replacer[parts[i]]
+    return "".join(parts)
 
 
 def str_indent(text, amount, char=" "):
@@ -173,13 +556,35 @@ def to_str(string):
     return str(string)
 
 
+def import_yaml():
+    """
+    Import yaml on first use. It is not needed (and not necessarily
+    installed) when only acting as a client of a vhost-gen daemon.
+    """
+    import yaml
+
+    return yaml
+
+
+def yaml_loader():
+    """Get the safe yaml loader class, the libyaml bindings if available."""
+    yaml = import_yaml()
+    return getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def yaml_safe_load(stream):
+    """Load yaml safely, using the libyaml bindings if available."""
+    return import_yaml().load(stream, Loader=yaml_loader())
+
+
 def load_yaml(path):
     """Wrapper to load yaml file safely."""
+    yaml = import_yaml()
 
     try:
         with open(path, "r") as stream:
             try:
-                data = yaml.safe_load(stream)
+                data = yaml_safe_load(stream)
                 if data is None:
                     data = dict()
                 return (True, data, "")
@@ -191,7 +596,9 @@ def load_yaml(path):
 
 def merge_yaml(yaml1, yaml2):
     """Merge two yaml strings. The secondary takes precedence."""
-    return dict(itertools.chain(yaml1.items(), yaml2.items()))
+    merged = dict(yaml1)
+    merged.update(yaml2)
+    return merged
 
 
 def symlink(src, dst, force=False):
@@ -203,20 +610,177 @@ def symlink(src, dst, force=False):
     if os.path.isdir(dst):
         return (False, "[ERR] destination is a directory: " + dst)
 
-    if force and os.path.exists(dst):
+    if not force:
         try:
-            os.remove(dst)
+            os.symlink(src, dst)
         except OSError as err:
-            return (False, "[ERR] Cannot delete: " + dst + ": " + str(err))
+            return (False, "[ERR] Cannot create link: " + str(err))
+        return (True, None)
 
+    # Create the link next to its destination and rename it over the
+    # destination, so concurrent runs never see a missing link.
+    tmp = "%s.%d.tmp" % (dst, os.getpid())
     try:
-        os.symlink(src, dst)
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(src, tmp)
     except OSError as err:
         return (False, "[ERR] Cannot create link: " + str(err))
 
+    try:
+        os.replace(tmp, dst)
+    except OSError as err:
+        # A concurrent run may have removed the temporary link already
+        try:
+            os.remove(tmp)
+        except OSError as rm_err:
+            if rm_err.errno != errno.ENOENT:
+                return (False, "[ERR] Cannot replace: " + dst + ": " + str(err)
+                        + " (cleanup failed: " + str(rm_err) + ")")
+        return (False, "[ERR] Cannot replace: " + dst + ": " + str(err))
+
     return (True, None)
 
 
+def write_file(path, content, mode=0o644):
+    """
+    Atomically write bytes to a file: they are written to a temporary file
+    in the same directory which is then renamed over the destination, so
+    readers only ever see the old or the new file.
+    """
+    import tempfile
+
+    directory, name = os.path.split(path)
+    try:
+        fd, tmp = tempfile.mkstemp(prefix="." + name + ".", suffix=".tmp",
+                                   dir=directory or ".")
+    except (IOError, OSError) as err:
+        return (False, str(err))
+
+    try:
+        with os.fdopen(fd, "wb") as stream:
+            stream.write(content)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except (IOError, OSError) as err:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return (False, str(err))
+
+    return (True, "")
+
+
+def lock_dir(path):
+    """
+    Take an exclusive advisory lock on a directory (blocking).
+    Returns the lock file descriptor to be passed to unlock_dir().
+    """
+    import fcntl
+
+    fd = os.open(os.path.join(path, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+
+def unlock_dir(fd):
+    """Release a lock taken by lock_dir()."""
+    import fcntl
+
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+############################################################
+# Cache Functions
+############################################################
+
+
+def cache_key(paths):
+    """
+    Build the cache key of a list of source files: path, mtime, size and
+    content hash of each of them, plus the path, mtime and size of this
+    program itself so that an updated vhost-gen never reads an outdated
+    cache entry.
+    """
+    import hashlib
+
+    # Only stat this program: hashing it would cost more than the cache saves
+    try:
+        stat = os.stat(os.path.abspath(__file__))
+    except OSError:
+        return None
+    key = [CACHE_VERSION, (os.path.abspath(__file__), stat.st_mtime, stat.st_size)]
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            with open(path, "rb") as stream:
+                digest = hashlib.sha1(stream.read()).hexdigest()
+        except (IOError, OSError):
+            return None
+        key.append((os.path.abspath(path), stat.st_mtime, stat.st_size, digest))
+    return tuple(key)
+
+
+def cache_path(cache_dir, kind, paths):
+    """Get the path of the cache file for a list of source files."""
+    import hashlib
+
+    name = kind + ":" + ":".join(os.path.abspath(path) for path in paths)
+    return os.path.join(cache_dir,
+                        kind + "-" + hashlib.sha1(name.encode("utf-8")).hexdigest())
+
+
+def cache_load(cache_dir, kind, paths):
+    """Load cached data. Returns None if not cached or outdated."""
+    if cache_dir is None:
+        return None
+
+    key = cache_key(paths)
+    if key is None:
+        return None
+
+    try:
+        with open(cache_path(cache_dir, kind, paths), "rb") as stream:
+            cached_key, data = marshal.load(stream)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if cached_key != key:
+        return None
+    return data
+
+
+def cache_save(cache_dir, kind, paths, data):
+    """
+    Store data in the cache. Caching is best effort, any error (e.g.: a
+    read-only cache directory) silently disables it.
+    """
+    if cache_dir is None:
+        return
+
+    key = cache_key(paths)
+    if key is None:
+        return
+
+    path = cache_path(cache_dir, kind, paths)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(tmp_path, "wb") as stream:
+            marshal.dump((key, data), stream)
+        os.rename(tmp_path, path)
+    except (IOError, OSError, ValueError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
 ############################################################
 # Argument Functions
 ############################################################
@@ -224,24 +788,59 @@ def symlink(src, dst, force=False):
 
 def parse_args(argv):
     """Parse command line arguments."""
+    import getopt
 
     # Config location, can be overwritten with -c
-    l_config_path = CONFIG_PATH
-    l_template_dir = TEMPLATE_DIR
-    o_template_dir = None
-    save = None
-    path = None
-    name = None
-    proxy = None
-    mode = None
-    location = None
-    default = False
-    verbose = False
+    args = {
+        "config_path": CONFIG_PATH,
+        "tpl_dir": TEMPLATE_DIR,
+        "o_tpl_dir": None,
+        "cache_dir": CACHE_DIR,
+        "manifest": None,
+        "save": None,
+        "docroot": None,
+        "name": None,
+        "proxy": None,
+        "mode": None,
+        "location": None,
+        "default": False,
+        "verbose": False,
+        "serve": None,
+        "connect": None,
+        "watch": None,
+        "reload_cmd": None,
+        "poll": False,
+        "profile": False,
+        "profile_out": None,
+        "metrics": None,
+        "jobs": 1,
+        "ndjson": False,
+        "inventory": None,
+        "inventory_name": None,
+        "regenerate": False,
+        "gc": False,
+        "gc_action": None,
+        "stage": False,
+        "check_cmd": None,
+        "bundle": None,
+        "mass": False,
+        "stack": None,
+        "stack_config": STACK_CONFIG_PATH,
+        "stack_tpl": STACK_TEMPLATE_DIR,
+    }
 
     # Define command line options
     try:
-        opts, argv = getopt.getopt(argv, "vm:c:p:r:l:n:t:o:ds",
-                                   ["version", "help"])
+        opts, argv = getopt.getopt(argv, "vm:c:p:r:l:n:t:o:b:ds",
+                                   ["version", "help", "cache-dir=",
+                                    "no-cache", "serve=", "connect=", "watch=",
+                                    "reload-cmd=", "poll", "profile",
+                                    "profile-out=", "metrics=", "jobs=",
+                                    "ndjson", "list", "show=", "remove=",
+                                    "disable=", "enable=", "regenerate", "gc",
+                                    "gc-action=", "stack=", "stack-config=",
+                                    "stack-tpl=", "stage", "check-cmd=",
+                                    "bundle=", "mass"])
     except getopt.GetoptError as err:
         print("[ERR]", str(err), file=sys.stderr)
         print("Type --help for help", file=sys.stderr)
@@ -257,150 +856,215 @@ def parse_args(argv):
             sys.exit()
         # Verbose
         elif opt == "-v":
-            verbose = True
+            args["verbose"] = True
         # Config file overwrite
         elif opt == "-c":
-            l_config_path = arg
+            args["config_path"] = arg
         # Vhost document root path
         elif opt == "-p":
-            path = arg
+            args["docroot"] = arg
         # Vhost reverse proxy (ADDR:PORT)
         elif opt == "-r":
-            proxy = arg
+            args["proxy"] = arg
         # Mode overwrite
         elif opt == "-m":
-            mode = arg
+            args["mode"] = arg
         # Location for reverse proxy
         elif opt == "-l":
-            location = arg
+            args["location"] = arg
         # Vhost name
         elif opt == "-n":
-            name = arg
+            args["name"] = arg
         # Global template dir
         elif opt == "-t":
-            l_template_dir = arg
+            args["tpl_dir"] = arg
         # Local template dir
         elif opt == "-o":
-            o_template_dir = arg
+            args["o_tpl_dir"] = arg
+        # Batch manifest
+        elif opt == "-b":
+            args["manifest"] = arg
+        # Cache
+        elif opt == "--cache-dir":
+            args["cache_dir"] = arg
+        elif opt == "--no-cache":
+            args["cache_dir"] = None
+        # Daemon
+        elif opt == "--serve":
+            args["serve"] = arg
+        elif opt == "--connect":
+            args["connect"] = arg
+        # Watch
+        elif opt == "--watch":
+            args["watch"] = arg
+        elif opt == "--reload-cmd":
+            args["reload_cmd"] = arg
+        elif opt == "--poll":
+            args["poll"] = True
+        # Profile
+        elif opt == "--profile":
+            args["profile"] = True
+        elif opt == "--profile-out":
+            args["profile"] = True
+            args["profile_out"] = arg
+        # Metrics
+        elif opt == "--metrics":
+            args["metrics"] = arg
+        # Inventory
+        elif opt == "--list":
+            args["inventory"] = "list"
+        elif opt in ("--show", "--remove", "--disable", "--enable"):
+            args["inventory"] = opt[2:]
+            args["inventory_name"] = arg
+        elif opt == "--regenerate":
+            args["regenerate"] = True
+        # Bundle files
+        elif opt == "--bundle":
+            try:
+                args["bundle"] = int(arg)
+            except ValueError:
+                args["bundle"] = 0
+            if args["bundle"] < 1:
+                print("[ERR] --bundle must be a number >= 1", file=sys.stderr)
+                print("Type --help for help", file=sys.stderr)
+                sys.exit(2)
+        # Mass hosting
+        elif opt == "--mass":
+            args["mass"] = True
+        # Staged conf_dir
+        elif opt == "--stage":
+            args["stage"] = True
+        elif opt == "--check-cmd":
+            args["stage"] = True
+            args["check_cmd"] = arg
+        # Stack mode
+        elif opt == "--stack":
+            args["stack"] = arg
+        elif opt == "--stack-config":
+            args["stack_config"] = arg
+        elif opt == "--stack-tpl":
+            args["stack_tpl"] = arg
+        # Garbage collection
+        elif opt == "--gc":
+            args["gc"] = True
+        elif opt == "--gc-action":
+            if arg not in GC_ACTIONS:
+                print("[ERR] --gc-action must be one of: " + ", ".join(GC_ACTIONS),
+                      file=sys.stderr)
+                print("Type --help for help", file=sys.stderr)
+                sys.exit(2)
+            args["gc"] = True
+            args["gc_action"] = arg
+        # Streaming batch
+        elif opt == "--ndjson":
+            args["ndjson"] = True
+        # Parallel batch rendering
+        elif opt == "--jobs":
+            try:
+                args["jobs"] = int(arg)
+            except ValueError:
+                args["jobs"] = -1
+            if args["jobs"] < 0:
+                print("[ERR] --jobs must be a number >= 0", file=sys.stderr)
+                print("Type --help for help", file=sys.stderr)
+                sys.exit(2)
+            if args["jobs"] == 0:
+                args["jobs"] = os.cpu_count() or 1
         # Save?
         elif opt == "-d":
-            default = True
+            args["default"] = True
         elif opt == "-s":
-            save = True
-
-    return (
-        l_config_path,
-        l_template_dir,
-        o_template_dir,
-        path,
-        proxy,
-        mode,
-        location,
-        name,
-        default,
-        save,
-        verbose,
-    )
+            args["save"] = True
 
+    return args
+
+
+def check_args_req(name, docroot, proxy, mode, location, names=ARG_NAMES):
+    """
+    Check required arguments without aborting, names is how the messages
+    refer to them (ARG_NAMES or SPEC_NAMES).
+
+    Returns a tuple of the first error message found (or None)
+    and a list of warning messages.
+    """
+    warnings = []
 
-def validate_args_req(name, docroot, proxy, mode, location):
-    """Validate required arguments."""
     # Validate required command line options are set
     if docroot is None and proxy is None:
-        print("[ERR] -p or -r is required", file=sys.stderr)
-        print("Type --help for help", file=sys.stderr)
-        sys.exit(1)
+        return ("%s or %s is required" % (names["docroot"], names["proxy"]), warnings)
     if docroot is not None and proxy is not None:
-        print("[ERR] -p and -r are mutually exclusive", file=sys.stderr)
-        print("Type --help for help", file=sys.stderr)
-        sys.exit(1)
+        return ("%s and %s are mutually exclusive" % (names["docroot"], names["proxy"]),
+                warnings)
 
     # Check proxy string
     if proxy is not None:
         if location is None:
-            print("[ERR] When specifying -r, -l is also required.",
-                  file=sys.stderr)
-            sys.exit(1)
+            return ("When specifying %s, %s is also required."
+                    % (names["proxy"], names["location"]), warnings)
 
-        # Regex: HOSTNAME/IP:PORT
-        regex = re.compile("(^http(s)?://[-_.a-zA-Z0-9]+:[0-9]+$)",
-                           re.IGNORECASE)
-        if not regex.match(proxy):
-            print(
-                "[ERR] Invalid proxy argument string: '%s', should be: %s or %s."
+        if not get_regex(PROXY_REGEX).match(proxy):
+            return (
+                "Invalid proxy argument string: '%s', should be: %s or %s."
                 % (proxy, "http(s)://HOST:PORT", "http(s)://IP:PORT"),
-                file=sys.stderr,
+                warnings,
             )
-            sys.exit(1)
 
-        port = int(re.sub("^.*:", "", proxy))
+        port = int(proxy.rsplit(":", 1)[1])
         if port < 1 or port > 65535:
-            print(
-                "[ERR] Invalid reverse proxy port range: '%d', should between 1 and 65535" % (
-                    port),
-                file=sys.stderr,
+            return (
+                "Invalid reverse proxy port range: '%d', should between 1 and 65535"
+                % (port),
+                warnings,
             )
-            sys.exit(1)
 
     # Check mode string
     if mode is not None:
         if mode not in ("plain", "ssl", "both", "redir", "let"):
-            print(
-                "[ERR] Invalid -m mode string: '%s', should be: %s, %s, %s %s or %s"
-                % (mode, "plain", "ssl", "both", "redir", "let"),
-                file=sys.stderr,
+            return (
+                "Invalid %s: '%s', should be: %s, %s, %s %s or %s"
+                % (names["mode"], mode, "plain", "ssl", "both", "redir", "let"),
+                warnings,
             )
-            sys.exit(1)
 
     # Check normal server settings
     if docroot is not None:
         if location is not None:
-            print("[WARN] -l is ignored when using normal vhost (-p)",
-                  file=sys.stderr)
+            warnings.append("%s is ignored when using normal vhost (%s)"
+                            % (names["location"], names["docroot"]))
 
     if name is None:
-        print("[ERR] -n is required", file=sys.stderr)
-        print("Type --help for help", file=sys.stderr)
-        sys.exit(1)
+        return ("%s is required" % (names["name"]), warnings)
 
-    regex = re.compile("(^[-_.a-zA-Z0-9]+$)", re.IGNORECASE)
-    if not regex.match(name):
-        print("[ERR] Invalid name:", name, file=sys.stderr)
-        sys.exit(1)
+    if not get_regex(NAME_REGEX).match(name):
+        return ("Invalid name: " + name, warnings)
+    if is_bundle_path(name.lower() + ".conf"):
+        return ("Reserved name: " + name, warnings)
+
+    return (None, warnings)
+
+
+def validate_args_req(name, docroot, proxy, mode, location):
+    """Validate required arguments, raises ArgumentError."""
+    err, warnings = check_args_req(name, docroot, proxy, mode, location)
+    for warning in warnings:
+        print("[WARN]", warning, file=sys.stderr)
+    if err is not None:
+        raise ArgumentError(err)
 
 
 def validate_args_opt(config_path, tpl_dir):
-    """Validate optional arguments."""
+    """
+    Validate optional arguments, raises ArgumentError.
+
+    Only the template of the configured server is needed, its existence
+    is checked when it is loaded.
+    """
 
     if not os.path.isfile(config_path):
         print("[WARN] Config file not found:", config_path, file=sys.stderr)
 
     if not os.path.isdir(tpl_dir):
-        print("[ERR] Template path does not exist:", tpl_dir, file=sys.stderr)
-        print("Type --help for help", file=sys.stderr)
-        sys.exit(1)
-
-    # Validate global templates
-    tpl_file = os.path.join(tpl_dir, TEMPLATES["apache22"])
-    if not os.path.isfile(tpl_file):
-        print("[ERR] Apache 2.2 template file does not exist:", tpl_file,
-              file=sys.stderr)
-        print("Type --help for help", file=sys.stderr)
-        sys.exit(1)
-
-    tpl_file = os.path.join(tpl_dir, TEMPLATES["apache24"])
-    if not os.path.isfile(tpl_file):
-        print("[ERR] Apache 2.4 template file does not exist:", tpl_file,
-              file=sys.stderr)
-        print("Type --help for help", file=sys.stderr)
-        sys.exit(1)
-
-    tpl_file = os.path.join(tpl_dir, TEMPLATES["nginx"])
-    if not os.path.isfile(tpl_file):
-        print("[ERR] Nginx template file does not exist:", tpl_file,
-              file=sys.stderr)
-        print("Type --help for help", file=sys.stderr)
-        sys.exit(1)
+        raise ArgumentError("Template path does not exist: " + tpl_dir)
 
 
 ############################################################
@@ -409,15 +1073,15 @@ def validate_args_opt(config_path, tpl_dir):
 
 
 def validate_config(config):
-    """Validate some important keys in config dict."""
+    """Validate some important keys in config dict, raises ConfigError."""
 
     # Validate server type
     valid_hosts = list(TEMPLATES.keys())
     if config["server"] not in valid_hosts:
-        print("[ERR] httpd.server must be 'apache22', 'apache24' or 'nginx'",
-              file=sys.stderr)
-        print("[ERR] Your configuration is:", config["server"], file=sys.stderr)
-        sys.exit(1)
+        raise ConfigError(
+            "httpd.server must be 'apache22', 'apache24' or 'nginx', "
+            "your configuration is: " + to_str(config["server"])
+        )
 
 
 #    # Validate if log dir can be created
@@ -483,7 +1147,7 @@ def vhost_get_default_server(config, default):
     return ""
 
 
-def vhost_get_server_name(config, server_name, default):
+def vhost_get_server_name(config, vhost_name, default):
     """Get server name."""
 
     # Nginx uses: "server_name _;" as the default
@@ -492,9 +1156,7 @@ def vhost_get_server_name(config, server_name, default):
 
     # Apache does not have any specialities. The first one takes precedence.
     # The name will be the same as with every other vhost.
-    prefix = to_str(config["vhost"]["name"]["prefix"])
-    suffix = to_str(config["vhost"]["name"]["suffix"])
-    return prefix + server_name + suffix
+    return vhost_name
 
 
 def vhost_get_access_log(config, server_name):
@@ -519,36 +1181,164 @@ def vhost_get_error_log(config, server_name):
     return path
 
 
+def vhost_get_ssl_crt_path(config, vhost_name, let):
+    """Get ssl crt path"""
+
+    if let:
+        name = os.path.join(vhost_name, "fullchain.cer")
+    else:
+        name = vhost_name + ".crt"
+
+    path = to_str(config["vhost"]["ssl"]["dir_crt"])
+    return os.path.join(path, name)
+
+
+def vhost_get_ssl_key_path(config, vhost_name, let):
+    """Get ssl key path"""
+    if let:
+        name = os.path.join(vhost_name, vhost_name + ".key")
+    else:
+        name = vhost_name + ".key"
+
+    path = to_str(config["vhost"]["ssl"]["dir_crt"])
+    return os.path.join(path, name)
+
+
+def vhost_get_docroot_path(config, docroot, proxy):
+    """Get path of document root."""
+    if proxy is not None:
+        return ""
+
+    suffix = to_str(config["vhost"]["docroot"]["suffix"])
+    path = os.path.join(docroot, suffix)
+    return path
+
+
+def vhost_get_mass_docroot(config):
+    """
+    Get the directory of the document roots of mass hosted apache vhosts
+    (conf.yml may not have vhost.mass at all).
+    """
+    mass = config["vhost"].get("mass") or {}
+    return to_str(mass.get("docroot")) or DEFAULT_CONFIG["vhost"]["mass"]["docroot"]
+
+
+def vhost_get_proxy_parts(proxy):
+    """Split a validated http(s)://HOST:PORT proxy string into its parts."""
+    if proxy is None:
+        return ("", "", "")
+
+    proto, addr = proxy.split("://", 1)
+    addr, port = addr.rsplit(":", 1)
+    return (proto, addr, port)
+
+
+############################################################
+# vHost Context
+############################################################
+
+
+class VhostContext(object):
+    """
+    Everything needed to render a single vhost, derived once from the
+    config and the vhost arguments (-n, -p, -r, -l, -m, -d).
+    """
+
+    __slots__ = (
+        "config",
+        "name",
+        "vhost_name",
+        "server_name",
+        "docroot",
+        "docroot_path",
+        "proxy",
+        "proxy_proto",
+        "proxy_addr",
+        "proxy_port",
+        "location",
+        "mode",
+        "default",
+        "port",
+        "ssl_port",
+        "listen",
+        "ssl_listen",
+        "http_proto",
+        "ssl_http_proto",
+        "default_vhost",
+        "access_log",
+        "error_log",
+        "ssl_access_log",
+        "ssl_error_log",
+        "ssl_crt_path",
+        "ssl_key_path",
+    )
+
+    def __init__(self, config, name, docroot, proxy, mode, location, default):
+        prefix = to_str(config["vhost"]["name"]["prefix"])
+        suffix = to_str(config["vhost"]["name"]["suffix"])
+        let = mode == "let"
+
+        self.config = config
+        self.name = name
+        self.vhost_name = prefix + name + suffix
+        self.server_name = vhost_get_server_name(config, self.vhost_name,
+                                                 default)
+        self.docroot = docroot
+        self.docroot_path = vhost_get_docroot_path(config, docroot, proxy)
+        self.proxy = proxy
+        self.proxy_proto, self.proxy_addr, self.proxy_port = vhost_get_proxy_parts(
+            proxy)
+        self.location = location
+        self.mode = mode
+        self.default = bool(default)
+        self.port = to_str(config["vhost"]["port"])
+        self.ssl_port = to_str(config["vhost"]["ssl_port"])
+        self.listen = vhost_get_port(config, False)
+        self.ssl_listen = vhost_get_port(config, True)
+        self.http_proto = vhost_get_http_proto(config, False)
+        self.ssl_http_proto = vhost_get_http_proto(config, True)
+        self.default_vhost = vhost_get_default_server(config, default)
+        self.access_log = vhost_get_access_log(config, name)
+        self.error_log = vhost_get_error_log(config, name)
+        self.ssl_access_log = vhost_get_access_log(config, name + "_ssl")
+        self.ssl_error_log = vhost_get_error_log(config, name + "_ssl")
+        self.ssl_crt_path = vhost_get_ssl_crt_path(config, self.vhost_name, let)
+        self.ssl_key_path = vhost_get_ssl_key_path(config, self.vhost_name, let)
+
+    def spec(self):
+        """Get the vhost arguments as a spec (manifest entry)."""
+        return {key: getattr(self, key) for key in MANIFEST_KEYS}
+
+
 ############################################################
 # Get vHost Type (normal or reverse proxy
 ############################################################
 
 
-def vhost_get_vhost_docroot(config, template, docroot, proxy):
+def vhost_get_vhost_docroot(ctx, template, index):
     """Get document root directive."""
-    if proxy is not None:
+    if ctx.proxy is not None:
         return ""
 
-    return str_replace(
+    return str_render(
         template["vhost_type"]["docroot"],
         {
-            "__DOCUMENT_ROOT__": vhost_get_docroot_path(config, docroot, proxy),
-            "__INDEX__": vhost_get_index(config),
+            "__DOCUMENT_ROOT__": ctx.docroot_path,
+            "__INDEX__": index,
         },
     )
 
 
-def vhost_get_vhost_rproxy(template, proxy, location):
+def vhost_get_vhost_rproxy(ctx, template):
     """Get reverse proxy definition."""
-    if proxy is not None:
-        return str_replace(
+    if ctx.proxy is not None:
+        return str_render(
             template["vhost_type"]["rproxy"],
             {
-                "__LOCATION__": location,
-                "__PROXY_PROTO__": re.sub("://.*$", "", proxy),
-                "__PROXY_ADDR__": re.search("^.*://(.+):[0-9]+", proxy).group(
-                    1),
-                "__PROXY_PORT__": re.sub("^.*:", "", proxy),
+                "__LOCATION__": ctx.location,
+                "__PROXY_PROTO__": ctx.proxy_proto,
+                "__PROXY_ADDR__": ctx.proxy_addr,
+                "__PROXY_PORT__": ctx.proxy_port,
             },
         )
     return ""
@@ -559,73 +1349,35 @@ def vhost_get_vhost_rproxy(template, proxy, location):
 ############################################################
 
 
-def vhost_get_vhost_ssl(config, template, server_name, let):
-    """Get ssl definition."""
-    return str_replace(
-        template["features"]["ssl"],
-        {
-            "__SSL_PATH_CRT__": to_str(
-                vhost_get_ssl_crt_path(config, server_name, let)),
-            "__SSL_PATH_KEY__": to_str(
-                vhost_get_ssl_key_path(config, server_name, let)),
-            "__SSL_PROTOCOLS__": to_str(config["vhost"]["ssl"]["protocols"]),
-            "__SSL_HONOR_CIPHER_ORDER__": to_str(
-                config["vhost"]["ssl"]["honor_cipher_order"]),
-            "__SSL_CIPHERS__": to_str(config["vhost"]["ssl"]["ciphers"]),
-        },
-    )
+def vhost_get_ssl_settings(config):
+    """Get the config-only placeholders of the ssl definition."""
+    return {
+        "__SSL_PROTOCOLS__": to_str(config["vhost"]["ssl"]["protocols"]),
+        "__SSL_HONOR_CIPHER_ORDER__": to_str(
+            config["vhost"]["ssl"]["honor_cipher_order"]),
+        "__SSL_CIPHERS__": to_str(config["vhost"]["ssl"]["ciphers"]),
+    }
+
+
+def vhost_get_vhost_ssl(ctx, section):
+    """Get ssl definition from the compiled ssl section (see vhost_get_ssl_section())."""
+    replacer = vhost_get_ssl_settings(ctx.config)
+    replacer["__SSL_PATH_CRT__"] = ctx.ssl_crt_path
+    replacer["__SSL_PATH_KEY__"] = ctx.ssl_key_path
+    return str_render(section, replacer)
 
 
-def vhost_get_vhost_redir(config, template, server_name):
+def vhost_get_vhost_redir(ctx, template):
     """Get redirect to ssl definition."""
-    return str_replace(
+    return str_render(
         template["features"]["redirect"],
         {
-            "__VHOST_NAME__": vhost_get_server_name(config, server_name, 0),
-            "__SSL_PORT__": to_str(config["vhost"]["ssl_port"]),
+            "__VHOST_NAME__": ctx.vhost_name,
+            "__SSL_PORT__": ctx.ssl_port,
         },
     )
 
 
-def vhost_get_ssl_crt_path(config, server_name, let):
-    """Get ssl crt path"""
-
-    prefix = to_str(config["vhost"]["name"]["prefix"])
-    suffix = to_str(config["vhost"]["name"]["suffix"])
-    name = prefix + server_name + suffix
-    if let:
-        name = os.path.join(name, "fullchain.cer")
-    else:
-        name += ".crt"
-
-    path = to_str(config["vhost"]["ssl"]["dir_crt"])
-    return os.path.join(path, name)
-
-
-def vhost_get_ssl_key_path(config, server_name, let):
-    """Get ssl key path"""
-    prefix = to_str(config["vhost"]["name"]["prefix"])
-    suffix = to_str(config["vhost"]["name"]["suffix"])
-    name = prefix + server_name + suffix
-    if let:
-        name = os.path.join(name, name + ".key")
-    else:
-        name += ".key"
-
-    path = to_str(config["vhost"]["ssl"]["dir_crt"])
-    return os.path.join(path, name)
-
-
-def vhost_get_docroot_path(config, docroot, proxy):
-    """Get path of document root."""
-    if proxy is not None:
-        return ""
-
-    suffix = to_str(config["vhost"]["docroot"]["suffix"])
-    path = os.path.join(docroot, suffix)
-    return path
-
-
 def vhost_get_index(config):
     """Get index."""
     if "index" in config["vhost"] and config["vhost"]["index"]:
@@ -636,23 +1388,23 @@ def vhost_get_index(config):
     return " ".join(elem)
 
 
-def vhost_get_php_fpm(config, template, docroot, proxy):
+def vhost_get_php_fpm(ctx, template):
     """Get PHP FPM directive. If using reverse proxy, PHP-FPM will be disabled."""
-    if proxy is not None:
+    if ctx.proxy is not None:
         return ""
 
     # Get PHP-FPM
     php_fpm = ""
+    config = ctx.config
     if config["vhost"]["php_fpm"]["enable"]:
-        php_fpm = str_replace(
+        php_fpm = str_render(
             template["features"]["php_fpm"],
             {
                 "__PHP_ADDR__": to_str(config["vhost"]["php_fpm"]["address"]),
                 "__PHP_PORT__": to_str(config["vhost"]["php_fpm"]["port"]),
                 "__PHP_TIMEOUT__": to_str(
                     config["vhost"]["php_fpm"]["timeout"]),
-                "__DOCUMENT_ROOT__": vhost_get_docroot_path(config, docroot,
-                                                            proxy),
+                "__DOCUMENT_ROOT__": ctx.docroot_path,
             },
         )
     return php_fpm
@@ -666,13 +1418,13 @@ def vhost_get_aliases(config, template):
         xdomain_request = ""
         if "xdomain_request" in item:
             if item["xdomain_request"]["enable"]:
-                xdomain_request = str_replace(
+                xdomain_request = str_render(
                     template["features"]["xdomain_request"],
                     {"__REGEX__": to_str(item["xdomain_request"]["origin"])},
                 )
         # Replace everything
         aliases.append(
-            str_replace(
+            str_render(
                 template["features"]["alias"],
                 {
                     "__ALIAS__": to_str(item["alias"]),
@@ -690,7 +1442,7 @@ def vhost_get_denies(config, template):
     denies = []
     for item in config["vhost"]["deny"]:
         denies.append(
-            str_replace(template["features"]["deny"],
+            str_render(template["features"]["deny"],
                         {"__REGEX__": to_str(item["alias"])})
         )
     # Join by OS independent newlines
@@ -699,12 +1451,13 @@ def vhost_get_denies(config, template):
 
 def vhost_get_server_status(config, template):
     """Get virtual host server status directivs."""
-    status = ""
-    if config["vhost"]["server_status"]["enable"]:
-        status = template["features"]["server_status"]
+    if not config["vhost"]["server_status"]["enable"]:
+        return ""
 
-    return str_replace(status, {
-        "__REGEX__": to_str(config["vhost"]["server_status"]["alias"])})
+    return str_render(
+        template["features"]["server_status"],
+        {"__REGEX__": to_str(config["vhost"]["server_status"]["alias"])},
+    )
 
 
 def vhost_get_custom_section(config):
@@ -713,134 +1466,344 @@ def vhost_get_custom_section(config):
 
 
 ############################################################
-# vHost create
+# Shared snippets
 ############################################################
 
-
-def get_vhost_plain(config, tpl, docroot, proxy, location, server_name,
-    default):
-    """Get plain vhost"""
-    return str_replace(
-        tpl["vhost"],
-        {
-            "__PORT__": vhost_get_port(config, False),
-            "__HTTP_PROTO__": vhost_get_http_proto(config, False),
-            "__DEFAULT_VHOST__": vhost_get_default_server(config, default),
-            "__DOCUMENT_ROOT__": vhost_get_docroot_path(config, docroot, proxy),
-            "__VHOST_NAME__": vhost_get_server_name(config, server_name,
-                                                    default),
-            "__VHOST_DOCROOT__": str_indent(
-                vhost_get_vhost_docroot(config, tpl, docroot, proxy), 4
-            ),
-            "__VHOST_RPROXY__": str_indent(
-                vhost_get_vhost_rproxy(tpl, proxy, location), 4),
-            "__REDIRECT__": "",
-            "__SSL__": "",
-            "__INDEX__": vhost_get_index(config),
-            "__ACCESS_LOG__": vhost_get_access_log(config, server_name),
-            "__ERROR_LOG__": vhost_get_error_log(config, server_name),
-            "__PHP_FPM__": str_indent(
-                vhost_get_php_fpm(config, tpl, docroot, proxy),
-                4),
-            "__ALIASES__": str_indent(vhost_get_aliases(config, tpl), 4),
-            "__DENIES__": str_indent(vhost_get_denies(config, tpl), 4),
-            "__SERVER_STATUS__": str_indent(
-                vhost_get_server_status(config, tpl), 4),
-            "__CUSTOM__": str_indent(vhost_get_custom_section(config), 4),
-        },
+# Placeholders of the ssl definition which differ per vhost
+SSL_VHOST_PLACEHOLDERS = ("__SSL_PATH_CRT__", "__SSL_PATH_KEY__")
+
+
+def split_section_lines(compiled):
+    """Split a compiled template section into one compiled section per line."""
+    lines = [[""]]
+    for i, part in enumerate(compiled):
+        if i % 2:
+            lines[-1].extend([part, ""])
+            continue
+        for chunk in part.splitlines(True):
+            lines[-1][-1] += chunk
+            if chunk.endswith("\n"):
+                lines.append([""])
+    if lines[-1] == [""]:
+        lines.pop()
+    return [tuple(line) for line in lines]
+
+
+def join_sections(sections):
+    """Concatenate compiled template sections into a single one."""
+    joined = [""]
+    for section in sections:
+        joined[-1] += section[0]
+        joined.extend(section[1:])
+    return tuple(joined)
+
+
+def vhost_get_ssl_shared(config, template):
+    """Get the lines of the ssl definition which are the same for every vhost."""
+    replacer = vhost_get_ssl_settings(config)
+    return "".join(
+        str_render(line, replacer)
+        for line in split_section_lines(template["features"]["ssl"])
+        if not set(line[1::2]) & set(SSL_VHOST_PLACEHOLDERS)
     )
 
 
-def get_vhost_ssl(config, tpl, docroot, proxy, location, server_name, default,
-    let=False):
-    """Get ssl vhost"""
-    return str_replace(
-        tpl["vhost"],
-        {
-            "__PORT__": vhost_get_port(config, True),
-            "__HTTP_PROTO__": vhost_get_http_proto(config, True),
-            "__DEFAULT_VHOST__": vhost_get_default_server(config, default),
-            "__DOCUMENT_ROOT__": vhost_get_docroot_path(config, docroot, proxy),
-            "__VHOST_NAME__": vhost_get_server_name(config, server_name,
-                                                    default),
-            "__VHOST_DOCROOT__": str_indent(
-                vhost_get_vhost_docroot(config, tpl, docroot, proxy), 4
-            ),
-            "__VHOST_RPROXY__": str_indent(
-                vhost_get_vhost_rproxy(tpl, proxy, location), 4),
-            "__REDIRECT__": "",
-            "__SSL__": str_indent(
-                vhost_get_vhost_ssl(config, tpl, server_name, let),
-                4),
-            "__INDEX__": vhost_get_index(config),
-            "__ACCESS_LOG__": vhost_get_access_log(config,
-                                                   server_name + "_ssl"),
-            "__ERROR_LOG__": vhost_get_error_log(config, server_name + "_ssl"),
-            "__PHP_FPM__": str_indent(
-                vhost_get_php_fpm(config, tpl, docroot, proxy),
-                4),
-            "__ALIASES__": str_indent(vhost_get_aliases(config, tpl), 4),
-            "__DENIES__": str_indent(vhost_get_denies(config, tpl), 4),
-            "__SERVER_STATUS__": str_indent(
-                vhost_get_server_status(config, tpl), 4),
-            "__CUSTOM__": str_indent(vhost_get_custom_section(config), 4),
-        },
-    )
+def vhost_get_snippets_enabled(config):
+    """Check if vhost.snippets is enabled (conf.yml may not have it at all)."""
+    return bool((config["vhost"].get("snippets") or {}).get("enable"))
 
 
-def get_vhost_redir(config, tpl, docroot, proxy, server_name, default):
-    """Get redirect to ssl vhost"""
-    return str_replace(
-        tpl["vhost"],
-        {
-            "__PORT__": vhost_get_port(config, False),
-            "__HTTP_PROTO__": vhost_get_http_proto(config, False),
-            "__DEFAULT_VHOST__": vhost_get_default_server(config, default),
-            "__DOCUMENT_ROOT__": vhost_get_docroot_path(config, docroot, proxy),
-            "__VHOST_NAME__": vhost_get_server_name(config, server_name,
-                                                    default),
-            "__VHOST_DOCROOT__": "",
-            "__VHOST_RPROXY__": "",
-            "__REDIRECT__": str_indent(
-                vhost_get_vhost_redir(config, tpl, server_name), 4),
-            "__SSL__": "",
-            "__INDEX__": "",
-            "__ACCESS_LOG__": vhost_get_access_log(config, server_name),
-            "__ERROR_LOG__": vhost_get_error_log(config, server_name),
-            "__PHP_FPM__": "",
-            "__ALIASES__": "",
-            "__DENIES__": "",
-            "__SERVER_STATUS__": "",
-            "__CUSTOM__": "",
-        },
-    )
+# Config-only fragments which can be moved into a shared snippet
+SNIPPETS = {
+    "ssl": vhost_get_ssl_shared,
+    "deny": vhost_get_denies,
+    "server_status": vhost_get_server_status,
+}
 
 
-def get_vhost(config, tpl, docroot, proxy, mode, location, server_name,
-    default):
-    """Create the vhost."""
+def get_snippet_path(config, kind, content):
+    """
+    Get the path of a shared snippet, named by the digest of its content so
+    a changed config always gets a new snippet. Snippets are not staged
+    (see StagedConfDir), they always go to the live conf_dir.
+    """
+    import hashlib
+
+    digest = hashlib.sha1(content.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(config.get("live_conf_dir", config["conf_dir"]),
+                        SNIPPET_DIR, "%s-%s.conf" % (kind, digest))
+
+
+def vhost_get_snippet(config, template, kind):
+    """
+    Get a config-only fragment, or with vhost.snippets enabled the
+    directive including the shared snippet it is written to instead.
+    """
+    content = SNIPPETS[kind](config, template)
+    if not vhost_get_snippets_enabled(config) or not content.strip():
+        return content
+    include = SNIPPET_INCLUDE[config["server"]] % (
+        get_snippet_path(config, kind, content))
+    return include + ("\n" if content.endswith("\n") else "")
+
+
+def vhost_get_snippets(config, template):
+    """Get {path: content} of every non-empty shared snippet."""
+    snippets = dict()
+    if not vhost_get_snippets_enabled(config):
+        return snippets
+    for kind, func in SNIPPETS.items():
+        content = func(config, template)
+        if content.strip():
+            snippets[get_snippet_path(config, kind, content)] = content
+    return snippets
+
+
+def vhost_get_ssl_section(config, template):
+    """
+    Get the compiled ssl section. With vhost.snippets enabled, only the lines
+    with the certificate and key of the vhost are kept, followed by the
+    directive including the other lines from their shared snippet.
+    """
+    section = template["features"]["ssl"]
+    if not vhost_get_snippets_enabled(config):
+        return section
+
+    lines = [line for line in split_section_lines(section)
+             if set(line[1::2]) & set(SSL_VHOST_PLACEHOLDERS)]
+    return join_sections(lines + [(vhost_get_snippet(config, template, "ssl"),)])
+
+
+############################################################
+# Config-only vHost fragments
+############################################################
+
+# Fragments which only depend on config and template (not on the vhost)
+FRAGMENTS = {
+    "__INDEX__": lambda config, tpl: vhost_get_index(config),
+    "__ALIASES__": lambda config, tpl: str_indent(vhost_get_aliases(config, tpl), 4),
+    "__DENIES__": lambda config, tpl: str_indent(
+        vhost_get_snippet(config, tpl, "deny"), 4),
+    "__SERVER_STATUS__": lambda config, tpl: str_indent(
+        vhost_get_snippet(config, tpl, "server_status"), 4),
+    "__CUSTOM__": lambda config, tpl: str_indent(vhost_get_custom_section(config), 4),
+    # Compiled, rendered with the certificate and key of each vhost
+    "__SSL__": vhost_get_ssl_section,
+}
+
+
+def vhost_dependencies(config, mode, proxy):
+    """
+    Get the config and template sections (as key tuples) a vhost with the
+    given mode and document root or reverse proxy is rendered from. The
+    conf_dir is one of them for the snippet include paths, vhost.mass for
+    the map entries of the mass hosting file.
+    """
+    config_keys = [
+        ("server",), ("conf_dir",), ("custom",), ("vhost", "port"),
+        ("vhost", "ssl_port"), ("vhost", "name"), ("vhost", "index"),
+        ("vhost", "log"), ("vhost", "alias"), ("vhost", "deny"),
+        ("vhost", "server_status"), ("vhost", "snippets"), ("vhost", "mass"),
+    ]
+    tpl_keys = [
+        ("vhost",), ("features", "alias"), ("features", "xdomain_request"),
+        ("features", "deny"),
+    ]
+    if config["vhost"]["server_status"]["enable"]:
+        tpl_keys.append(("features", "server_status"))
+
+    if proxy is None:
+        config_keys.extend([("vhost", "docroot"), ("vhost", "php_fpm")])
+        tpl_keys.append(("vhost_type", "docroot"))
+        if config["vhost"]["php_fpm"]["enable"]:
+            tpl_keys.append(("features", "php_fpm"))
+    else:
+        tpl_keys.append(("vhost_type", "rproxy"))
+
+    if mode in ("ssl", "both", "redir", "let"):
+        config_keys.append(("vhost", "ssl"))
+        tpl_keys.append(("features", "ssl"))
+    if mode in ("redir", "let"):
+        tpl_keys.append(("features", "redirect"))
+
+    return (config_keys, tpl_keys)
+
+
+def sections_digest(data, keys):
+    """
+    Get the sha1 hex digest of the given sections (key tuples) of data and
+    of RENDER_VERSION.
+    """
+    sections = [["render_version", RENDER_VERSION]]
+    for path in keys:
+        section = data
+        for key in path:
+            section = section.get(key) if isinstance(section, dict) else None
+        sections.append([".".join(path), section])
+    return data_digest(sections)
+
+
+class FragmentCache(object):
+    """
+    Memoize the config-only fragments of one loaded config/template pair,
+    so they are computed once and reused by every variant (plain, ssl, redir)
+    of every vhost rendered with it.
+    """
+
+    def __init__(self, config, tpl):
+        self.config = config
+        self.tpl = tpl
+        self.fragments = dict()
+        self.hits = 0
+        self.misses = 0
+        self.dependency_digests = dict()
+        self.snippets_saved = False
+
+    def get(self, placeholder):
+        """Get an already indented fragment by its placeholder."""
+        if placeholder in self.fragments:
+            self.hits += 1
+            return self.fragments[placeholder]
+
+        self.misses += 1
+        fragment = FRAGMENTS[placeholder](self.config, self.tpl)
+        self.fragments[placeholder] = fragment
+        return fragment
+
+    def stats(self):
+        """Get a printable summary of the cache counters."""
+        return "fragment cache: %d hits, %d misses" % (self.hits, self.misses)
+
+    def dependencies(self, spec):
+        """
+        Get the sha1 hex digests of the config and of the template sections
+        a vhost spec depends on (see vhost_dependencies()). They only change
+        when one of these sections (or RENDER_VERSION) changes.
+        """
+        key = (spec["mode"], spec["proxy"] is None)
+        if key not in self.dependency_digests:
+            config_keys, tpl_keys = vhost_dependencies(self.config, spec["mode"],
+                                                       spec["proxy"])
+            # A staged config renders for the live conf_dir (see StagedConfDir)
+            config = dict(self.config, conf_dir=self.config.get(
+                "live_conf_dir", self.config["conf_dir"]))
+            self.dependency_digests[key] = (
+                sections_digest(config, config_keys),
+                sections_digest(self.tpl, tpl_keys),
+            )
+        return self.dependency_digests[key]
+
+
+############################################################
+# vHost create
+############################################################
+
+
+def get_vhost_plain(ctx, tpl, fragments, redirect=""):
+    """Get plain vhost, with optional directives at the position of a redirect"""
+    return str_render(
+        tpl["vhost"],
+        {
+            "__PORT__": ctx.listen,
+            "__HTTP_PROTO__": ctx.http_proto,
+            "__DEFAULT_VHOST__": ctx.default_vhost,
+            "__DOCUMENT_ROOT__": ctx.docroot_path,
+            "__VHOST_NAME__": ctx.server_name,
+            "__VHOST_DOCROOT__": str_indent(
+                vhost_get_vhost_docroot(ctx, tpl, fragments.get("__INDEX__")), 4
+            ),
+            "__VHOST_RPROXY__": str_indent(vhost_get_vhost_rproxy(ctx, tpl), 4),
+            "__REDIRECT__": str_indent(redirect, 4),
+            "__SSL__": "",
+            "__INDEX__": fragments.get("__INDEX__"),
+            "__ACCESS_LOG__": ctx.access_log,
+            "__ERROR_LOG__": ctx.error_log,
+            "__PHP_FPM__": str_indent(vhost_get_php_fpm(ctx, tpl), 4),
+            "__ALIASES__": fragments.get("__ALIASES__"),
+            "__DENIES__": fragments.get("__DENIES__"),
+            "__SERVER_STATUS__": fragments.get("__SERVER_STATUS__"),
+            "__CUSTOM__": fragments.get("__CUSTOM__"),
+        },
+    )
+
+
+def get_vhost_ssl(ctx, tpl, fragments):
+    """Get ssl vhost"""
+    return str_render(
+        tpl["vhost"],
+        {
+            "__PORT__": ctx.ssl_listen,
+            "__HTTP_PROTO__": ctx.ssl_http_proto,
+            "__DEFAULT_VHOST__": ctx.default_vhost,
+            "__DOCUMENT_ROOT__": ctx.docroot_path,
+            "__VHOST_NAME__": ctx.server_name,
+            "__VHOST_DOCROOT__": str_indent(
+                vhost_get_vhost_docroot(ctx, tpl, fragments.get("__INDEX__")), 4
+            ),
+            "__VHOST_RPROXY__": str_indent(vhost_get_vhost_rproxy(ctx, tpl), 4),
+            "__REDIRECT__": "",
+            "__SSL__": str_indent(
+                vhost_get_vhost_ssl(ctx, fragments.get("__SSL__")), 4),
+            "__INDEX__": fragments.get("__INDEX__"),
+            "__ACCESS_LOG__": ctx.ssl_access_log,
+            "__ERROR_LOG__": ctx.ssl_error_log,
+            "__PHP_FPM__": str_indent(vhost_get_php_fpm(ctx, tpl), 4),
+            "__ALIASES__": fragments.get("__ALIASES__"),
+            "__DENIES__": fragments.get("__DENIES__"),
+            "__SERVER_STATUS__": fragments.get("__SERVER_STATUS__"),
+            "__CUSTOM__": fragments.get("__CUSTOM__"),
+        },
+    )
+
 
-    if mode == "ssl":
-        return get_vhost_ssl(config, tpl, docroot, proxy, location, server_name,
-                             default)
-    if mode == "both":
-        return get_vhost_ssl(
-            config, tpl, docroot, proxy, location, server_name, default
-        ) + get_vhost_plain(config, tpl, docroot, proxy, location, server_name,
-                            default)
+def get_vhost_redir(ctx, tpl):
+    """Get redirect to ssl vhost"""
+    return str_render(
+        tpl["vhost"],
+        {
+            "__PORT__": ctx.listen,
+            "__HTTP_PROTO__": ctx.http_proto,
+            "__DEFAULT_VHOST__": ctx.default_vhost,
+            "__DOCUMENT_ROOT__": ctx.docroot_path,
+            "__VHOST_NAME__": ctx.server_name,
+            "__VHOST_DOCROOT__": "",
+            "__VHOST_RPROXY__": "",
+            "__REDIRECT__": str_indent(vhost_get_vhost_redir(ctx, tpl), 4),
+            "__SSL__": "",
+            "__INDEX__": "",
+            "__ACCESS_LOG__": ctx.access_log,
+            "__ERROR_LOG__": ctx.error_log,
+            "__PHP_FPM__": "",
+            "__ALIASES__": "",
+            "__DENIES__": "",
+            "__SERVER_STATUS__": "",
+            "__CUSTOM__": "",
+        },
+    )
+
+
+def iter_vhost(ctx, tpl, fragments=None):
+    """
+    Create the vhost one server block at a time (ssl, then plain or redirect),
+    so modes with two blocks can be streamed without joining them first.
+
+    Pass the same FragmentCache to every call rendering with the same
+    config/template pair to reuse its config-only fragments.
+    """
+    if fragments is None or fragments.config is not ctx.config or fragments.tpl is not tpl:
+        fragments = FragmentCache(ctx.config, tpl)
 
-    if mode == "redir":
-        return get_vhost_ssl(
-            config, tpl, docroot, proxy, location, server_name, default
-        ) + get_vhost_redir(config, tpl, docroot, proxy, server_name, default)
+    if ctx.mode in ("ssl", "both", "redir", "let"):
+        yield get_vhost_ssl(ctx, tpl, fragments)
+    if ctx.mode in ("redir", "let"):
+        yield get_vhost_redir(ctx, tpl)
+    elif ctx.mode != "ssl":
+        yield get_vhost_plain(ctx, tpl, fragments)
 
-    if mode == "let":
-        return get_vhost_ssl(
-            config, tpl, docroot, proxy, location, server_name, default, True
-        ) + get_vhost_redir(config, tpl, docroot, proxy, server_name, default)
 
-    return get_vhost_plain(config, tpl, docroot, proxy, location, server_name,
-                           default)
+def get_vhost(ctx, tpl, fragments=None):
+    """Create the vhost."""
+    return "".join(iter_vhost(ctx, tpl, fragments))
 
 
 ############################################################
@@ -848,11 +1811,15 @@ def get_vhost(config, tpl, docroot, proxy, mode, location, server_name,
 ############################################################
 
 
-def load_config(config_path):
+def load_config(config_path, cache_dir=None):
     """Load config and merge with defaults in case not found or something is missing."""
 
     # Load configuration file
     if os.path.isfile(config_path):
+        config = cache_load(cache_dir, "config", [config_path])
+        if config is not None:
+            return (True, config, "")
+
         succ, config, err = load_yaml(config_path)
         if not succ:
             return (False, dict(), err)
@@ -863,11 +1830,61 @@ def load_config(config_path):
     # Merge config settings with program defaults (config takes precedence over defaults)
     config = merge_yaml(DEFAULT_CONFIG, config)
 
+    if os.path.isfile(config_path):
+        cache_save(cache_dir, "config", [config_path], config)
+
     return (True, config, "")
 
 
-def load_template(template_dir, o_template_dir, server):
-    """Load global and optional template file and merge them."""
+def compile_section(string, placeholders):
+    """
+    Tokenize a template section into alternating literal and placeholder
+    segments. Unknown placeholders are reported as an error.
+    """
+    string = to_str(string)
+    parts = get_regex("(" + PLACEHOLDER_REGEX + ")").split(string)
+    unknown = sorted(set(parts[1::2]) - set(placeholders))
+    if unknown:
+        return (False, tuple(), "unknown placeholders: " + ", ".join(unknown))
+    return (True, tuple(parts), "")
+
+
+def compile_template(template):
+    """Compile every known section of a loaded template."""
+
+    compiled = dict()
+    for keys, placeholders in TEMPLATE_PLACEHOLDERS.items():
+        section = template
+        for key in keys:
+            if not isinstance(section, dict) or key not in section:
+                return (False, dict(),
+                        "missing template section: " + ".".join(keys))
+            section = section[key]
+
+        succ, parts, err = compile_section(section, placeholders)
+        if not succ:
+            return (False, dict(), "(" + ".".join(keys) + "): " + err)
+
+        target = compiled
+        for key in keys[:-1]:
+            target = target.setdefault(key, dict())
+        target[keys[-1]] = parts
+
+    return (True, compiled, "")
+
+
+def load_template(template_dir, o_template_dir, server, cache_dir=None):
+    """Load global and optional template file, merge and compile them."""
+
+    # Source files of the (merged) template
+    sources = [os.path.join(template_dir, TEMPLATES[server])]
+    if o_template_dir is not None:
+        if os.path.isfile(os.path.join(o_template_dir, TEMPLATES[server])):
+            sources.append(os.path.join(o_template_dir, TEMPLATES[server]))
+
+    compiled = cache_load(cache_dir, "template", sources)
+    if compiled is not None:
+        return (True, compiled, "")
 
     # Load global template file
     succ, template, err = load_yaml(
@@ -904,7 +1921,93 @@ def load_template(template_dir, o_template_dir, server):
                 )
             template = merge_yaml(template, template2)
 
-    return (True, template, "")
+    # Tokenize all sections once, rendering is then a single join
+    succ, compiled, err = compile_template(template)
+    if not succ:
+        return (False, dict(), "(template): " + err)
+
+    cache_save(cache_dir, "template", sources, compiled)
+
+    return (True, compiled, "")
+
+
+def load_manifest(path):
+    """
+    Load a batch manifest (YAML or JSON) and return its list of vhost entries.
+    A path of '-' reads the manifest from stdin.
+    """
+
+    try:
+        if path == "-":
+            content = sys.stdin.read()
+        else:
+            with open(path, "r") as stream:
+                content = stream.read()
+    except IOError:
+        return (False, list(), "File does not exist: " + path)
+
+    return parse_manifest(content, path)
+
+
+def parse_manifest(content, path="-"):
+    """Parse the content of a batch manifest (YAML or JSON)."""
+    import json
+
+    # JSON is a subset of YAML, but the json module is a lot faster
+    yaml = import_yaml()
+    try:
+        if content.lstrip()[:1] in ("[", "{"):
+            data = json.loads(content)
+        else:
+            data = yaml_safe_load(content)
+    except (ValueError, yaml.YAMLError) as err:
+        return (False, list(), str(err))
+
+    if isinstance(data, dict):
+        data = data.get("vhosts")
+    if not isinstance(data, list):
+        return (False, list(), "Manifest must be a list of vhosts: " + path)
+
+    return (True, data, "")
+
+
+def check_manifest_entry(entry):
+    """
+    Normalize and validate a single manifest entry.
+
+    Returns a tuple of the normalized vhost dict, the first error message
+    found (or None) and a list of warning messages.
+    """
+    if not isinstance(entry, dict):
+        return (None, "Manifest entry must be a mapping", [])
+
+    unknown = sorted(set(entry.keys()) - set(MANIFEST_KEYS))
+    if unknown:
+        return (None, "Unknown manifest keys: " + ", ".join(unknown), [])
+
+    # Strings like "false" or "no" (e.g. from JSON) would be truthy
+    default = entry.get("default")
+    if default is not None and not isinstance(default, bool):
+        return (None, "Invalid default: '%s', should be true or false"
+                % (to_str(default)), [])
+
+    vhost = {
+        "name": entry.get("name"),
+        "docroot": entry.get("docroot"),
+        "proxy": entry.get("proxy"),
+        "location": entry.get("location"),
+        "mode": entry.get("mode"),
+        "default": bool(default),
+    }
+    for key in ("name", "docroot", "proxy", "location", "mode"):
+        if vhost[key] is not None:
+            vhost[key] = to_str(vhost[key])
+
+    err, warnings = check_args_req(
+        vhost["name"], vhost["docroot"], vhost["proxy"], vhost["mode"],
+        vhost["location"], SPEC_NAMES
+    )
+    return (vhost, err, warnings)
 
 
 ############################################################
@@ -912,12 +2015,436 @@ def load_template(template_dir, o_template_dir, server):
 ############################################################
 
 
+def check_conf_dir(config):
+    """Check that the output conf_dir exists and is writeable."""
+    if not os.path.isdir(config["conf_dir"]):
+        return (False, "[ERR] output conf_dir does not exist: " + config["conf_dir"])
+    if not os.access(config["conf_dir"], os.W_OK):
+        return (
+            False,
+            "[ERR] directory does not have write permissions " + config["conf_dir"],
+        )
+    return (True, None)
+
+
+def get_vhost_path(config, name):
+    """Get the path a vhost is saved to."""
+    return os.path.join(config["conf_dir"], name + ".conf")
+
+
+def data_digest(data):
+    """Get the sha1 hex digest of a loaded config or template."""
+    import hashlib
+    import json
+
+    content = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def vhost_digest(vhost):
+    """Get the sha1 hex digest of a rendered vhost, as saved by save_vhost()."""
+    import hashlib
+
+    return hashlib.sha1(vhost.encode("utf-8")).hexdigest()
+
+
+def file_digest(path):
+    """Get the sha1 hex digest of a file or None if it does not exist."""
+    import hashlib
+
+    try:
+        with open(path, "rb") as stream:
+            return hashlib.sha1(stream.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+def save_vhost(config, name, vhost):
+    """
+    Write the generated vhost into conf_dir, unless the file on disk already
+    has the exact same content.
+
+    Returns the save status (created, updated or unchanged) on success.
+    """
+    return save_vhost_path(get_vhost_path(config, name), vhost)
+
+
+def save_vhost_path(vhost_path, vhost):
+    """Write a generated vhost to vhost_path, unless it is unchanged."""
+    import hashlib
+
+    content = vhost.encode("utf-8")
+
+    current = file_digest(vhost_path)
+    if current == hashlib.sha1(content).hexdigest():
+        return (True, STATUS_UNCHANGED, "")
+
+    succ, err = write_file(vhost_path, content)
+    if not succ:
+        return (False, "", "[ERR] Cannot write vhost: " + err)
+
+    if current is None:
+        return (True, STATUS_CREATED, "")
+    return (True, STATUS_UPDATED, "")
+
+
+def save_snippets(fragments):
+    """
+    Write the shared snippets (vhost.snippets) the vhosts rendered with
+    fragments include, once per loaded config. Snippets are named by the
+    digest of their content, so an existing one is never rewritten.
+    """
+    if fragments.snippets_saved:
+        return (True, "")
+
+    snippets = vhost_get_snippets(fragments.config, fragments.tpl)
+    for path in sorted(snippets):
+        if os.path.exists(path):
+            continue
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    return (False, "[ERR] Cannot create directory: " + str(err))
+        succ, err = write_file(path, snippets[path].encode("utf-8"))
+        if not succ:
+            return (False, "[ERR] Cannot write snippet: " + err)
+
+    fragments.snippets_saved = True
+    return (True, "")
+
+
+def save_vhost_pair(saves):
+    """
+    Write a list of (config, name, vhost) together, e.g. a backend vhost and
+    its front proxy vhost: either all changed vhosts are written or none.
+    Changed vhosts are written to temporary files first and then renamed
+    over their destinations. If a rename fails, the ones renamed before are
+    restored (see rollback_vhost_pair()). All conf_dirs are locked meanwhile.
+
+    Returns the list of save statuses (created, updated or unchanged).
+    """
+    import tempfile
+
+    locks = []
+    staged = []
+    try:
+        for conf_dir in sorted(set(config["conf_dir"] for config, _, _ in saves)):
+            locks.append(lock_dir(conf_dir))
+
+        statuses = []
+        for config, name, vhost in saves:
+            path = get_vhost_path(config, name)
+            content = vhost.encode("utf-8")
+            try:
+                with open(path, "rb") as stream:
+                    previous = stream.read()
+            except (IOError, OSError):
+                previous = None
+            if previous == content:
+                statuses.append(STATUS_UNCHANGED)
+                continue
+
+            fd, tmp = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".",
+                                       suffix=".tmp", dir=config["conf_dir"])
+            staged.append((tmp, path, name, previous))
+            with os.fdopen(fd, "wb") as stream:
+                stream.write(content)
+                stream.flush()
+                os.fsync(stream.fileno())
+            os.chmod(tmp, 0o644)
+            statuses.append(STATUS_CREATED if previous is None else STATUS_UPDATED)
+    except (IOError, OSError) as err:
+        errors = rollback_vhost_pair(staged, 0)
+        for lock in locks:
+            unlock_dir(lock)
+        return (False, [], rollback_error("[ERR] Cannot write vhost: " + str(err),
+                                          errors))
+
+    try:
+        for index, (tmp, path, _, _) in enumerate(staged):
+            try:
+                os.replace(tmp, path)
+            except OSError as err:
+                errors = rollback_vhost_pair(staged, index)
+                return (False, [], rollback_error("[ERR] Cannot write vhost: "
+                                                  + str(err), errors))
+    finally:
+        for lock in locks:
+            unlock_dir(lock)
+
+    return (True, statuses, "")
+
+
+def rollback_vhost_pair(staged, index):
+    """
+    Undo a failed save_vhost_pair(): remove the temporary files of the
+    staged (tmp, path, name, previous content) tuples from index on and
+    restore the vhosts renamed before. Returns the list of errors of what
+    could not be undone.
+    """
+    errors = []
+    for tmp, _, name, _ in staged[index:]:
+        succ, err = remove_vhost_path(tmp, name)
+        if not succ:
+            errors.append(error_message(err))
+    for _, path, name, previous in staged[:index]:
+        if previous is None:
+            succ, err = remove_vhost_path(path, name)
+        else:
+            succ, err = write_file(path, previous)
+        if not succ:
+            errors.append("Cannot restore %s: %s" % (path, error_message(err)))
+    return errors
+
+
+def rollback_error(err, errors):
+    """Add the errors of a failed rollback to the error which caused it."""
+    if not errors:
+        return err
+    return err + " (rollback failed: " + "; ".join(errors) + ")"
+
+
+def is_bundle_path(path):
+    """Check if a vhost path is a bundle or the mass hosting file (or a disabled one)."""
+    return bool(get_regex(BUNDLE_REGEX).match(os.path.basename(path)))
+
+
+def get_bundle_path(config, name, shards):
+    """Get the bundle file of a vhost, it only depends on the name and shards."""
+    import hashlib
+
+    shard = int(hashlib.sha1(name.encode("utf-8")).hexdigest()[:8], 16) % shards
+    return os.path.join(config["conf_dir"], "%s%d.conf" % (BUNDLE_PREFIX, shard))
+
+
+def read_bundle_parts(path):
+    """
+    Read a bundle file as (head, {name: vhost}, tail), where head and tail
+    are the fixed content around the sections (see BUNDLE_SECTIONS). All
+    of them are empty if the file is missing. A section without its end
+    marker, or content outside of the sections (other than head and tail),
+    would be lost when the bundle is written again, so it is an error.
+
+    Returns (succ, (head, sections, tail), err).
+    """
+    sections = dict()
+    try:
+        with open(path, "rb") as stream:
+            content = stream.read().decode("utf-8")
+    except (IOError, OSError):
+        return (True, ("", sections, ""), "")
+
+    head, sep, content = content.partition(BUNDLE_SECTIONS)
+    if sep:
+        head += sep
+    else:
+        head, content = "", head
+
+    name = None
+    lines = []
+    tail = []
+    outside = "[ERR] Malformed bundle %s: line %d is outside of any section"
+    for number, line in enumerate(content.splitlines(True), head.count("\n") + 1):
+        if name is None:
+            if line.startswith(BUNDLE_BEGIN):
+                # The tail only follows the last section
+                if tail:
+                    return (False, None, outside % (path, number - len(tail)))
+                name = line[len(BUNDLE_BEGIN):].strip()
+                lines = []
+            elif sep:
+                tail.append(line)
+            else:
+                return (False, None, outside % (path, number))
+        elif line.startswith(BUNDLE_BEGIN):
+            return (False, None, "[ERR] Malformed bundle %s: section %s has no"
+                    " end marker" % (path, name))
+        elif line.rstrip("\n") == BUNDLE_END + name:
+            sections[name] = "".join(lines)
+            name = None
+        else:
+            lines.append(line)
+    if name is not None:
+        return (False, None, "[ERR] Malformed bundle %s: section %s has no end"
+                " marker" % (path, name))
+    return (True, (head, sections, "".join(tail)), "")
+
+
+def read_bundle(path):
+    """Read the sections of a bundle file, returns (succ, {name: vhost}, err)."""
+    succ, parts, err = read_bundle_parts(path)
+    return (succ, parts[1] if succ else None, err)
+
+
+def write_bundle(path, sections, head="", tail=""):
+    """
+    Atomically write the sections of a bundle file, sorted by name so the
+    file is stable, between head and tail. An empty bundle is removed.
+    """
+    if not sections and not head and not tail:
+        try:
+            os.remove(path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                return (False, str(err))
+        return (True, "")
+
+    parts = [head]
+    for name in sorted(sections):
+        parts.append(BUNDLE_BEGIN + name + "\n" + sections[name]
+                     + BUNDLE_END + name + "\n")
+    parts.append(tail)
+    return write_file(path, "".join(parts).encode("utf-8"))
+
+
+def save_bundle_vhosts(items):
+    """
+    Add or replace the sections of a list of (bundle path, name, vhost)
+    items. Every bundle is read and (if any of its sections changed)
+    written once, other bundles are not touched. The conf_dir is locked
+    meanwhile.
+
+    Returns the list of save statuses (created, updated or unchanged).
+    """
+    try:
+        locks = [lock_dir(directory) for directory in
+                 sorted(set(os.path.dirname(path) for path, _, _ in items))]
+    except (IOError, OSError) as err:
+        return (False, [], "[ERR] Cannot lock conf_dir: " + str(err))
+    try:
+        return save_bundle_vhosts_locked(items)
+    finally:
+        for lock in locks:
+            unlock_dir(lock)
+
+
+def save_bundle_vhosts_locked(items):
+    """Save bundle sections, the caller must hold the conf_dir lock."""
+    bundles = dict()
+    statuses = []
+    for path, name, vhost in items:
+        if path not in bundles:
+            succ, parts, err = read_bundle_parts(path)
+            if not succ:
+                return (False, [], err)
+            bundles[path] = parts + (set(),)
+        _, sections, _, changed = bundles[path]
+        if not vhost.endswith("\n"):
+            vhost += "\n"
+        current = sections.get(name)
+        if current == vhost:
+            statuses.append(STATUS_UNCHANGED)
+            continue
+        sections[name] = vhost
+        changed.add(name)
+        statuses.append(STATUS_CREATED if current is None else STATUS_UPDATED)
+
+    for path, (head, sections, tail, changed) in bundles.items():
+        if not changed:
+            continue
+        succ, err = write_bundle(path, sections, head, tail)
+        if not succ:
+            return (False, [], "[ERR] Cannot write bundle: " + err)
+    return (True, statuses, "")
+
+
+def remove_bundle_vhosts(path, names):
+    """Remove the sections of vhosts from a bundle file, returns (succ, err)."""
+    try:
+        lock = lock_dir(os.path.dirname(path))
+    except (IOError, OSError) as err:
+        return (False, "[ERR] Cannot lock conf_dir: " + str(err))
+    try:
+        succ, parts, err = read_bundle_parts(path)
+        if not succ:
+            return (False, err)
+        head, sections, tail = parts
+        if not any(name in sections for name in names):
+            return (True, "")
+        for name in names:
+            sections.pop(name, None)
+        succ, err = write_bundle(path, sections, head, tail)
+    finally:
+        unlock_dir(lock)
+    if not succ:
+        return (False, "[ERR] Cannot write bundle: " + err)
+    return (True, "")
+
+
+def remove_vhost_path(path, name):
+    """Remove a vhost file, or its section if path is a bundle, returns (succ, err)."""
+    if is_bundle_path(path):
+        return remove_bundle_vhosts(path, [name])
+    try:
+        os.remove(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            return (False, "[ERR] Cannot remove vhost: " + str(err))
+    return (True, "")
+
+
+def remove_vhost(inventory, name, docroot):
+    """
+    Remove a saved vhost (its file, or its section of a bundle or the mass
+    hosting file), but only if it serves the given document root: as its
+    inventory entry says or, for a vhost file missing from the inventory,
+    as its content says. Returns the removed path (None if the vhost was
+    left alone) on success.
+    """
+    succ, entries, err = inventory.entries(name)
+    if not succ:
+        return (False, None, "[ERR] " + err)
+    if entries:
+        spec = entries[0]["spec"]
+        if (spec["docroot"] is None
+                or os.path.normpath(spec["docroot"]) != os.path.normpath(docroot)):
+            return (True, None, "")
+        succ, _, err = inventory.remove(name)
+        return (succ, entries[0]["path"] if succ else None, err)
+
+    config = inventory.config
+    vhost_path = get_vhost_path(config, name)
+    try:
+        with open(vhost_path, "rb") as stream:
+            content = stream.read().decode("utf-8", "replace")
+    except (IOError, OSError):
+        return (True, None, "")
+
+    docroot_path = vhost_get_docroot_path(config, docroot, None)
+    if '"' + docroot_path + '"' not in content:
+        return (True, None, "")
+
+    try:
+        os.remove(vhost_path)
+    except OSError as err:
+        return (False, None, "[ERR] Cannot remove vhost: " + str(err))
+    return (True, vhost_path, "")
+
+
 def apply_log_settings(config):
     """
     This function will apply various settings for the log defines, including
     creating the directory itself as well as handling log file output (access
     and error) to stderr/stdout.
+
+    The shared symlinks and log directory are handled while holding a lock
+    on conf_dir, so parallel runs do not race on them.
     """
+    try:
+        lock = lock_dir(config["conf_dir"])
+    except (IOError, OSError) as err:
+        return (False, "[ERR] Cannot lock conf_dir: " + str(err))
+
+    try:
+        return apply_log_settings_locked(config)
+    finally:
+        unlock_dir(lock)
+
+
+def apply_log_settings_locked(config):
+    """Apply log settings, the caller must hold the conf_dir lock."""
     # Symlink stdout to access logfile
     if config["vhost"]["log"]["access"]["stdout"]:
         succ, err = symlink("/dev/stdout", STDOUT_ACCESS, force=True)
@@ -936,92 +2463,2918 @@ def apply_log_settings(config):
             try:
                 os.makedirs(config["vhost"]["log"]["dir"]["path"])
             except OSError as err:
-                return (False, "[ERR] Cannot create directory: " + str(err))
+                if err.errno != errno.EEXIST:
+                    return (False, "[ERR] Cannot create directory: " + str(err))
 
     return (True, None)
 
 
+def run_reload_cmd(command):
+    """Run the command reloading the web server, returns if it succeeded."""
+    import shlex
+    import subprocess
+
+    try:
+        code = subprocess.call(shlex.split(command))
+    except OSError as err:
+        code = str(err)
+    if code != 0:
+        print("[ERR] Reload command failed: %s" % (code), file=sys.stderr)
+    return code == 0
+
+
 ############################################################
-# Main Function
+# Mass hosting Functions
 ############################################################
 
 
-def main(argv):
-    """Main entrypoint."""
+def is_mass_vhost(config, spec):
+    """
+    Check if a vhost spec can be served by the mass hosting server block:
+    a plain http vhost with a document root which is not the default one.
+    Apache finds the document root by the host name, so it also has to be
+    <vhost.mass.docroot>/<name>.
+    """
+    if (spec["proxy"] is not None or spec["mode"] not in (None, "plain")
+            or spec["default"]):
+        return False
+    if MASS[config["server"]]["docroot"] is not None:
+        return True
+    name = (to_str(config["vhost"]["name"]["prefix"]) + spec["name"]
+            + to_str(config["vhost"]["name"]["suffix"]))
+    docroot = os.path.join(vhost_get_mass_docroot(config), name)
+    return name == name.lower() and os.path.normpath(spec["docroot"]) == docroot
 
-    # Get command line arguments
-    (
-        config_path,
-        tpl_dir,
-        o_tpl_dir,
-        docroot,
-        proxy,
-        mode,
-        location,
-        name,
-        default,
-        save,
-        verbose,
-    ) = parse_args(argv)
-
-    # Validate command line arguments This will abort the program on error
-    # This will abort the program on error
-    validate_args_req(name, docroot, proxy, mode, location)
-    validate_args_opt(config_path, tpl_dir)
 
-    # Load config
-    succ, config, err = load_config(config_path)
-    if not succ:
-        print("[ERR] Error loading config", err, file=sys.stderr)
+def is_mass_path(path):
+    """Check if a vhost path is the (enabled) mass hosting file."""
+    return os.path.basename(path) == MASS_NAME + ".conf"
+
+
+def get_mass_path(config):
+    """Get the path of the mass hosting file."""
+    return os.path.join(config["conf_dir"], MASS_NAME + ".conf")
+
+
+def get_mass_entry(ctx):
+    """Get the map entry (nginx) or ServerAlias (apache) of a mass hosted vhost."""
+    mass = MASS[ctx.config["server"]]
+    name = ctx.server_name
+    if name.lower() in mass["keywords"]:
+        name = "\\" + name
+    return mass["entry"] % {"name": name, "docroot": ctx.docroot_path}
+
+
+def get_mass_frame(config, template, fragments):
+    """
+    Get the content before and after the entries of the mass hosting file:
+    the server block serving every host of the file from its document
+    root, rendered like a plain vhost, and the map around the entries if
+    the server looks the document root up in one.
+    """
+    mass = MASS[config["server"]]
+    docroot = mass["docroot"] or vhost_get_mass_docroot(config)
+    ctx = VhostContext(config, MASS_NAME, docroot, None, "plain", None, False)
+    ctx.server_name = mass["server_name"]
+    ctx.docroot_path = docroot
+    directives = mass["directives"] % {
+        "docroot": vhost_get_docroot_path(config, os.path.join(docroot, "%0"), None)
+    }
+    if mass["map"] is None:
+        # The entries go right into the server block
+        server = get_vhost_plain(ctx, template, fragments,
+                                 directives + BUNDLE_SECTIONS)
+        head, _, tail = server.partition(str_indent(BUNDLE_SECTIONS, 4))
+        return (head + BUNDLE_SECTIONS, tail)
+    server = get_vhost_plain(ctx, template, fragments, directives)
+    return (mass["map"][0] + BUNDLE_SECTIONS, mass["map"][1] + server)
+
+
+def save_mass_frame(config, template, fragments):
+    """
+    Write the map and server block of the mass hosting file around its
+    current map entries, unless they are unchanged.
+
+    Returns the save status (created, updated or unchanged) on success.
+    """
+    path = get_mass_path(config)
+    head, tail = get_mass_frame(config, template, fragments)
+    try:
+        lock = lock_dir(config["conf_dir"])
+    except (IOError, OSError) as err:
+        return (False, "", "[ERR] Cannot lock conf_dir: " + str(err))
+    try:
+        succ, parts, err = read_bundle_parts(path)
+        if not succ:
+            return (False, "", err)
+        current_head, sections, current_tail = parts
+        if (current_head, current_tail) == (head, tail):
+            return (True, STATUS_UNCHANGED, "")
+        succ, err = write_bundle(path, sections, head, tail)
+    finally:
+        unlock_dir(lock)
+    if not succ:
+        return (False, "", "[ERR] Cannot write vhost: " + err)
+    return (True, STATUS_UPDATED if current_head else STATUS_CREATED, "")
+
+
+############################################################
+# Inventory Functions
+############################################################
+
+
+class Inventory(object):
+    """
+    Index of every vhost saved to conf_dir (its spec, path, content digest
+    and the digests of the config and template sections it was rendered
+    from), kept in conf_dir/.vhost-gen.sqlite. Listing, looking up, removing,
+    disabling, enabling and regenerating vhosts use the index instead of
+    scanning conf_dir.
+
+    The database is opened on first use and kept open.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        # A staged config (see StagedConfDir) writes files to the staging
+        # directory, but its inventory is the one of the live conf_dir
+        self.conf_dir = config.get("live_conf_dir", config["conf_dir"])
+        self.db = None
+
+    def path(self, name):
+        """Get the live path of the vhost name."""
+        return os.path.join(self.conf_dir, name + ".conf")
+
+    def open(self):
+        """Open (and create) the index database."""
+        if self.db is None:
+            import sqlite3
+
+            # The daemon uses it from the thread of each connection, one
+            # request at a time
+            db = sqlite3.connect(
+                os.path.join(self.conf_dir, INVENTORY_FILE),
+                timeout=DAEMON_TIMEOUT,
+                check_same_thread=False,
+            )
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS vhosts ("
+                " name TEXT PRIMARY KEY,"
+                " spec TEXT NOT NULL,"
+                " path TEXT NOT NULL,"
+                " digest TEXT NOT NULL,"
+                " config_digest TEXT NOT NULL,"
+                " template_digest TEXT NOT NULL,"
+                " enabled INTEGER NOT NULL,"
+                " updated REAL NOT NULL)"
+            )
+            self.db = db
+        return self.db
+
+    def close(self):
+        """Close the index database."""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def run(self, func, *args):
+        """Run func(db, *args) in a transaction and return (succ, data, err)."""
+        import sqlite3
+
+        try:
+            db = self.open()
+            with db:
+                return (True, func(db, *args), "")
+        except sqlite3.Error as err:
+            return (False, None, "Inventory error: " + str(err))
+
+    def local_path(self, path):
+        """Get where a live vhost path is written to (see StagedConfDir)."""
+        return os.path.join(self.config["conf_dir"], os.path.basename(path))
+
+    def touch(self, names):
+        """Note the entries a staged batch changes (see StagedConfDir.abort())."""
+        touched = self.config.get("stage_touched")
+        if touched is not None:
+            touched.update(names)
+
+    def record(self, fragments, saved, bundles=None):
+        """
+        Add or update the index entries of a list of (spec, digest) pairs of
+        saved vhosts, bundles maps the names of vhosts saved to a bundle to
+        its path. Saving a disabled vhost enables it again, so its disabled
+        copy is removed, as is the previous copy of a vhost which moved into
+        or out of a bundle. They are only removed once the entries are
+        committed, so a failed update never points at a removed file.
+        """
+        import json
+        import time
+
+        now = time.time()
+        bundles = bundles or dict()
+        self.touch(spec["name"] for spec, _ in saved)
+        stale = []
+
+        def insert(db):
+            del stale[:]
+            rows = []
+            for spec, digest in saved:
+                name = spec["name"]
+                if name in bundles:
+                    path = os.path.join(self.conf_dir, os.path.basename(bundles[name]))
+                else:
+                    path = self.path(name)
+                previous = db.execute("SELECT path, enabled FROM vhosts WHERE name = ?",
+                                      (name,)).fetchone()
+                if previous is not None and (previous[0] != path or not previous[1]):
+                    suffix = "" if previous[1] else DISABLED_SUFFIX
+                    stale.append((self.local_path(previous[0]) + suffix, name))
+                config_digest, template_digest = fragments.dependencies(spec)
+                rows.append((name, json.dumps(spec, sort_keys=True), path,
+                             digest, config_digest, template_digest, 1, now))
+            db.executemany(
+                "INSERT OR REPLACE INTO vhosts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows)
+
+        succ, _, err = self.run(insert)
+        if not succ:
+            return (False, err)
+        for path, name in stale:
+            succ, err = remove_vhost_path(path, name)
+            if not succ:
+                print("[WARN]", error_message(err), file=sys.stderr)
+        return (True, "")
+
+    def update(self, rendered):
+        """
+        Update the path and digests of a list of (name, path, digest,
+        config_digest, template_digest) tuples of regenerated vhosts,
+        keeping them enabled or disabled.
+        """
+        import time
+
+        now = time.time()
+        self.touch(item[0] for item in rendered)
+        succ, _, err = self.run(
+            lambda db: db.executemany(
+                "UPDATE vhosts SET path = ?, digest = ?, config_digest = ?,"
+                " template_digest = ?, updated = ? WHERE name = ?",
+                [(os.path.join(self.conf_dir, os.path.basename(path)), digest,
+                  config_digest, template_digest, now, name)
+                 for name, path, digest, config_digest, template_digest
+                 in rendered]))
+        return (succ, err)
+
+    def forget(self, names):
+        """Remove the index entries of vhosts removed from conf_dir."""
+        self.touch(names)
+        succ, _, err = self.run(
+            lambda db: db.executemany("DELETE FROM vhosts WHERE name = ?",
+                                      [(name,) for name in names]))
+        return (succ, err)
+
+    def entries(self, name=None):
+        """Get all index entries (or the one of name) as dicts."""
+        import json
+
+        def select(db):
+            query = ("SELECT name, spec, path, digest, config_digest,"
+                     " template_digest, enabled, updated FROM vhosts")
+            if name is None:
+                rows = db.execute(query + " ORDER BY name")
+            else:
+                rows = db.execute(query + " WHERE name = ?", (name,))
+            return [{
+                "name": row[0],
+                "spec": json.loads(row[1]),
+                "path": row[2],
+                "digest": row[3],
+                "config_digest": row[4],
+                "template_digest": row[5],
+                "enabled": bool(row[6]),
+                "updated": row[7],
+            } for row in rows]
+
+        return self.run(select)
+
+    def count(self):
+        """Get the number of enabled vhosts."""
+        return self.run(lambda db: db.execute(
+            "SELECT COUNT(*) FROM vhosts WHERE enabled = 1").fetchone()[0])
+
+    def entry(self, name):
+        """Get the index entry of name, it is an error if there is none."""
+        succ, entries, err = self.entries(name)
+        if succ and not entries:
+            return (False, None, "Not in inventory: " + name)
+        return (succ, entries[0] if succ else None, err)
+
+    def remove(self, name):
+        """Remove a vhost (enabled or disabled) and its index entry."""
+        return self.remove_many([name])[name]
+
+    def remove_many(self, names):
+        """
+        Remove a list of vhosts (enabled or disabled) and their index entries,
+        rewriting each bundle they are in only once. Returns {name: (succ,
+        status, err)}.
+        """
+        results = dict()
+        files = dict()
+        for name in names:
+            succ, entry, err = self.entry(name)
+            if not succ:
+                results[name] = (False, "", err)
+                continue
+            files.setdefault(self.local_path(entry["path"]), []).append(name)
+
+        for path, group in sorted(files.items()):
+            for target in (path, path + DISABLED_SUFFIX):
+                if is_bundle_path(target):
+                    succ, err = remove_bundle_vhosts(target, group)
+                else:
+                    succ, err = remove_vhost_path(target, group[0])
+                if not succ:
+                    break
+            if succ:
+                succ, err = self.forget(group)
+            for name in group:
+                results[name] = (succ, STATUS_REMOVED if succ else "", err)
+        return results
+
+    def set_enabled(self, name, enabled):
+        """
+        Disable a vhost by renaming it to <path>.disabled (or by moving its
+        section to the <path>.disabled bundle), or enable it again.
+        """
+        return self.set_enabled_many([name], enabled)[name]
+
+    def set_enabled_many(self, names, enabled):
+        """
+        Disable or enable a list of vhosts like set_enabled(), moving the
+        sections of each bundle they are in at once. Returns {name: (succ,
+        status, err)}.
+        """
+        status = STATUS_ENABLED if enabled else STATUS_DISABLED
+        results = dict()
+        files = dict()
+        for name in names:
+            succ, entry, err = self.entry(name)
+            if not succ:
+                results[name] = (False, "", err)
+            elif entry["enabled"] == enabled:
+                results[name] = (True, STATUS_UNCHANGED, "")
+            else:
+                files.setdefault(self.local_path(entry["path"]), []).append(name)
+
+        for path, group in sorted(files.items()):
+            src, dst = path, path + DISABLED_SUFFIX
+            if enabled:
+                src, dst = dst, src
+            succ, err = move_vhosts(src, dst, group)
+            if succ:
+                self.touch(group)
+                succ, _, err = self.run(
+                    lambda db: db.executemany(
+                        "UPDATE vhosts SET enabled = ? WHERE name = ?",
+                        [(int(enabled), name) for name in group]))
+            for name in group:
+                results[name] = (succ, status if succ else "", err)
+        return results
+
+
+def move_vhosts(src, dst, names):
+    """
+    Rename the vhost file src to dst or, if src is a bundle, move the
+    sections of names from it to the bundle dst. Returns (succ, err).
+    """
+    if not is_bundle_path(src):
+        try:
+            os.replace(src, dst)
+        except OSError as err:
+            return (False, "[ERR] Cannot rename vhost: " + str(err))
+        return (True, "")
+
+    succ, sections, err = read_bundle(src)
+    if not succ:
+        return (False, err)
+    missing = [name for name in names if name not in sections]
+    if missing:
+        return (False, "[ERR] Not in bundle %s: %s" % (src, ", ".join(missing)))
+    succ, _, err = save_bundle_vhosts([(dst, name, sections[name]) for name in names])
+    if not succ:
+        return (False, err)
+    return remove_bundle_vhosts(src, names)
+
+
+def check_docroot(path):
+    """Get why a document root makes its vhost an orphan, or None."""
+    if os.path.isdir(path):
+        return None
+    return "document root does not exist: " + path
+
+
+def check_backend(addr, port, timeout):
+    """Get why a reverse proxy backend makes its vhost an orphan, or None."""
+    import socket
+
+    try:
+        socket.create_connection((addr, port), timeout).close()
+    except socket.gaierror as err:
+        return "backend does not resolve: %s (%s)" % (addr, err.strerror)
+    except (socket.timeout, OSError) as err:
+        return "backend unreachable: %s:%s (%s)" % (addr, port, err)
+    return None
+
+
+def find_orphans(entries, workers=GC_WORKERS, timeout=GC_TIMEOUT):
+    """
+    Check the document root (stat) or reverse proxy backend (DNS lookup and
+    TCP connect) of every inventory entry with a pool of worker threads.
+    Entries sharing a document root or backend are checked only once.
+
+    Returns a list of (entry, reason) pairs of the orphaned vhosts.
+    """
+    import queue
+    import threading
+    import time
+
+    checks = dict()
+    for entry in entries:
+        spec = entry["spec"]
+        if spec["proxy"] is None:
+            key = (spec["docroot"],)
+        else:
+            _, addr, port = vhost_get_proxy_parts(spec["proxy"])
+            key = (addr, int(port))
+        checks.setdefault(key, []).append(entry)
+
+    tasks = queue.Queue()
+    for key in checks:
+        tasks.put(key)
+    results = queue.Queue()
+
+    def work():
+        while True:
+            try:
+                key = tasks.get_nowait()
+            except queue.Empty:
+                return
+            if len(key) == 1:
+                results.put((key, check_docroot(key[0])))
+            else:
+                results.put((key, check_backend(key[0], key[1], timeout)))
+
+    # DNS lookups cannot be timed out, so the workers are daemon threads
+    # which do not keep the process alive, and probes still running once
+    # every round of workers had its time are given up
+    for _ in range(min(workers, len(checks))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+    deadline = time.time() + timeout * (-(-len(checks) // workers) + 1)
+
+    reasons = dict()
+    while len(reasons) < len(checks):
+        try:
+            key, reason = results.get(timeout=max(0, deadline - time.time()))
+        except queue.Empty:
+            break
+        reasons[key] = reason
+    for key in checks:
+        if key not in reasons and len(key) == 1:
+            reasons[key] = "document root check timed out: %s" % key
+        elif key not in reasons:
+            reasons[key] = "backend check timed out: %s:%s" % key
+
+    orphans = []
+    for key, group in checks.items():
+        if reasons[key] is not None:
+            orphans.extend((entry, reasons[key]) for entry in group)
+    orphans.sort(key=lambda orphan: orphan[0]["name"])
+    return orphans
+
+
+def gc_request(inventory, action=None):
+    """
+    Find the orphaned vhosts of the inventory (see find_orphans()) and
+    disable or remove them if an action is given. Returns the response (as
+    used by the daemon protocol).
+    """
+    succ, entries, err = inventory.entries()
+    if not succ:
+        return {"ok": False, "error": err}
+    entries = [entry for entry in entries if entry["enabled"]]
+
+    found = find_orphans(entries)
+    # Each bundle is rewritten once for all of its orphans
+    names = [entry["name"] for entry, _ in found]
+    results = dict()
+    if action == "remove":
+        results = inventory.remove_many(names)
+    elif action == "disable":
+        results = inventory.set_enabled_many(names, False)
+
+    orphans = []
+    for entry, reason in found:
+        orphan = {"name": entry["name"], "reason": reason, "status": None,
+                  "error": None}
+        if action is not None:
+            succ, orphan["status"], err = results[entry["name"]]
+            if not succ:
+                orphan["status"] = None
+                orphan["error"] = error_message(err)
+        orphans.append(orphan)
+    return {"ok": True, "checked": len(entries), "orphans": orphans}
+
+
+def print_gc_response(response, action):
+    """
+    Print the orphaned vhosts of a gc response, exits on errors.
+    Returns if any vhost was disabled or removed.
+    """
+    if not response.get("ok"):
+        print("[ERR]", response.get("error"), file=sys.stderr)
+        sys.exit(1)
+
+    changed = False
+    failed = 0
+    for orphan in response["orphans"]:
+        if orphan["error"] is not None:
+            failed += 1
+            print("[FAIL] %s: %s (%s)" % (orphan["name"], orphan["error"],
+                                          orphan["reason"]))
+            continue
+        status = orphan["status"] or "orphan"
+        changed = changed or status in (STATUS_DISABLED, STATUS_REMOVED)
+        print("%-10s %s: %s" % (status, orphan["name"], orphan["reason"]))
+    print("vhostgen: %d vhosts checked, %d orphaned, %d failed"
+          % (response["checked"], len(response["orphans"]), failed))
+    if action is not None:
+        print("reload: %s" % ("yes" if changed else "no"))
+    if failed:
+        sys.exit(1)
+    return changed
+
+
+def inventory_request(inventory, op, name):
+    """
+    Run an inventory operation (list, show, remove, disable or enable) and
+    get its response (as used by the daemon protocol).
+    """
+    if op == "list":
+        succ, entries, err = inventory.entries()
+        if not succ:
+            return {"ok": False, "error": err}
+        return {"ok": True, "entries": entries}
+
+    if name is None:
+        return {"ok": False, "error": "Missing vhost name for: " + op}
+    if op == "show":
+        succ, entry, err = inventory.entry(name)
+        if not succ:
+            return {"ok": False, "error": err}
+        return {"ok": True, "entry": entry}
+
+    succ, entry, err = inventory.entry(name)
+    if not succ:
+        return {"ok": False, "error": err}
+    if op == "remove":
+        succ, status, err = inventory.remove(name)
+    else:
+        succ, status, err = inventory.set_enabled(name, op == "enable")
+    if not succ:
+        return {"ok": False, "error": error_message(err)}
+    return {"ok": True, "status": status, "path": entry["path"]}
+
+
+def print_inventory_response(op, response):
+    """Print the response of an inventory operation, exits on errors."""
+    import json
+    import time
+
+    if not response.get("ok"):
+        print("[ERR]", response.get("error"), file=sys.stderr)
+        sys.exit(1)
+
+    if op == "list":
+        for entry in response["entries"]:
+            spec = entry["spec"]
+            print("%-30s %-8s %-5s %-40s %s" % (
+                entry["name"],
+                STATUS_ENABLED if entry["enabled"] else STATUS_DISABLED,
+                spec["mode"] or "plain",
+                spec["docroot"] or spec["proxy"],
+                time.strftime("%Y-%m-%d %H:%M:%S",
+                              time.localtime(entry["updated"])),
+            ))
+    elif op == "show":
+        print(json.dumps(response["entry"], indent=2, sort_keys=True))
+    else:
+        print(response["status"], response["path"])
+
+
+############################################################
+# Stage Functions
+############################################################
+
+
+def is_vhost_file(name):
+    """Check if a conf_dir entry is an (enabled or disabled) vhost file."""
+    return not name.startswith(".") and (
+        name.endswith(".conf") or name.endswith(".conf" + DISABLED_SUFFIX))
+
+
+class StagedConfDir(object):
+    """
+    A staging copy of conf_dir, so a batch of vhosts can be rendered,
+    validated as a whole and only then made live.
+
+    open() locks conf_dir, creates the staging directory inside it with a
+    hard link of every vhost file and backs up the inventory. Everything
+    saved with the staged config (see config) goes to the staging directory,
+    the inventory entries keep their live paths. check() runs a validation
+    command on the staging directory, commit() moves every changed, added
+    or removed vhost file into conf_dir (the server only reads them on its
+    next reload) and abort() discards the staging directory and restores
+    the inventory entries the batch changed.
+
+    Single saves do not wait for the lock, so only files the batch wrote
+    (whose inode differs from the one linked) are moved into conf_dir, only
+    files which were linked into the staging directory and removed by the
+    batch are removed from conf_dir, and only the entries the batch changed
+    are restored.
+    """
+
+    def __init__(self, config):
+        self.live = config
+        self.config = None
+        self.dir = None
+        self.lock = None
+        # Inodes of the vhost files linked into the staging directory
+        self.linked = dict()
+        # Names of the inventory entries changed by the batch (see Inventory)
+        self.touched = set()
+
+    def open(self):
+        """Create the staging directory, returns (succ, err)."""
+        import sqlite3
+        import tempfile
+
+        conf_dir = self.live["conf_dir"]
+        succ, err = check_conf_dir(self.live)
+        if not succ:
+            return (False, err)
+        try:
+            self.lock = lock_dir(conf_dir)
+            self.dir = tempfile.mkdtemp(prefix=STAGE_PREFIX, dir=conf_dir)
+            for name in os.listdir(conf_dir):
+                if is_vhost_file(name):
+                    path = os.path.join(self.dir, name)
+                    os.link(os.path.join(conf_dir, name), path)
+                    self.linked[name] = os.stat(path).st_ino
+        except (IOError, OSError) as err:
+            self.close()
+            return (False, "[ERR] Cannot stage conf_dir: " + str(err))
+
+        backup = sqlite3.connect(os.path.join(self.dir, INVENTORY_FILE))
+        inventory = Inventory(self.live)
+        succ, _, err = inventory.run(lambda db: db.backup(backup))
+        inventory.close()
+        backup.close()
+        if not succ:
+            self.close()
+            return (False, err)
+
+        self.config = dict(self.live, conf_dir=self.dir,
+                           live_conf_dir=conf_dir, stage_touched=self.touched)
+        return (True, "")
+
+    def live_path(self, path):
+        """Get the live path of a path inside the staging directory."""
+        return os.path.join(self.live["conf_dir"], os.path.relpath(path, self.dir))
+
+    def check(self, command):
+        """
+        Run the validation command, with {} replaced by the staging
+        directory, and return if it succeeded.
+        """
+        import shlex
+        import subprocess
+
+        argv = [arg.replace("{}", self.dir) for arg in shlex.split(command)]
+        try:
+            code = subprocess.call(argv)
+        except OSError as err:
+            code = str(err)
+        if code != 0:
+            print("[ERR] Check command failed: %s" % (code), file=sys.stderr)
+        return code == 0
+
+    def commit(self):
+        """
+        Move every vhost file the batch wrote into conf_dir and remove the
+        ones the batch removed, then clean up. Files the batch did not write
+        are left alone, even if a single save changed the live one meanwhile.
+        Returns (succ, number of changed files, err).
+        """
+        conf_dir = self.live["conf_dir"]
+        changed = 0
+        try:
+            staged = set(name for name in os.listdir(self.dir) if is_vhost_file(name))
+            for name in sorted(staged):
+                path = os.path.join(self.dir, name)
+                if self.linked.get(name) == os.stat(path).st_ino:
+                    continue
+                os.replace(path, os.path.join(conf_dir, name))
+                changed += 1
+            for name in sorted(set(self.linked) - staged):
+                try:
+                    os.remove(os.path.join(conf_dir, name))
+                except OSError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+                changed += 1
+        except OSError as err:
+            self.close()
+            return (False, changed, "[ERR] Cannot swap staged vhosts: " + str(err))
+        self.close()
+        return (True, changed, "")
+
+    def abort(self):
+        """
+        Discard the staging directory and restore the inventory entries the
+        batch changed.
+        """
+        import sqlite3
+
+        names = [(name,) for name in sorted(self.touched)]
+        backup = sqlite3.connect(os.path.join(self.dir, INVENTORY_FILE))
+        try:
+            rows = []
+            for name in names:
+                rows.extend(backup.execute("SELECT * FROM vhosts WHERE name = ?",
+                                           name).fetchall())
+        except sqlite3.Error as err:
+            rows = None
+            succ, err = False, "Inventory error: " + str(err)
+        finally:
+            backup.close()
+
+        if rows is not None:
+            def restore(db):
+                db.executemany("DELETE FROM vhosts WHERE name = ?", names)
+                db.executemany("INSERT INTO vhosts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               rows)
+
+            inventory = Inventory(self.live)
+            succ, _, err = inventory.run(restore)
+            inventory.close()
+        if not succ:
+            print("[WARN]", err, file=sys.stderr)
+        self.close()
+
+    def close(self):
+        """Remove the staging directory and unlock conf_dir."""
+        import shutil
+
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+        if self.lock is not None:
+            unlock_dir(self.lock)
+            self.lock = None
+
+
+def finish_stage(stage, args):
+    """
+    Validate the staging directory with --check-cmd and swap it live, or
+    discard it if the check failed. Exits on failures.
+    """
+    if args["check_cmd"] is not None and not stage.check(args["check_cmd"]):
+        stage.abort()
+        print("[ERR] Staged vhosts failed the check, conf_dir is unchanged",
+              file=sys.stderr)
+        sys.exit(1)
+
+    succ, _, err = stage.commit()
+    if not succ:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+
+
+############################################################
+# Profile Functions
+############################################################
+
+
+def process_uptime():
+    """Get the seconds since this process was started (Linux only) or None."""
+    try:
+        with open("/proc/self/stat", "r") as stream:
+            stat = stream.read()
+        with open("/proc/uptime", "r") as stream:
+            uptime = float(stream.read().split()[0])
+        # Field 22 (starttime), counted from the field after the command name
+        ticks = int(stat.rsplit(")", 1)[1].split()[19])
+        return uptime - float(ticks) / os.sysconf("SC_CLK_TCK")
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def profile_clock():
+    """Get the current (wall, CPU) time."""
+    import time
+
+    return (time.perf_counter(), time.process_time())
+
+
+def percentile(values, pct):
+    """Get the nearest-rank percentile of an already sorted list."""
+    rank = int(len(values) * pct / 100.0 + 0.999999)
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class ProfilePhase(object):
+    """Context manager adding the wall and CPU time of its block to a phase."""
+
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = profile_clock()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add_since(self.name, self.start)
+        # Phases aborting with an error (e.g. validate_args) count as one
+        if isinstance(exc[1], VhostGenError) or (
+                isinstance(exc[1], SystemExit) and exc[1].code):
+            self.profiler.count("errors", self.name)
+        return False
+
+
+class NullPhase(object):
+    """Context manager of a disabled PhaseProfiler, doing nothing."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class PhaseProfiler(object):
+    """
+    Collect wall and CPU time samples per phase (load_config, render, write, ...)
+    and event counters over a whole run, batch or daemon lifetime.
+    Disabled profilers record nothing.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.samples = dict()
+        self.counters = dict()
+        self.observations = dict()
+
+    def phase(self, name):
+        """Get a context manager timing its block as one sample of name."""
+        if not self.enabled:
+            return NULL_PHASE
+        return ProfilePhase(self, name)
+
+    def add(self, name, wall, cpu):
+        """Add a single sample to a phase."""
+        if self.enabled:
+            self.samples.setdefault(name, []).append((wall, cpu))
+
+    def add_since(self, name, start):
+        """Add the time passed since start (from profile_clock()) to a phase."""
+        if self.enabled:
+            wall, cpu = profile_clock()
+            self.add(name, wall - start[0], cpu - start[1])
+
+    def count(self, name, label="", value=1):
+        """Add to an event counter, e.g. ("errors", "load_config")."""
+        if self.enabled:
+            key = (name, label)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def merge(self, samples, counters, observations):
+        """Add the samples and counters collected by another (worker) profiler."""
+        if not self.enabled:
+            return
+        for name, values in samples.items():
+            self.samples.setdefault(name, []).extend(values)
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for name, values in observations.items():
+            self.observations.setdefault(name, []).extend(values)
+
+    def drain(self):
+        """
+        Get the samples, counters and observations collected so far and start
+        over, so a daemon only keeps what was not written to --metrics yet.
+        """
+        drained = (self.samples, self.counters, self.observations)
+        self.samples = dict()
+        self.counters = dict()
+        self.observations = dict()
+        return drained
+
+    def count_save(self, status, vhost):
+        """Count a save status and the size of every vhost actually written."""
+        if self.enabled:
+            self.count("saved", status)
+            if status in (STATUS_CREATED, STATUS_UPDATED):
+                self.observations.setdefault("output_bytes", []).append(
+                    len(vhost.encode("utf-8")))
+
+    def add_startup(self, start):
+        """
+        Add the interpreter startup up to start (from profile_clock()), i.e. before
+        vhost-gen could measure anything itself.
+        """
+        if not self.enabled:
+            return
+        uptime = process_uptime()
+        if uptime is not None:
+            uptime -= profile_clock()[0] - start[0]
+        self.add("startup", uptime, start[1])
+
+    def report(self):
+        """Get the per-phase timing table in milliseconds."""
+        lines = [
+            "%-18s %7s %10s %9s %9s %9s %9s %10s"
+            % ("phase", "count", "wall", "p50", "p90", "p99", "max", "cpu")
+        ]
+        for name, samples in self.samples.items():
+            walls = sorted(wall for wall, _ in samples if wall is not None)
+            cpu = sum(cpu for _, cpu in samples)
+            if not walls:
+                lines.append("%-18s %7d %10s %9s %9s %9s %9s %10.3f"
+                             % (name, len(samples), "-", "-", "-", "-", "-",
+                                cpu * 1000))
+                continue
+            lines.append(
+                "%-18s %7d %10.3f %9.3f %9.3f %9.3f %9.3f %10.3f"
+                % (name, len(samples), sum(walls) * 1000,
+                   percentile(walls, 50) * 1000, percentile(walls, 90) * 1000,
+                   percentile(walls, 99) * 1000, walls[-1] * 1000, cpu * 1000)
+            )
+        return os.linesep.join(lines)
+
+    def print_report(self):
+        """Print the timing table to stderr, if enabled and anything was measured."""
+        if self.enabled and self.samples:
+            print("vhostgen: profile (ms)", file=sys.stderr)
+            print(self.report(), file=sys.stderr)
+
+
+NULL_PHASE = NullPhase()
+NULL_PROFILER = PhaseProfiler(False)
+
+
+############################################################
+# Metrics Functions
+############################################################
+
+# Histogram buckets of the Prometheus metrics
+METRICS_RENDER_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                          0.025, 0.05, 0.1)
+METRICS_LOAD_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                        1.0, 2.5)
+METRICS_BYTES_BUCKETS = (512, 1024, 2048, 4096, 8192, 16384, 32768, 65536,
+                         131072, 262144)
+
+
+def read_metrics(path):
+    """
+    Read the samples of a previously written metrics file as {key: value},
+    so counters and histograms keep counting across runs.
+    """
+    samples = dict()
+    try:
+        with open(path, "r") as stream:
+            for line in stream:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                key, value = line.rsplit(" ", 1)
+                samples[key] = float(value)
+    except (IOError, OSError, ValueError):
+        return dict()
+    return samples
+
+
+def metrics_histogram(name, labels, values, buckets):
+    """Get the (key, value) samples of a histogram over values."""
+    samples = []
+    for bound in buckets:
+        samples.append(('%s_bucket{%sle="%s"}' % (name, labels, bound),
+                        len([value for value in values if value <= bound])))
+    samples.append(('%s_bucket{%sle="+Inf"}' % (name, labels), len(values)))
+    labels = "{" + labels.rstrip(",") + "}" if labels else ""
+    samples.append(("%s_sum%s" % (name, labels), sum(values)))
+    samples.append(("%s_count%s" % (name, labels), len(values)))
+    return samples
+
+
+def metrics_conf_dir(config):
+    """
+    Get the number of enabled vhosts of the inventory (a bundle or the mass
+    hosting file holds many) and the total size of the vhost files in
+    conf_dir.
+    """
+    size = 0
+    try:
+        for name in os.listdir(config["conf_dir"]):
+            if name.endswith(".conf"):
+                size += os.path.getsize(os.path.join(config["conf_dir"], name))
+    except OSError:
+        return (None, None)
+    if not os.path.isfile(os.path.join(config["conf_dir"], INVENTORY_FILE)):
+        return (0, size)
+    inventory = Inventory(config)
+    succ, count, _ = inventory.count()
+    inventory.close()
+    return (count if succ else None, size)
+
+
+def write_metrics(path, profiler, config):
+    """
+    Atomically write the run (or daemon lifetime) collected by profiler as
+    Prometheus textfile metrics. Counters and histograms are added to the
+    current samples of the file, gauges are replaced. What profiler collected
+    is drained once written (see PhaseProfiler.drain()), so every call only
+    adds the increments since the last one and a daemon's memory stays
+    flat. The directory of the file is locked meanwhile, so parallel runs do
+    not lose each other's increments.
+    """
+    try:
+        lock = lock_dir(os.path.dirname(os.path.abspath(path)))
+    except (IOError, OSError) as err:
+        print("[WARN] Cannot lock metrics:", err, file=sys.stderr)
+        return
+    try:
+        write_metrics_locked(path, profiler, config)
+    finally:
+        unlock_dir(lock)
+
+
+def write_metrics_locked(path, profiler, config):
+    """Write the metrics file, see write_metrics()."""
+    import time
+
+    previous = read_metrics(path)
+    drained = profiler.drain()
+    samples, counters, observations = drained
+
+    def walls(phase):
+        return [wall for wall, _ in samples.get(phase, [])]
+
+    kinds = set(label for name, label in counters if name == "errors")
+    for key in previous:
+        if key.startswith('vhost_gen_errors_total{kind="'):
+            kinds.add(key.split('"')[1])
+
+    # (name, type, help, [(key, value), ...])
+    families = [
+        ("vhost_gen_vhosts_rendered_total", "counter", "Vhosts rendered.",
+         [("vhost_gen_vhosts_rendered_total", len(walls("render")))]),
+        ("vhost_gen_vhosts_saved_total", "counter", "Vhosts saved by status.",
+         [('vhost_gen_vhosts_saved_total{status="%s"}' % (status),
+           counters.get(("saved", status), 0))
+          for status in (STATUS_CREATED, STATUS_UPDATED, STATUS_UNCHANGED,
+                         STATUS_REMOVED)]),
+        ("vhost_gen_errors_total", "counter", "Errors by kind.",
+         [('vhost_gen_errors_total{kind="%s"}' % (kind),
+           counters.get(("errors", kind), 0))
+          for kind in sorted(kinds)]),
+        ("vhost_gen_render_seconds", "histogram", "Time to render a vhost.",
+         metrics_histogram("vhost_gen_render_seconds", "", walls("render"),
+                           METRICS_RENDER_BUCKETS)),
+        ("vhost_gen_load_seconds", "histogram",
+         "Time to load the config or template.",
+         metrics_histogram("vhost_gen_load_seconds", 'kind="config",',
+                           walls("load_config"), METRICS_LOAD_BUCKETS)
+         + metrics_histogram("vhost_gen_load_seconds", 'kind="template",',
+                             walls("load_template"), METRICS_LOAD_BUCKETS)),
+        ("vhost_gen_output_bytes", "histogram", "Size of every vhost written.",
+         metrics_histogram("vhost_gen_output_bytes", "",
+                           observations.get("output_bytes", []),
+                           METRICS_BYTES_BUCKETS)),
+    ]
+    families = [
+        (name, kind, text,
+         [(key, value + previous.get(key, 0)) for key, value in values])
+        for name, kind, text, values in families
+    ]
+
+    count, size = (None, None) if config is None else metrics_conf_dir(config)
+    if count is not None:
+        families.append(("vhost_gen_conf_dir_vhosts", "gauge",
+                         "Enabled vhosts in the conf_dir inventory.",
+                         [("vhost_gen_conf_dir_vhosts", count)]))
+    if size is not None:
+        families.append(("vhost_gen_conf_dir_bytes", "gauge",
+                         "Total size of the vhost files in conf_dir.",
+                         [("vhost_gen_conf_dir_bytes", size)]))
+    families.append(("vhost_gen_last_run_timestamp_seconds", "gauge",
+                     "Time of the last vhost-gen run.",
+                     [("vhost_gen_last_run_timestamp_seconds", time.time())]))
+
+    lines = []
+    for name, kind, text, values in families:
+        lines.append("# HELP %s %s" % (name, text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for key, value in values:
+            lines.append("%s %s" % (key, int(value) if value == int(value) else value))
+    content = "\n".join(lines) + "\n"
+
+    succ, err = write_file(path, content.encode("utf-8"))
+    if not succ:
+        # Keep the increments for the next try
+        profiler.merge(*drained)
+        print("[WARN] Cannot write metrics:", err, file=sys.stderr)
+
+
+############################################################
+# Library API
+############################################################
+
+
+class VhostGenError(Exception):
+    """Base class of all errors raised by vhost-gen."""
+
+
+class ArgumentError(VhostGenError):
+    """Invalid command line arguments or vhost spec."""
+
+
+class ConfigError(VhostGenError):
+    """The config file cannot be loaded or is invalid."""
+
+
+class TemplateError(VhostGenError):
+    """The template cannot be loaded or compiled."""
+
+
+class SaveError(VhostGenError):
+    """A vhost cannot be written to conf_dir or its log settings applied."""
+
+
+class FrozenDict(dict):
+    """A dict which cannot be modified, see freeze()."""
+
+    __slots__ = ()
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Loaded config and template are immutable")
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(data):
+    """
+    Get a deep copy of loaded yaml data which cannot be modified: dicts
+    become FrozenDicts and lists become tuples. Both still serialize to
+    the same json, so digests do not change.
+    """
+    if isinstance(data, dict):
+        return FrozenDict((key, freeze(value)) for key, value in data.items())
+    if isinstance(data, list):
+        return tuple(freeze(value) for value in data)
+    return data
+
+
+def error_message(err):
+    """Strip the [ERR] prefix the tuple returning helpers put on messages."""
+    if err.startswith("[ERR] "):
+        return err[len("[ERR] "):]
+    return err
+
+
+class VhostGen(object):
+    """
+    A loaded, validated and compiled config/template pair (see load()),
+    rendering and saving any number of vhosts. Instances are immutable,
+    and so are their config and template (see freeze()).
+
+    A vhost spec is a mapping with the keys name, docroot or proxy, location,
+    mode and default (same meaning as -n, -p, -r, -l, -m and -d).
+    """
+
+    __slots__ = ("config", "template", "fragments", "inventory")
+
+    def __init__(self, config, template):
+        config = freeze(config)
+        template = freeze(template)
+        object.__setattr__(self, "config", config)
+        object.__setattr__(self, "template", template)
+        object.__setattr__(self, "fragments", FragmentCache(config, template))
+        object.__setattr__(self, "inventory", Inventory(config))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("VhostGen objects are immutable")
+
+    def context(self, spec):
+        """Validate a vhost spec and get its VhostContext, raises ArgumentError."""
+        vhost, err, _ = check_manifest_entry(spec)
+        if err is not None:
+            raise ArgumentError(err)
+        return VhostContext(self.config, vhost["name"], vhost["docroot"],
+                            vhost["proxy"], vhost["mode"], vhost["location"],
+                            vhost["default"])
+
+    def render(self, spec):
+        """Render a vhost spec, raises ArgumentError."""
+        return get_vhost(self.context(spec), self.template, self.fragments)
+
+    def prepare(self, spec, mass=False):
+        """
+        Validate and render a vhost spec for write() and return its
+        VhostContext, the rendered vhost and whether it is mass hosted:
+        with mass, a vhost the mass hosting server block can serve (see
+        is_mass_vhost()) is rendered as its map entry. Raises ArgumentError.
+        """
+        ctx = self.context(spec)
+        mass = mass and is_mass_vhost(self.config, ctx.spec())
+        if mass:
+            return (ctx, get_mass_entry(ctx), True)
+        return (ctx, get_vhost(ctx, self.template, self.fragments), False)
+
+    def path(self, name):
+        """Get the path the vhost name is saved to."""
+        return get_vhost_path(self.config, name)
+
+    def write(self, name, vhost, spec=None, bundle=None, mass=False):
+        """
+        Write a rendered vhost to conf_dir (unless unchanged) and return
+        the save status and path, raises SaveError. When its spec is given,
+        the vhost is also recorded in the conf_dir inventory. With bundle
+        (a number of shards), it is saved as a section of its bundle. With
+        mass, vhost is its map entry (see get_mass_entry()) and is saved as
+        a section of the mass hosting file, whose server block is updated
+        first.
+        """
+        if mass and self.config["server"] not in MASS:
+            raise ArgumentError("Mass hosting is not supported for "
+                                + self.config["server"])
+        succ, err = check_conf_dir(self.config)
+        if succ:
+            succ, err = save_snippets(self.fragments)
+        if not succ:
+            raise SaveError(error_message(err))
+        frame = STATUS_UNCHANGED
+        if mass:
+            succ, frame, err = save_mass_frame(self.config, self.template,
+                                               self.fragments)
+            if not succ:
+                raise SaveError(error_message(err))
+            path = get_mass_path(self.config)
+        elif bundle is not None:
+            path = get_bundle_path(self.config, name, bundle)
+        bundles = dict()
+        if mass or bundle is not None:
+            bundles[name] = path
+            succ, statuses, err = save_bundle_vhosts([(path, name, vhost)])
+            status = statuses[0] if succ else None
+        else:
+            path = self.path(name)
+            succ, status, err = save_vhost(self.config, name, vhost)
+        if not succ:
+            raise SaveError(error_message(err))
+        if status == STATUS_UNCHANGED and frame != STATUS_UNCHANGED:
+            status = STATUS_UPDATED
+        if spec is not None:
+            succ, err = self.inventory.record(self.fragments,
+                                              [(spec, vhost_digest(vhost))], bundles)
+            if not succ:
+                print("[WARN]", err, file=sys.stderr)
+        return (status, path)
+
+    def apply_log_settings(self):
+        """Create the log directory and stdout/stderr symlinks, raises SaveError."""
+        succ, err = apply_log_settings(self.config)
+        if not succ:
+            raise SaveError(error_message(err))
+
+    def save(self, spec, log_settings=True, bundle=None, mass=False):
+        """
+        Render and write a vhost spec and return the save status and path,
+        raises ArgumentError or SaveError. When saving many vhosts, pass
+        log_settings=False and call apply_log_settings() once at the end.
+        With mass, a vhost the mass hosting server block can serve (see
+        is_mass_vhost()) is only added to its map.
+        """
+        ctx, vhost, mass = self.prepare(spec, mass)
+        status, path = self.write(ctx.name, vhost, ctx.spec(), bundle, mass)
+        if log_settings:
+            self.apply_log_settings()
+        return (status, path)
+
+    def regenerate(self, bundle=None, mass=False):
+        """
+        Regenerate every vhost of the conf_dir inventory whose config or
+        template sections changed and return the list of per-vhost results
+        (see regenerate_vhosts()), raises SaveError.
+        """
+        if mass and self.config["server"] not in MASS:
+            raise ArgumentError("Mass hosting is not supported for "
+                                + self.config["server"])
+        results, err = regenerate_vhosts(self.config, self.template,
+                                         self.fragments, self.inventory,
+                                         bundle=bundle, mass=mass)
+        if err is not None:
+            raise SaveError(error_message(err))
+        return results
+
+
+def load(config_path=CONFIG_PATH, tpl_dir=TEMPLATE_DIR, o_tpl_dir=None,
+         cache_dir=CACHE_DIR, profiler=NULL_PROFILER, defaults=False):
+    """
+    Load, validate and compile config and template and return them as
+    a VhostGen object, raises ConfigError or TemplateError. A missing
+    config file is an error, unless defaults is set (as on the command
+    line), which uses the default config instead.
+    """
+    if not defaults and not os.path.isfile(config_path):
+        raise ConfigError("Config file not found: " + config_path)
+
+    with profiler.phase("load_config"):
+        succ, config, err = load_config(config_path, cache_dir)
+        if not succ:
+            raise ConfigError("Error loading config " + err)
+        validate_config(config)
+
+    with profiler.phase("load_template"):
+        if not os.path.isdir(tpl_dir):
+            raise TemplateError("Template path does not exist: " + tpl_dir)
+        succ, template, err = load_template(tpl_dir, o_tpl_dir, config["server"],
+                                            cache_dir)
+        if not succ:
+            raise TemplateError("Error loading template " + err)
+
+    return VhostGen(config, template)
+
+
+############################################################
+# Daemon Functions
+############################################################
+
+
+class VhostDaemon(object):
+    """
+    Keeps config and template loaded between requests and reloads them
+    as soon as one of their files changes.
+
+    Every connection is served by its own thread, the requests are handled
+    one at a time (see lock).
+    """
+
+    def __init__(self, args, profiler=NULL_PROFILER):
+        import threading
+
+        self.lock = threading.Lock()
+        self.args = args
+        self.profiler = profiler
+        self.vg = None
+        self.config = None
+        self.template = None
+        self.fragments = None
+        self.inventory = None
+        self.signature = None
+
+    def sources(self):
+        """Get all files config and template are loaded from."""
+        paths = [self.args["config_path"]]
+        if self.config is not None:
+            tpl_name = TEMPLATES[self.config["server"]]
+            paths.append(os.path.join(self.args["tpl_dir"], tpl_name))
+            if self.args["o_tpl_dir"] is not None:
+                paths.append(os.path.join(self.args["o_tpl_dir"], tpl_name))
+        return paths
+
+    def get_signature(self):
+        """Get a cheap (stat only) signature of all source files."""
+        signature = []
+        for path in self.sources():
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_mtime, stat.st_size))
+            except OSError:
+                signature.append((path, None, None))
+        return tuple(signature)
+
+    def load(self):
+        """(Re)load config and template if any of their files changed."""
+        if self.config is not None and self.signature == self.get_signature():
+            return (True, "")
+
+        try:
+            vg = load(self.args["config_path"], self.args["tpl_dir"],
+                      self.args["o_tpl_dir"], self.args["cache_dir"],
+                      self.profiler, defaults=True)
+        except VhostGenError as err:
+            return (False, str(err))
+        if self.args["mass"] and vg.config["server"] not in MASS:
+            vg.inventory.close()
+            return (False, "--mass is not supported for " + vg.config["server"])
+
+        self.vg = vg
+        self.config = vg.config
+        self.template = vg.template
+        self.fragments = vg.fragments
+        if self.inventory is not None:
+            self.inventory.close()
+        self.inventory = vg.inventory
+        self.signature = self.get_signature()
+        if self.args["verbose"]:
+            print("vhostgen: [%s] Loaded config and template"
+                  % (log_time()), file=sys.stderr)
+        return (True, "")
+
+    def handle(self, request):
+        """Handle a single request and return the response."""
+        if not isinstance(request, dict):
+            return {"ok": False, "error": "Request must be a JSON object"}
+
+        if request.get("op") == "ping":
+            return {"ok": True}
+        if request.get("op") == "batch":
+            return self.handle_batch(request)
+        if request.get("op") == "regenerate":
+            succ, err = self.load()
+            if not succ:
+                return {"ok": False, "error": err}
+            results, err = regenerate_vhosts(self.config, self.template,
+                                             self.fragments, self.inventory,
+                                             self.profiler, self.args["bundle"],
+                                             self.args["mass"])
+            if err is not None:
+                return {"ok": False, "error": err}
+            return {"ok": True, "results": results}
+        if request.get("op") == "gc":
+            if request.get("action") not in (None,) + GC_ACTIONS:
+                return {"ok": False, "error": "Invalid gc action: %s"
+                        % (to_str(request.get("action")))}
+            succ, err = self.load()
+            if not succ:
+                return {"ok": False, "error": err}
+            return gc_request(self.inventory, request.get("action"))
+        if request.get("op") in INVENTORY_OPS:
+            succ, err = self.load()
+            if not succ:
+                return {"ok": False, "error": err}
+            return inventory_request(self.inventory, request["op"],
+                                     request.get("name"))
+        if request.get("op") not in ("render", "save"):
+            return {"ok": False,
+                    "error": "Invalid op: %s" % (to_str(request.get("op")))}
+
+        vhost, err, warnings = check_manifest_entry(request.get("vhost"))
+        if err is not None:
+            self.profiler.count("errors", "manifest_entry")
+            return {"ok": False, "error": err, "warnings": warnings}
+
+        succ, err = self.load()
+        if not succ:
+            return {"ok": False, "error": err, "warnings": warnings}
+
+        save = request["op"] == "save"
+        try:
+            with self.profiler.phase("render"):
+                ctx, output, mass = self.vg.prepare(vhost, save and self.args["mass"])
+        except ArgumentError as err:
+            self.profiler.count("errors", "manifest_entry")
+            return {"ok": False, "error": str(err), "warnings": warnings}
+        if self.args["verbose"]:
+            print("vhostgen: [%s] %s: %s"
+                  % (log_time(),
+                     request["op"].capitalize(), ctx.vhost_name),
+                  file=sys.stderr)
+
+        if not save:
+            return {"ok": True, "vhost": output, "warnings": warnings}
+
+        try:
+            with self.profiler.phase("write"):
+                status, path = self.vg.write(ctx.name, output, ctx.spec(),
+                                             self.args["bundle"], mass)
+        except VhostGenError as err:
+            self.profiler.count("errors", "write")
+            return {"ok": False, "error": str(err), "warnings": warnings}
+        self.profiler.count_save(status, output)
+        try:
+            with self.profiler.phase("apply_log_settings"):
+                self.vg.apply_log_settings()
+        except SaveError as err:
+            self.profiler.count("errors", "apply_log_settings")
+            return {"ok": False, "error": str(err), "warnings": warnings}
+
+        return {"ok": True, "status": status, "path": path, "warnings": warnings}
+
+    def handle_batch(self, request):
+        """Handle a batch request of a manifest path or content."""
+        if request.get("content") is not None:
+            succ, entries, err = parse_manifest(to_str(request["content"]))
+        else:
+            succ, entries, err = load_manifest(to_str(request.get("manifest")))
+        if not succ:
+            self.profiler.count("errors", "load_manifest")
+            return {"ok": False, "error": "Error loading manifest " + err}
+
+        succ, err = self.load()
+        if not succ:
+            return {"ok": False, "error": err}
+
+        results, err = run_batch(self.config, self.template, self.fragments,
+                                 entries, bool(request.get("save")),
+                                 self.args["verbose"], self.profiler,
+                                 self.args["jobs"], self.args["bundle"],
+                                 self.args["mass"])
+        if err is not None:
+            return {"ok": False, "error": err}
+        return {"ok": True, "results": results}
+
+    def handle_connection(self, conn):
+        """Answer every newline delimited JSON request of a connection."""
+        import json
+        import socket
+
+        conn.settimeout(DAEMON_TIMEOUT)
+        stream = conn.makefile("rwb")
+        try:
+            for line in stream:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                except ValueError as err:
+                    response = {"ok": False, "error": "Invalid JSON: " + str(err)}
+                else:
+                    with self.lock:
+                        response = self.handle(request)
+                stream.write(json.dumps(response).encode("utf-8") + b"\n")
+                stream.flush()
+        except (IOError, OSError, socket.timeout):
+            pass
+        finally:
+            stream.close()
+            conn.close()
+
+
+def open_unix_socket(path):
+    """Bind a listening unix socket, replacing a stale socket file."""
+    import socket
+
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except (IOError, OSError):
+            os.remove(path)
+        else:
+            return (False, None, "Daemon already listening on: " + path)
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+        os.chmod(path, 0o660)
+        server.listen(64)
+    except (IOError, OSError) as err:
+        server.close()
+        return (False, None, str(err))
+    return (True, server, "")
+
+
+def serve(args, profiler=NULL_PROFILER):
+    """
+    Run the daemon until it receives SIGINT or SIGTERM, serving every
+    connection in its own thread.
+    """
+    import signal
+    import threading
+
+    daemon = VhostDaemon(args, profiler)
+    succ, err = daemon.load()
+    if not succ:
+        print("[ERR]", err, file=sys.stderr)
         sys.exit(1)
 
-    # Load template
-    succ, template, err = load_template(tpl_dir, o_tpl_dir, config["server"])
+    succ, server, err = open_unix_socket(args["serve"])
     if not succ:
-        print("[ERR] Error loading template", err, file=sys.stderr)
+        print("[ERR] Cannot listen on socket:", err, file=sys.stderr)
         sys.exit(1)
 
-    # Validate configuration file
-    # This will abort the program on error
-    validate_config(config)
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
 
-    # Retrieve fully build vhost
-    vhost = get_vhost(config, template, docroot, proxy, mode, location, name,
-                      default)
+    signal.signal(signal.SIGTERM, stop)
+    if args["verbose"]:
+        print("vhostgen: [%s] Listening on %s"
+              % (log_time(), args["serve"]),
+              file=sys.stderr)
+    def serve_connection(conn):
+        daemon.handle_connection(conn)
+        if args["metrics"] is not None:
+            with daemon.lock:
+                write_metrics(args["metrics"], profiler, daemon.config)
 
-    if verbose:
-        print(
-            "vhostgen: [%s] Adding: %s"
-            % (
-                time.strftime("%Y-%m-%d %H:%M:%S"),
-                to_str(config["vhost"]["name"]["prefix"])
-                + name
-                + to_str(config["vhost"]["name"]["suffix"]),
-            )
-        )
+    try:
+        while True:
+            conn, _ = server.accept()
+            thread = threading.Thread(target=serve_connection, args=(conn,))
+            thread.daemon = True
+            thread.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(args["serve"])
+
+
+def daemon_request(path, request):
+    """Send a single request to a vhost-gen daemon and return its response."""
+    import json
+    import socket
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(DAEMON_TIMEOUT)
+    try:
+        client.connect(path)
+        client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    except (IOError, OSError, socket.timeout) as err:
+        return (False, dict(), "Cannot talk to daemon at %s: %s" % (path, err))
+    finally:
+        client.close()
 
-    if save:
-        if not os.path.isdir(config["conf_dir"]):
-            print("[ERR] output conf_dir does not exist:", config["conf_dir"],
-                  file=sys.stderr)
+    try:
+        return (True, json.loads(data.decode("utf-8")), "")
+    except ValueError:
+        return (False, dict(), "Invalid response from daemon at " + path)
+
+
+def main_client_batch(args, profiler):
+    """Generate all vhosts of a manifest through a running vhost-gen daemon."""
+    request = {"op": "batch", "manifest": args["manifest"],
+               "save": bool(args["save"])}
+    # The daemon cannot read our stdin, send the manifest itself instead
+    if args["manifest"] == "-":
+        request["content"] = sys.stdin.read()
+
+    with profiler.phase("request"):
+        succ, response, err = daemon_request(args["connect"], request)
+    if not succ:
+        profiler.count("errors", "request")
+        print("[ERR]", err, file=sys.stderr)
+        sys.exit(1)
+    if not response.get("ok"):
+        print("[ERR]", response.get("error"), file=sys.stderr)
+        sys.exit(1)
+
+    if print_batch_results(response["results"], args["save"]):
+        sys.exit(1)
+
+
+def main_client_stream(args, profiler):
+    """Stream a NDJSON manifest through a running vhost-gen daemon."""
+    import json
+    import socket
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(DAEMON_TIMEOUT)
+    try:
+        client.connect(args["connect"])
+    except (IOError, OSError) as err:
+        client.close()
+        profiler.count("errors", "request")
+        print("[ERR] Cannot talk to daemon at %s: %s" % (args["connect"], err),
+              file=sys.stderr)
+        sys.exit(1)
+
+    stream = client.makefile("rwb")
+    op = "save" if args["save"] else "render"
+
+    def handle(entry):
+        with profiler.phase("request"):
+            try:
+                stream.write(json.dumps({"op": op, "vhost": entry}).encode("utf-8")
+                             + b"\n")
+                stream.flush()
+                response = json.loads(stream.readline().decode("utf-8"))
+            except (IOError, OSError, ValueError, socket.timeout) as err:
+                profiler.count("errors", "request")
+                raise VhostGenError("Cannot talk to daemon at %s: %s"
+                                    % (args["connect"], err))
+        if not response.get("ok"):
+            raise VhostGenError(response.get("error"))
+        if args["save"]:
+            return ({"status": response["status"], "path": response["path"]}, None)
+        return ({"vhost": response["vhost"]}, None)
+
+    try:
+        main_stream(args, handle, profiler)
+    finally:
+        stream.close()
+        client.close()
+
+
+def main_client(args, profiler=NULL_PROFILER):
+    """Generate a single vhost through a running vhost-gen daemon."""
+    if args["inventory"] is not None:
+        with profiler.phase("request"):
+            succ, response, err = daemon_request(
+                args["connect"],
+                {"op": args["inventory"], "name": args["inventory_name"]})
+        if not succ:
+            profiler.count("errors", "request")
+            print("[ERR]", err, file=sys.stderr)
+            sys.exit(1)
+        print_inventory_response(args["inventory"], response)
+        return
+    if args["gc"]:
+        with profiler.phase("request"):
+            succ, response, err = daemon_request(
+                args["connect"], {"op": "gc", "action": args["gc_action"]})
+        if not succ:
+            profiler.count("errors", "request")
+            print("[ERR]", err, file=sys.stderr)
+            sys.exit(1)
+        print_gc_response(response, args["gc_action"])
+        return
+    if args["regenerate"]:
+        with profiler.phase("request"):
+            succ, response, err = daemon_request(args["connect"],
+                                                 {"op": "regenerate"})
+        if not succ or not response.get("ok"):
+            profiler.count("errors", "request")
+            print("[ERR]", err or response.get("error"), file=sys.stderr)
             sys.exit(1)
-        if not os.access(config["conf_dir"], os.W_OK):
+        if print_regenerate_results(response["results"]):
+            sys.exit(1)
+        return
+    if args["ndjson"]:
+        main_client_stream(args, profiler)
+        return
+    if args["manifest"] is not None:
+        main_client_batch(args, profiler)
+        return
+
+    request = {
+        "op": "save" if args["save"] else "render",
+        "vhost": {
+            "name": args["name"],
+            "docroot": args["docroot"],
+            "proxy": args["proxy"],
+            "location": args["location"],
+            "mode": args["mode"],
+            "default": args["default"],
+        },
+    }
+    with profiler.phase("request"):
+        succ, response, err = daemon_request(args["connect"], request)
+    if not succ:
+        profiler.count("errors", "request")
+        print("[ERR]", err, file=sys.stderr)
+        sys.exit(1)
+
+    for warning in response.get("warnings", []):
+        print("[WARN]", warning, file=sys.stderr)
+    if not response.get("ok"):
+        print("[ERR]", response.get("error"), file=sys.stderr)
+        sys.exit(1)
+
+    if args["save"]:
+        print(response["status"], response["path"])
+    else:
+        print(response["vhost"])
+
+
+############################################################
+# Watch Functions
+############################################################
+
+# inotify(7) constants
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+def inotify_watch(path):
+    """
+    Watch a directory for created, deleted and moved entries with inotify.
+    Returns the inotify file descriptor or None if inotify is not available.
+    """
+    try:
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+        if libc.inotify_add_watch(fd, path.encode("utf-8"), mask) < 0:
+            os.close(fd)
+            return None
+    except (ImportError, OSError, AttributeError):
+        return None
+    return fd
+
+
+def inotify_read(fd):
+    """
+    Read all pending inotify events. Returns the set of changed directory
+    names, or None if the event queue overflowed and a rescan is needed.
+    """
+    import struct
+
+    names = set()
+    while True:
+        try:
+            data = os.read(fd, 65536)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return names
+            raise
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = struct.unpack_from("iIII", data, offset)
+            offset += 16
+            name = data[offset:offset + length].rstrip(b"\0").decode("utf-8")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_ISDIR:
+                names.add(name)
+
+
+def watch_list_sites(path):
+    """Get the names of all site directories below path."""
+    try:
+        entries = os.listdir(path)
+    except OSError:
+        return set()
+    return set(name for name in entries
+               if os.path.isdir(os.path.join(path, name)))
+
+
+def watch_inventory_sites(daemon, path):
+    """
+    Get the names of the inventory vhosts of site directories below path,
+    whether the directories still exist or not.
+    """
+    succ, entries, err = daemon.inventory.entries()
+    if not succ:
+        print("[WARN]", err, file=sys.stderr)
+        return set()
+    path = os.path.normpath(path)
+    return set(entry["name"] for entry in entries
+               if entry["spec"]["docroot"] is not None
+               and os.path.normpath(entry["spec"]["docroot"])
+               == os.path.join(path, entry["name"]))
+
+
+def watch_spec(daemon, args, name, docroot):
+    """
+    Get the spec to save the vhost name with for the site directory docroot,
+    or None if it must be left alone. A new vhost is saved with the mode of
+    --watch, a vhost of the inventory keeps its stored spec (mode, location,
+    default), but only if it has that document root and is enabled. A vhost
+    file missing from the inventory is only overwritten if its content has
+    that document root.
+    """
+    spec = {"name": name, "docroot": docroot, "mode": args["mode"]}
+    succ, entries, _ = daemon.inventory.entries(name)
+    if succ and entries:
+        stored = entries[0]["spec"]
+        if (not entries[0]["enabled"] or stored["docroot"] is None
+                or os.path.normpath(stored["docroot"]) != os.path.normpath(docroot)):
+            return None
+        return stored
+
+    vhost_path = get_vhost_path(daemon.config, name)
+    try:
+        with open(vhost_path, "rb") as stream:
+            content = stream.read().decode("utf-8", "replace")
+    except (IOError, OSError):
+        return spec
+    docroot_path = vhost_get_docroot_path(daemon.config, docroot, None)
+    return spec if '"' + docroot_path + '"' in content else None
+
+
+def watch_sync(daemon, args, names):
+    """
+    Add, update or remove the vhosts of the given site directories
+    (depending on whether they still exist) as one batch.
+    """
+    succ, err = daemon.load()
+    if not succ:
+        print("[ERR]", err, file=sys.stderr)
+        return
+
+    entries = []
+    removed = 0
+    for name in sorted(names):
+        # Skip hidden directories and names vhost-gen does not accept
+        if name.startswith(".") or check_args_req(name, "/", None, None, None)[0]:
+            continue
+        docroot = os.path.join(args["watch"], name)
+
+        if not os.path.isdir(docroot):
+            succ, path, err = remove_vhost(daemon.inventory, name, docroot)
+            if not succ:
+                daemon.profiler.count("errors", "remove")
+                print(err, file=sys.stderr)
+            elif path is not None:
+                daemon.profiler.count("saved", STATUS_REMOVED)
+                removed += 1
+                print("%s %s" % (STATUS_REMOVED, path))
+            continue
+
+        # Never overwrite vhosts which were not generated for this directory
+        spec = watch_spec(daemon, args, name, docroot)
+        if spec is None:
+            if args["verbose"]:
+                print("[WARN] %s: not managed by --watch, skipping" % (name),
+                      file=sys.stderr)
+            continue
+        entries.append(spec)
+
+    results, err = run_batch(daemon.config, daemon.template, daemon.fragments,
+                             entries, True, args["verbose"], daemon.profiler,
+                             args["jobs"], args["bundle"], args["mass"])
+    if err is not None:
+        print(err, file=sys.stderr)
+    changed = removed
+    for result in results:
+        if result["error"] is not None:
+            print("[FAIL] %s: %s" % (result["label"], result["error"]),
+                  file=sys.stderr)
+        elif result["status"] != STATUS_UNCHANGED:
+            changed += 1
+            print("%s %s" % (result["status"], result["path"]))
+    sys.stdout.flush()
+
+    if changed and args["reload_cmd"] is not None:
+        run_reload_cmd(args["reload_cmd"])
+
+
+def watch_sync_all(daemon, args):
+    """
+    Sync every site directory, and the vhosts of site directories deleted
+    while not watching. Returns the names of the site directories.
+    """
+    names = watch_list_sites(args["watch"])
+    watch_sync(daemon, args, names | watch_inventory_sites(daemon, args["watch"]))
+    return names
+
+
+def watch(args, profiler=NULL_PROFILER):
+    """
+    Keep the vhosts of all site directories below args["watch"] in sync
+    until SIGINT or SIGTERM is received.
+    """
+    import select
+    import signal
+    import time
+
+    if not os.path.isdir(args["watch"]):
+        print("[ERR] Watch path does not exist:", args["watch"], file=sys.stderr)
+        sys.exit(1)
+
+    daemon = VhostDaemon(args, profiler)
+    succ, err = daemon.load()
+    if not succ:
+        print("[ERR]", err, file=sys.stderr)
+        sys.exit(1)
+    succ, err = check_conf_dir(daemon.config)
+    if not succ:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, stop)
+
+    fd = None if args["poll"] else inotify_watch(args["watch"])
+    if fd is None and not args["poll"]:
+        print("[WARN] inotify not available, falling back to polling",
+              file=sys.stderr)
+
+    # Initial full sync
+    known = watch_sync_all(daemon, args)
+    if args["metrics"] is not None:
+        write_metrics(args["metrics"], profiler, daemon.config)
+
+    try:
+        while True:
+            if fd is None:
+                time.sleep(WATCH_POLL_INTERVAL)
+                current = watch_list_sites(args["watch"])
+                changed = current ^ known
+                known = current
+            else:
+                select.select([fd], [], [])
+                changed = set()
+                # Coalesce bursts of events into a single batch
+                while True:
+                    names = inotify_read(fd)
+                    if names is None:
+                        changed = None
+                    elif changed is not None:
+                        changed |= names
+                    if not select.select([fd], [], [], WATCH_DEBOUNCE)[0]:
+                        break
+                # Also catch what the events missed, e.g. a directory
+                # deleted and created again, or an overflowed queue
+                current = watch_list_sites(args["watch"])
+                if changed is None:
+                    changed = current | known
+                else:
+                    changed |= current ^ known
+                known = current
+            if changed:
+                watch_sync(daemon, args, changed)
+                if args["metrics"] is not None:
+                    write_metrics(args["metrics"], profiler, daemon.config)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+############################################################
+# Main Function
+############################################################
+
+
+# Config, template and fragment cache of a --jobs pool worker process
+BATCH_WORKER = None
+
+
+def render_entries(config, template, fragments, items, save, profiler):
+    """
+    Render (and save) a list of (index, vhost) items.
+
+    Returns a (index, vhost_name, status, error, output, digest) tuple per
+    item, output is only kept when not saving and digest only when saved.
+    """
+    done = []
+    for index, vhost in items:
+        with profiler.phase("render"):
+            ctx = VhostContext(config, vhost["name"], vhost["docroot"],
+                               vhost["proxy"], vhost["mode"], vhost["location"],
+                               vhost["default"])
+            output = get_vhost(ctx, template, fragments)
+        if not save:
+            done.append((index, ctx.vhost_name, None, None, output, None))
+            continue
+
+        with profiler.phase("write"):
+            succ, status, err = save_vhost(config, vhost["name"], output)
+        digest = None
+        if succ:
+            profiler.count_save(status, output)
+            digest = vhost_digest(output)
+            err = None
+        else:
+            profiler.count("errors", "write")
+        done.append((index, ctx.vhost_name, status, err, None, digest))
+    return done
+
+
+def batch_worker_init(config, template):
+    """Initialize a --jobs pool worker, which gets config and template only once."""
+    global BATCH_WORKER
+    BATCH_WORKER = (config, template, FragmentCache(config, template))
+
+
+def batch_worker(task):
+    """Render (and save) one shard of items in a --jobs pool worker."""
+    save, profile, items = task
+    config, template, fragments = BATCH_WORKER
+    profiler = PhaseProfiler(profile)
+    done = render_entries(config, template, fragments, items, save, profiler)
+    return (done, profiler.samples, profiler.counters, profiler.observations)
+
+
+def render_entries_parallel(config, template, items, save, jobs, profiler):
+    """
+    Render (and save) a list of (index, vhost) items with a pool of jobs
+    worker processes. Items are split into contiguous shards and the results
+    are returned in the order of items.
+    """
+    import multiprocessing
+
+    # A few shards per worker, so slow shards do not leave workers idle
+    size = max(1, -(-len(items) // (jobs * 4)))
+    tasks = [(save, profiler.enabled, items[i:i + size])
+             for i in range(0, len(items), size)]
+
+    done = []
+    with multiprocessing.Pool(jobs, batch_worker_init, (config, template)) as pool:
+        for shard, samples, counters, observations in pool.imap(batch_worker, tasks):
+            done.extend(shard)
+            profiler.merge(samples, counters, observations)
+    return done
+
+
+def run_batch(config, template, fragments, entries, save, verbose,
+              profiler=NULL_PROFILER, jobs=1, bundle=None, mass=False):
+    """
+    Validate every manifest entry up front, then render (and save) every
+    valid one with the same loaded config and template, using jobs worker
+    processes if more than one. With bundle (a number of shards), vhosts
+    are saved into bundles, each changed bundle is written once. With mass,
+    vhosts the mass hosting server block can serve are only added to its
+    map, its server block is updated once.
+
+    Returns the list of per-entry results and an error message (or None)
+    for failures affecting the whole batch.
+    """
+    results = []
+    seen = set()
+    for index, entry in enumerate(entries):
+        vhost, err, warnings = check_manifest_entry(entry)
+        label = "#%d" % (index + 1)
+        if isinstance(entry, dict) and entry.get("name") is not None:
+            label = to_str(entry["name"])
+        if err is None and vhost["name"] in seen:
+            err = "Duplicate name in manifest"
+        if err is None:
+            seen.add(vhost["name"])
+        results.append({
+            "label": label,
+            "vhost": vhost,
+            "error": err,
+            "warnings": warnings,
+            "status": None,
+            "path": None,
+            "output": None,
+        })
+
+    for result in results:
+        if result["error"] is not None:
+            profiler.count("errors", "manifest_entry")
+
+    if save:
+        succ, err = check_conf_dir(config)
+        if not succ:
+            profiler.count("errors", "conf_dir")
+            return (results, err)
+        with profiler.phase("write"):
+            succ, err = save_snippets(fragments)
+        if not succ:
+            profiler.count("errors", "write")
+            return (results, err)
+
+    # Render (and save) every valid entry
+    items = [(index, result["vhost"]) for index, result in enumerate(results)
+             if result["error"] is None]
+    mass_items = []
+    if save and mass:
+        mass_items = [item for item in items if is_mass_vhost(config, item[1])]
+        items = [item for item in items if not is_mass_vhost(config, item[1])]
+    render_save = save and bundle is None
+    if jobs > 1 and len(items) > 1:
+        done = render_entries_parallel(config, template, items, render_save,
+                                       min(jobs, len(items)), profiler)
+    else:
+        done = render_entries(config, template, fragments, items, render_save,
+                              profiler)
+
+    bundles = dict()
+    if save and bundle is not None:
+        for index, _, _, _, _, _ in done:
+            name = results[index]["vhost"]["name"]
+            bundles[name] = get_bundle_path(config, name, bundle)
+    mass_frame = None
+    if mass_items:
+        with profiler.phase("write"):
+            succ, status, err = save_mass_frame(config, template, fragments)
+        if not succ:
+            profiler.count("errors", "write")
+            return (results, err)
+        mass_frame = {"label": MASS_NAME, "vhost": None, "error": None,
+                      "warnings": [], "status": status,
+                      "path": get_mass_path(config), "output": None}
+        for index, vhost in mass_items:
+            with profiler.phase("render"):
+                ctx = VhostContext(config, vhost["name"], vhost["docroot"],
+                                   vhost["proxy"], vhost["mode"], vhost["location"],
+                                   vhost["default"])
+                done.append((index, ctx.vhost_name, None, None, get_mass_entry(ctx),
+                             None))
+            bundles[vhost["name"]] = get_mass_path(config)
+
+    if bundles:
+        sectioned = [i for i, item in enumerate(done)
+                     if results[item[0]]["vhost"]["name"] in bundles]
+        names = [results[done[i][0]]["vhost"]["name"] for i in sectioned]
+        with profiler.phase("write"):
+            succ, statuses, err = save_bundle_vhosts(
+                [(bundles[name], name, done[i][4]) for name, i in zip(names, sectioned)])
+        if not succ:
+            profiler.count("errors", "write")
+            return (results, err)
+        for i, status in zip(sectioned, statuses):
+            index, vhost_name, _, _, output, _ = done[i]
+            profiler.count_save(status, output)
+            done[i] = (index, vhost_name, status, None, None, vhost_digest(output))
+
+    saved = []
+    for index, vhost_name, status, err, output, digest in done:
+        result = results[index]
+        if digest is not None:
+            saved.append((result["vhost"], digest))
+        if verbose:
             print(
-                "[ERR] directory does not have write permissions",
-                config["conf_dir"],
+                "vhostgen: [%s] Adding: %s"
+                % (log_time(), vhost_name),
                 file=sys.stderr,
             )
-            sys.exit(1)
+        if save:
+            result["error"] = err
+            result["status"] = status
+            result["path"] = bundles.get(result["vhost"]["name"]) or get_vhost_path(
+                config, result["vhost"]["name"])
+        else:
+            result["output"] = output
 
-        vhost_path = os.path.join(config["conf_dir"], name + ".conf")
-        with open(vhost_path, "w") as outfile:
-            outfile.write(vhost)
+    if saved:
+        inventory = Inventory(config)
+        succ, err = inventory.record(fragments, saved, bundles)
+        inventory.close()
+        if not succ:
+            print("[WARN]", err, file=sys.stderr)
+    if mass_frame is not None:
+        results.append(mass_frame)
+
+    # Apply settings for logging (symlinks, mkdir) once for the whole batch
+    if save and [result for result in results if result["error"] is None]:
+        with profiler.phase("apply_log_settings"):
+            succ, err = apply_log_settings(config)
+        if not succ:
+            profiler.count("errors", "apply_log_settings")
+            return (results, err)
+
+    return (results, None)
+
+
+def print_batch_results(results, save):
+    """Print the rendered vhosts (if not saved) and the batch summary."""
+    for result in results:
+        for warning in result["warnings"]:
+            print("[WARN] %s: %s" % (result["label"], warning), file=sys.stderr)
+        if result["output"] is not None:
+            print(result["output"])
+
+    # Print summary (to stderr when vhosts are printed to stdout)
+    stream = sys.stdout if save else sys.stderr
+    failed = 0
+    changed = 0
+    for result in results:
+        if result["error"] is not None:
+            failed += 1
+            print("[FAIL] %s: %s" % (result["label"], result["error"]),
+                  file=stream)
+        elif result["status"] is not None:
+            print("[OK]   %s: %s %s" % (result["label"], result["status"],
+                                        result["path"]), file=stream)
+        else:
+            print("[OK]   %s" % (result["label"]), file=stream)
+        if result["status"] in (STATUS_CREATED, STATUS_UPDATED):
+            changed += 1
+    print(
+        "vhostgen: %d succeeded, %d failed" % (len(results) - failed, failed),
+        file=stream,
+    )
+    if save:
+        print("reload: %s" % ("yes" if changed else "no"), file=stream)
 
-        # Apply settings for logging (symlinks, mkdir) only in save mode
-        succ, err = apply_log_settings(config)
+    return failed
+
+
+def regenerate_vhosts(config, template, fragments, inventory,
+                      profiler=NULL_PROFILER, bundle=None, mass=False):
+    """
+    Render every vhost of the inventory again from its stored spec, after
+    config or templates changed. Vhosts whose config and template sections
+    did not change (and whose file still exists) are skipped without
+    rendering, the others are only rewritten if their content changed.
+    Disabled vhosts are regenerated into their disabled file.
+
+    Vhosts stay in their file or bundle, unless bundle (a number of shards)
+    is given: then every vhost not yet in its bundle is moved there. With
+    mass, every vhost the mass hosting server block can serve is moved to
+    its map instead. The server block is updated whenever a vhost is there.
+
+    Returns the list of per-vhost results (name, status, path and error)
+    and an error message (or None) for failures affecting all vhosts.
+    """
+    succ, err = check_conf_dir(config)
+    if not succ:
+        profiler.count("errors", "conf_dir")
+        return ([], err)
+    with profiler.phase("write"):
+        succ, err = save_snippets(fragments)
+    if not succ:
+        profiler.count("errors", "write")
+        return ([], err)
+    succ, entries, err = inventory.entries()
+    if not succ:
+        return ([], err)
+
+    results = []
+    rendered = []
+    bundled = []
+    moved = []
+    mass_frame = False
+    for entry in entries:
+        spec = entry["spec"]
+        suffix = "" if entry["enabled"] else DISABLED_SUFFIX
+        current = inventory.local_path(entry["path"])
+        target = current
+        if mass and is_mass_vhost(config, spec):
+            target = get_mass_path(config)
+        elif bundle is not None:
+            target = get_bundle_path(config, entry["name"], bundle)
+        path = target + suffix
+        mass_frame = mass_frame or is_mass_path(target)
+        result = {"name": entry["name"], "status": STATUS_SKIPPED, "path": path,
+                  "enabled": entry["enabled"], "error": None}
+        results.append(result)
+
+        config_digest, template_digest = fragments.dependencies(spec)
+        if (config_digest == entry["config_digest"]
+                and template_digest == entry["template_digest"]
+                and target == current and os.path.exists(path)):
+            continue
+
+        with profiler.phase("render"):
+            ctx = VhostContext(config, spec["name"], spec["docroot"],
+                               spec["proxy"], spec["mode"], spec["location"],
+                               spec["default"])
+            if is_mass_path(target):
+                output = get_mass_entry(ctx)
+            else:
+                output = get_vhost(ctx, template, fragments)
+        if target != current:
+            moved.append((current + suffix, entry["name"]))
+        if is_bundle_path(target):
+            bundled.append((result, path, output))
+        else:
+            with profiler.phase("write"):
+                succ, status, err = save_vhost_path(path, output)
+            if not succ:
+                profiler.count("errors", "write")
+                result["status"] = None
+                result["error"] = err
+                continue
+            profiler.count_save(status, output)
+            result["status"] = status
+        rendered.append((entry["name"], target, vhost_digest(output), config_digest,
+                         template_digest))
+
+    if mass_frame:
+        with profiler.phase("write"):
+            succ, status, err = save_mass_frame(config, template, fragments)
+        if not succ:
+            profiler.count("errors", "write")
+            return (results, err)
+        results.append({"name": MASS_NAME, "status": status,
+                        "path": get_mass_path(config), "enabled": True,
+                        "error": None})
+
+    if bundled:
+        with profiler.phase("write"):
+            succ, statuses, err = save_bundle_vhosts(
+                [(path, result["name"], output) for result, path, output in bundled])
+        if not succ:
+            profiler.count("errors", "write")
+            return (results, err)
+        for (result, _, output), status in zip(bundled, statuses):
+            profiler.count_save(status, output)
+            result["status"] = status
+
+    for path, name in moved:
+        succ, err = remove_vhost_path(path, name)
+        if not succ:
+            print("[WARN]", error_message(err), file=sys.stderr)
+
+    if rendered:
+        succ, err = inventory.update(rendered)
+        if not succ:
+            print("[WARN]", err, file=sys.stderr)
+        with profiler.phase("apply_log_settings"):
+            succ, err = apply_log_settings(config)
+        if not succ:
+            profiler.count("errors", "apply_log_settings")
+            return (results, err)
+
+    return (results, None)
+
+
+def print_regenerate_results(results):
+    """Print the vhosts a regeneration rendered, its summary and if a reload is needed."""
+    counts = dict()
+    reload = False
+    for result in results:
+        status = result["status"]
+        counts[status] = counts.get(status, 0) + 1
+        if result["error"] is not None:
+            print("[FAIL] %s: %s" % (result["name"], result["error"]))
+        elif status != STATUS_SKIPPED:
+            print("[OK]   %s: %s %s" % (result["name"], status, result["path"]))
+            reload = reload or (result["enabled"]
+                                and status in (STATUS_CREATED, STATUS_UPDATED))
+    print(
+        "vhostgen: %d vhosts, %d skipped, %d created, %d updated, %d unchanged,"
+        " %d failed" % (len(results), counts.get(STATUS_SKIPPED, 0),
+                        counts.get(STATUS_CREATED, 0), counts.get(STATUS_UPDATED, 0),
+                        counts.get(STATUS_UNCHANGED, 0), counts.get(None, 0))
+    )
+    print("reload: %s" % ("yes" if reload else "no"))
+    return counts.get(None, 0)
+
+
+def main_batch(args, config, template, profiler=NULL_PROFILER):
+    """Generate all vhosts of a manifest with one loaded config and template."""
+
+    with profiler.phase("load_manifest"):
+        succ, entries, err = load_manifest(args["manifest"])
+    if not succ:
+        profiler.count("errors", "load_manifest")
+        print("[ERR] Error loading manifest", err, file=sys.stderr)
+        sys.exit(1)
+
+    stage = None
+    if args["stage"]:
+        stage = StagedConfDir(config)
+        succ, err = stage.open()
         if not succ:
             print(err, file=sys.stderr)
             sys.exit(1)
+        config = stage.config
+
+    fragments = FragmentCache(config, template)
+    results, err = run_batch(config, template, fragments, entries,
+                             args["save"], args["verbose"], profiler,
+                             args["jobs"], args["bundle"], args["mass"])
+    if err is not None:
+        if stage is not None:
+            stage.abort()
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    if args["verbose"]:
+        print("vhostgen:", fragments.stats(), file=sys.stderr)
+
+    if stage is not None:
+        for result in results:
+            if result["path"] is not None:
+                result["path"] = stage.live_path(result["path"])
+        finish_stage(stage, args)
+
+    failed = print_batch_results(results, args["save"])
+    if args["reload_cmd"] is not None and [
+            result for result in results
+            if result["status"] in (STATUS_CREATED, STATUS_UPDATED)]:
+        if not run_reload_cmd(args["reload_cmd"]):
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+def stream_result(stream, result, vhost_parts=None):
+    """
+    Write one NDJSON result line. The rendered server blocks are
+    encoded into its "vhost" string as they are rendered.
+    """
+    import json
+
+    line = json.dumps(result)
+    if vhost_parts is None:
+        stream.write(line + "\n")
+    else:
+        stream.write(line[:-1] + ', "vhost": "')
+        for part in vhost_parts:
+            stream.write(json.dumps(part)[1:-1])
+        stream.write('"}\n')
+    stream.flush()
+
+
+def main_inventory(args):
+    """List, show, remove, disable or enable vhosts using the inventory."""
+    succ, config, err = load_config(args["config_path"], args["cache_dir"])
+    if not succ:
+        raise ConfigError("Error loading config " + err)
+    validate_config(config)
+
+    inventory = Inventory(config)
+    response = inventory_request(inventory, args["inventory"],
+                                 args["inventory_name"])
+    inventory.close()
+    print_inventory_response(args["inventory"], response)
+
+
+def main_gc(args):
+    """Find orphaned vhosts, disable or remove them and reload the server once."""
+    succ, config, err = load_config(args["config_path"], args["cache_dir"])
+    if not succ:
+        raise ConfigError("Error loading config " + err)
+    validate_config(config)
+
+    inventory = Inventory(config)
+    response = gc_request(inventory, args["gc_action"])
+    inventory.close()
+    changed = print_gc_response(response, args["gc_action"])
+    if changed and args["reload_cmd"] is not None:
+        if not run_reload_cmd(args["reload_cmd"]):
+            sys.exit(1)
+
+
+def stack_specs(spec, backend_config, backend_host):
+    """
+    Get the backend vhost spec and the spec of the front reverse proxy vhost
+    forwarding everything to it (over https for modes with an ssl vhost).
+    """
+    if spec["mode"] in ("ssl", "both", "redir", "let"):
+        proxy = "https://%s:%s" % (backend_host, backend_config["vhost"]["ssl_port"])
+    else:
+        proxy = "http://%s:%s" % (backend_host, backend_config["vhost"]["port"])
+
+    backend = dict(spec, location=None)
+    front = dict(spec, docroot=None, proxy=proxy, location=spec["location"] or "/")
+    return (backend, front)
+
+
+def main_stack(args, vg, profiler):
+    """
+    Render a backend vhost (-p) and the front reverse proxy vhost for it
+    with both config/template pairs loaded once, and save both as a pair.
+    """
+    backend_vg = load(args["stack_config"], args["stack_tpl"], None,
+                      args["cache_dir"], profiler, defaults=True)
+
+    spec = {key: args[key] for key in MANIFEST_KEYS}
+    backend_spec, front_spec = stack_specs(spec, backend_vg.config, args["stack"])
+    with profiler.phase("render"):
+        pair = []
+        for pair_vg, pair_spec in ((backend_vg, backend_spec), (vg, front_spec)):
+            ctx = pair_vg.context(pair_spec)
+            pair.append((pair_vg, ctx, get_vhost(ctx, pair_vg.template,
+                                                 pair_vg.fragments)))
+
+    if not args["save"]:
+        for _, _, vhost in pair:
+            print(vhost)
+        return
+
+    for pair_vg, _, _ in pair:
+        succ, err = check_conf_dir(pair_vg.config)
+        if succ:
+            succ, err = save_snippets(pair_vg.fragments)
+        if not succ:
+            raise SaveError(error_message(err))
+    with profiler.phase("write"):
+        succ, statuses, err = save_vhost_pair(
+            [(pair_vg.config, ctx.name, vhost) for pair_vg, ctx, vhost in pair])
+    if not succ:
+        raise SaveError(error_message(err))
+
+    for (pair_vg, ctx, vhost), status in zip(pair, statuses):
+        profiler.count_save(status, vhost)
+        succ, err = pair_vg.inventory.record(pair_vg.fragments,
+                                             [(ctx.spec(), vhost_digest(vhost))])
+        pair_vg.inventory.close()
+        if not succ:
+            print("[WARN]", err, file=sys.stderr)
+        print(status, pair_vg.path(ctx.name))
+
+    with profiler.phase("apply_log_settings"):
+        for pair_vg, _, _ in pair:
+            pair_vg.apply_log_settings()
+
+
+def main_regenerate(args, vg, profiler):
+    """Regenerate the vhosts of the inventory affected by config or template changes."""
+    config = vg.config
+    stage = None
+    if args["stage"]:
+        stage = StagedConfDir(config)
+        succ, err = stage.open()
+        if not succ:
+            raise SaveError(error_message(err))
+        config = stage.config
+
+    inventory = Inventory(config)
+    results, err = regenerate_vhosts(config, vg.template, vg.fragments,
+                                     inventory, profiler, args["bundle"],
+                                     args["mass"])
+    inventory.close()
+    if err is not None:
+        if stage is not None:
+            stage.abort()
+        raise SaveError(error_message(err))
+
+    if stage is not None:
+        for result in results:
+            result["path"] = stage.live_path(result["path"])
+        finish_stage(stage, args)
+
+    failed = print_regenerate_results(results)
+    if args["reload_cmd"] is not None and [
+            result for result in results
+            if result["enabled"] and result["status"] in (STATUS_CREATED,
+                                                          STATUS_UPDATED)]:
+        if not run_reload_cmd(args["reload_cmd"]):
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+def main_stream(args, handle, profiler):
+    """
+    Render (and save) a NDJSON manifest one line at a time, without keeping
+    entries or rendered vhosts around.
+
+    handle(entry) does the work for a single entry. It returns the result
+    fields (status and path, or vhost) and, when the vhost still has to be
+    rendered to stdout, its server blocks (else None). Failures are raised
+    as VhostGenError.
+    """
+    import json
+
+    if args["manifest"] in (None, "-"):
+        source = sys.stdin
+    else:
+        try:
+            source = open(args["manifest"], "r")
+        except IOError:
+            raise ArgumentError("File does not exist: " + args["manifest"])
+
+    succeeded = 0
+    failed = 0
+    changed = False
+    with source:
+        for number, line in enumerate(source, 1):
+            if not line.strip():
+                continue
+            result = {"line": number, "name": None}
+            try:
+                entry = json.loads(line)
+            except ValueError as err:
+                entry = None
+                error = "Invalid JSON: " + str(err)
+            if isinstance(entry, dict) and entry.get("name") is not None:
+                result["name"] = to_str(entry["name"])
+
+            try:
+                if entry is None:
+                    with profiler.phase("validate_args"):
+                        raise ArgumentError(error)
+                fields, parts = handle(entry)
+            except VhostGenError as err:
+                result["ok"] = False
+                result["error"] = str(err)
+                stream_result(sys.stdout, result)
+                failed += 1
+                continue
+
+            result["ok"] = True
+            result.update(fields)
+            if parts is None:
+                stream_result(sys.stdout, result)
+            else:
+                with profiler.phase("render"):
+                    stream_result(sys.stdout, result, parts)
+            changed = changed or fields.get("status") in (STATUS_CREATED,
+                                                          STATUS_UPDATED)
+            succeeded += 1
+
+    print("vhostgen: %d succeeded, %d failed" % (succeeded, failed), file=sys.stderr)
+    if args["save"]:
+        print("reload: %s" % ("yes" if changed else "no"), file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+def stream_handler(args, vg, profiler):
+    """Get the main_stream() handler rendering (and saving) with vg."""
+    state = {"log_settings": False}
+
+    def handle(entry):
+        with profiler.phase("validate_args"):
+            ctx = vg.context(entry)
+        parts = iter_vhost(ctx, vg.template, vg.fragments)
+        if args["verbose"]:
+            print("vhostgen: [%s] Adding: %s" % (log_time(), ctx.vhost_name),
+                  file=sys.stderr)
+        if not args["save"]:
+            return (dict(), parts)
+
+        with profiler.phase("render"):
+            vhost = "".join(parts)
+        with profiler.phase("write"):
+            status, path = vg.write(ctx.name, vhost, ctx.spec())
+        profiler.count_save(status, vhost)
+        if not state["log_settings"]:
+            with profiler.phase("apply_log_settings"):
+                vg.apply_log_settings()
+            state["log_settings"] = True
+        return ({"status": status, "path": path}, None)
+
+    return handle
+
+
+def main(argv):
+    """Main entrypoint."""
+
+    # Answer --help and --version without parsing (and importing) anything
+    if argv == ["--help"]:
+        print_help()
+        return
+    if argv == ["--version"]:
+        print_version()
+        return
+
+    # Get command line arguments
+    start = profile_clock()
+    args = parse_args(argv)
+
+    profiler = PhaseProfiler(args["profile"] or args["metrics"] is not None)
+    profiler.add_startup(start)
+    profiler.add_since("parse_args", start)
+
+    cprofile = None
+    if args["profile_out"] is not None:
+        import cProfile
+
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+    try:
+        run(args, profiler)
+    except ArgumentError as err:
+        print("[ERR]", err, file=sys.stderr)
+        print("Type --help for help", file=sys.stderr)
+        sys.exit(1)
+    except VhostGenError as err:
+        print("[ERR]", err, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if cprofile is not None:
+            cprofile.disable()
+            cprofile.dump_stats(args["profile_out"])
+        # Before the metrics are written, which drains the profiler
+        if args["profile"]:
+            profiler.print_report()
+        if args["metrics"] is not None:
+            # Only needed for the conf_dir gauges, a daemon answered --connect
+            config = None
+            if args["connect"] is None and os.path.isfile(args["config_path"]):
+                succ, config, _ = load_config(args["config_path"], args["cache_dir"])
+                config = config if succ else None
+            write_metrics(args["metrics"], profiler, config)
+
+
+def run(args, profiler):
+    """Run whatever the parsed command line arguments ask for."""
+    name = args["name"]
+
+    if args["stage"]:
+        if args["connect"] is not None:
+            raise ArgumentError("--stage cannot be used with --connect")
+        if not args["regenerate"] and (args["manifest"] is None or not args["save"]
+                                       or args["ndjson"]):
+            raise ArgumentError("--stage needs -b with -s, or --regenerate")
+    if args["bundle"] is not None:
+        if args["connect"] is not None or args["ndjson"] or args["stack"] is not None:
+            raise ArgumentError("--bundle cannot be used with --connect, --ndjson"
+                                " or --stack")
+        if (not args["save"] and not args["regenerate"] and args["serve"] is None
+                and args["watch"] is None):
+            raise ArgumentError("--bundle needs -s, --regenerate, --serve or --watch")
+    if args["mass"]:
+        if args["connect"] is not None or args["ndjson"] or args["stack"] is not None:
+            raise ArgumentError("--mass cannot be used with --connect, --ndjson"
+                                " or --stack")
+        if (not args["save"] and not args["regenerate"] and args["serve"] is None
+                and args["watch"] is None):
+            raise ArgumentError("--mass needs -s, --regenerate, --serve or --watch")
+    if args["stack"] is not None:
+        if args["connect"] is not None or args["manifest"] is not None:
+            raise ArgumentError("--stack cannot be used with --connect or -b")
+        if args["proxy"] is not None:
+            raise ArgumentError("--stack renders the reverse proxy itself, use -p")
+
+    # Validate command line arguments (as a single profile phase)
+    # This will abort the program on error
+    local = (args["connect"] is None and args["inventory"] is None
+             and not args["gc"])
+    with profiler.phase("validate_args"):
+        if (args["manifest"] is None and args["serve"] is None
+                and args["watch"] is None and not args["ndjson"]
+                and args["inventory"] is None and not args["regenerate"]
+                and not args["gc"]):
+            validate_args_req(name, args["docroot"], args["proxy"], args["mode"],
+                              args["location"])
+        if local:
+            validate_args_opt(args["config_path"], args["tpl_dir"])
+        if local and args["stack"] is not None:
+            validate_args_opt(args["stack_config"], args["stack_tpl"])
+
+    # Let a running daemon do the work
+    if args["connect"] is not None:
+        main_client(args, profiler)
+        return
+
+    if args["inventory"] is not None:
+        main_inventory(args)
+        return
+
+    if args["gc"]:
+        main_gc(args)
+        return
+
+    if args["serve"] is not None:
+        serve(args, profiler)
+        return
+
+    if args["watch"] is not None:
+        watch(args, profiler)
+        return
+
+    # Load config and template
+    vg = load(args["config_path"], args["tpl_dir"], args["o_tpl_dir"],
+              args["cache_dir"], profiler, defaults=True)
+    if args["mass"] and vg.config["server"] not in MASS:
+        raise ArgumentError("--mass is not supported for " + vg.config["server"])
+
+    if args["regenerate"]:
+        main_regenerate(args, vg, profiler)
+        return
+
+    if args["stack"] is not None:
+        main_stack(args, vg, profiler)
+        return
+
+    if args["ndjson"]:
+        main_stream(args, stream_handler(args, vg, profiler), profiler)
+        return
+
+    if args["manifest"] is not None:
+        main_batch(args, vg.config, vg.template, profiler)
+        return
+
+    # Retrieve fully build vhost
+    spec = {key: args[key] for key in MANIFEST_KEYS}
+    with profiler.phase("render"):
+        ctx, vhost, mass = vg.prepare(spec, args["mass"])
+
+    if args["verbose"]:
+        print(
+            "vhostgen: [%s] Adding: %s"
+            % (log_time(), ctx.vhost_name)
+        )
+        print("vhostgen:", vg.fragments.stats(), file=sys.stderr)
+
+    if args["save"]:
+        with profiler.phase("write"):
+            status, path = vg.write(name, vhost, ctx.spec(), args["bundle"], mass)
+        profiler.count_save(status, vhost)
+        print(status, path)
+
+        # Apply settings for logging (symlinks, mkdir) only in save mode
+        with profiler.phase("apply_log_settings"):
+            vg.apply_log_settings()
     else:
         print(vhost)
 